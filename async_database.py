@@ -0,0 +1,1064 @@
+"""
+Асинхронный слой доступа к базе данных (psycopg 3)
+
+Используется ботами, парсером и планировщиком: запросы выполняются
+без блокировки цикла событий и без отдельных потоков. Схему БД создает
+синхронный Database при старте приложения.
+"""
+import asyncio
+import hashlib
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Optional, List, Dict
+
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from utils.logger import get_logger
+from utils.write_spool import WriteSpool
+from config.app_settings import (
+    ASYNC_DB_POOL_MIN_SIZE, ASYNC_DB_POOL_MAX_SIZE, DB_POOL_CHECKOUT_TIMEOUT_SECONDS,
+    USER_LOG_QUEUE_SIZE, USER_LOG_BATCH_SIZE, USER_LOG_FLUSH_INTERVAL_SECONDS, USER_CACHE_RECONNECT_SECONDS,
+    ADMIN_SQL_STATEMENT_TIMEOUT_SECONDS, ADMIN_SQL_MAX_ROWS, ADMIN_SQL_FETCH_SIZE,
+    WRITE_SPOOL_PATH, WRITE_SPOOL_MAX_MB, WRITE_SPOOL_REPLAY_INTERVAL_SECONDS, WRITE_SPOOL_REPLAY_BATCH_SIZE
+)
+
+logger = get_logger('async_database')
+
+# Маркер остановки фоновой записи логов в очереди (см. _log_writer)
+LOG_QUEUE_STOP = object()
+
+
+def _db_unavailable(error: Exception) -> bool:
+    """Ошибка означает недоступность базы (обрыв, отказ в подключении, таймаут пула), а не ошибку запроса"""
+    if not isinstance(error, psycopg.OperationalError):
+        return False
+    # У ошибок соединения и таймаута пула нет SQLSTATE; 08xxx - ошибки подключения,
+    # 57P01-57P03 - остановка или перезапуск сервера
+    return error.sqlstate is None or error.sqlstate.startswith('08') or error.sqlstate in ('57P01', '57P02', '57P03')
+
+
+class AsyncDatabase:
+    # Записи, которые откладываются в журнал при недоступной базе: {операция: метод записи}.
+    # Метод принимает (conn, source, rows) и пишет в транзакции conn: при повторе журнала
+    # в той же транзакции отмечаются воспроизведенные записи (см. _replay_records)
+    SPOOLED_WRITES = {
+        'ads': '_write_ads',
+        'deliveries': '_write_deliveries',
+        'user_logs': '_write_logs',
+        'parsing_logs': '_write_parsing_logs',
+    }
+
+    def __init__(self, db_config: dict):
+        self.db_config = db_config
+        # psycopg 3 ожидает dbname вместо database
+        self._conn_kwargs = {
+            ('dbname' if key == 'database' else key): value
+            for key, value in db_config.items()
+        }
+        self.pool = AsyncConnectionPool(
+            kwargs=self._conn_kwargs,
+            min_size=ASYNC_DB_POOL_MIN_SIZE,
+            max_size=ASYNC_DB_POOL_MAX_SIZE,
+            timeout=DB_POOL_CHECKOUT_TIMEOUT_SECONDS,
+            check=AsyncConnectionPool.check_connection,
+            open=False
+        )
+        # Отдельное соединение для сессионных advisory-блокировок: блокировку
+        # нужно снимать тем же соединением, которым она взята
+        self._lock_conn = None
+        self._lock_conn_guard = asyncio.Lock()
+        # Админские /sql-запросы изолированы от пула (см. execute_sql)
+        self._admin_conn = None
+        self._admin_sql_guard = asyncio.Lock()
+        # Логи действий пользователей пишутся в фоне пачками (см. add_log)
+        self._log_queue = asyncio.Queue(maxsize=USER_LOG_QUEUE_SIZE)
+        self._pending_logs = []
+        self._log_writer_task = None
+        self.dropped_logs = 0
+        # Пакетный upsert объявлений: сколько строк переписано и сколько пропущено без изменений
+        self.ads_touched = 0
+        self.ads_untouched = 0
+        # Кэш строк users по user_id: обновляется при записи через этот объект и по
+        # уведомлениям users_changed от других процессов (см. _users_listener)
+        self._users = {}
+        self._users_loaded = False
+        self._users_listener_task = None
+        # Журнал записей, отложенных на время недоступности базы (см. _spooled_write)
+        self._spool = WriteSpool(WRITE_SPOOL_PATH, WRITE_SPOOL_MAX_MB * 1024 * 1024)
+        self._spool_guard = asyncio.Lock()
+        self._spool_append_guard = asyncio.Lock()
+        self._spool_replayer_task = None
+        # Размыкатель: после ошибки недоступности записи идут сразу в журнал, не дожидаясь
+        # таймаута пула; проверяет базу и снимает флаг только воспроизведение журнала
+        self._db_down = False
+
+    async def open(self):
+        """Открыть пул соединений и запустить фоновую запись логов"""
+        try:
+            await self.pool.open(wait=True)
+            logger.info(
+                f"Асинхронный пул соединений создан (min={ASYNC_DB_POOL_MIN_SIZE}, max={ASYNC_DB_POOL_MAX_SIZE})"
+            )
+        except Exception as e:
+            logger.error(f"Ошибка подключения к базе данных: {e}")
+            raise
+        self._log_writer_task = asyncio.create_task(self._log_writer())
+        self._users_listener_task = asyncio.create_task(self._users_listener())
+        self._spool_replayer_task = asyncio.create_task(self._spool_replayer())
+
+    @asynccontextmanager
+    async def cursor(self, row_factory=None):
+        """
+        Курсор на соединении из пула в рамках одной транзакции
+
+        При выходе из блока транзакция фиксируется, при исключении
+        откатывается (это делает pool.connection()). Запросы горячих путей
+        выполняются с prepare=True: psycopg готовит их на сервере один раз
+        на соединение и дальше передает только параметры.
+        """
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=row_factory) as cur:
+                yield cur
+
+    @asynccontextmanager
+    async def _lock_cursor(self):
+        """Курсор на выделенном соединении для advisory-блокировок"""
+        async with self._lock_conn_guard:
+            if self._lock_conn is None or self._lock_conn.closed:
+                # При переподключении блокировки прежней сессии уже освобождены сервером
+                self._lock_conn = await psycopg.AsyncConnection.connect(autocommit=True, **self._conn_kwargs)
+            try:
+                async with self._lock_conn.cursor() as cur:
+                    yield cur
+            except psycopg.OperationalError:
+                await self._lock_conn.close()
+                raise
+
+    async def _spooled_write(self, op: str, source: Optional[str], rows: list):
+        """
+        Выполнить запись из SPOOLED_WRITES, а при недоступной базе отложить ее в журнал
+
+        Пока в журнале есть записи, сначала воспроизводится он: новые данные
+        не должны обгонять старые (иначе повтор журнала затрет свежую цену).
+        Пока база считается недоступной (_db_down), запись сразу уходит в
+        журнал: каждый вызов иначе ждал бы таймаут пула и повтор журнала.
+
+        Returns:
+            Результат метода записи или None, если запись отложена
+        """
+        if not self._db_down and self._spool.size():
+            await self.replay_spool()
+        if not self._db_down and not self._spool.size():
+            try:
+                async with self.pool.connection() as conn:
+                    return await getattr(self, self.SPOOLED_WRITES[op])(conn, source, rows)
+            except Exception as e:
+                if not _db_unavailable(e):
+                    raise
+                self._db_down = True
+                logger.warning(
+                    f"База недоступна, запись {op} ({len(rows)} строк) и следующие записи "
+                    f"откладываются в журнал до его воспроизведения: {e}"
+                )
+        # id записи журнала позволяет при повторе пропустить уже записанное (см. _replay_records).
+        # Очередь блокировки сохраняет порядок записей в файле
+        async with self._spool_append_guard:
+            await asyncio.to_thread(
+                self._spool.append, op, {'id': uuid.uuid4().hex, 'source': source, 'rows': rows}
+            )
+        return None
+
+    async def replay_spool(self) -> int:
+        """
+        Воспроизвести журнал отложенных записей
+
+        Журнал читается порциями по WRITE_SPOOL_REPLAY_BATCH_SIZE строк, подряд
+        идущие записи одной операции и источника объединяются в пачки.
+        Воспроизведенная часть удаляется из файла один раз в конце. Если база
+        снова недоступна, воспроизведение прерывается до следующей попытки,
+        после полного воспроизведения записи снова идут в базу (_db_down).
+
+        Returns:
+            Количество воспроизведенных записей журнала
+        """
+        async with self._spool_guard:
+            offset = 0
+            replayed = 0
+            available = True
+            while available:
+                records = await asyncio.to_thread(self._spool.read, offset, WRITE_SPOOL_REPLAY_BATCH_SIZE)
+                if not records:
+                    break
+                for (op, source), payloads, end in self._group_spool_records(records):
+                    try:
+                        await self._replay_batch(op, source, payloads)
+                    except Exception as e:
+                        logger.warning(f"База недоступна, журнал будет воспроизведен позже: {e}")
+                        available = False
+                        break
+                    offset = end
+                    replayed += len(payloads)
+            if self._db_down and available:
+                logger.info("Журнал воспроизведен, записи снова идут в базу")
+            self._db_down = not available
+
+            # Если сбой случится до удаления, повтор пропустит записи по spool_replayed
+            if offset:
+                await asyncio.to_thread(self._spool.consume, offset)
+            if replayed:
+                logger.info(f"Из журнала отложенных записей воспроизведено записей: {replayed}")
+            return replayed
+
+    @staticmethod
+    def _group_spool_records(records: List[tuple]) -> List[tuple]:
+        """Объединить подряд идущие записи одной операции и источника: [((op, source), [данные], конец)]"""
+        batches = []
+        for op, payload, end in records:
+            key = (op, payload['source'])
+            if batches and batches[-1][0] == key:
+                batches[-1][1].append(payload)
+                batches[-1][2] = end
+            else:
+                batches.append([key, [payload], end])
+        return [tuple(batch) for batch in batches]
+
+    async def _replay_batch(self, op: str, source: Optional[str], payloads: List[Dict]):
+        """
+        Воспроизвести пачку записей журнала
+
+        Если пачка не записалась из-за ошибки в данных, записи повторяются по
+        одной и отбрасываются только те, что не записываются сами по себе.
+        Исключение выходит наружу, только если база недоступна.
+        """
+        try:
+            await self._replay_records(op, source, payloads)
+            return
+        except Exception as e:
+            if _db_unavailable(e):
+                raise
+            if len(payloads) > 1:
+                logger.warning(f"Пачка журнала {op} не записана ({e}), повторяем по одной записи")
+            else:
+                logger.error(f"Запись журнала {op} отброшена ({len(payloads[0]['rows'])} строк): {e}")
+                return
+
+        for payload in payloads:
+            try:
+                await self._replay_records(op, source, [payload])
+            except Exception as e:
+                if _db_unavailable(e):
+                    raise
+                logger.error(f"Запись журнала {op} отброшена ({len(payload['rows'])} строк): {e}")
+
+    async def _replay_records(self, op: str, source: Optional[str], payloads: List[Dict]):
+        """
+        Записать строки записей журнала одной транзакцией с отметкой в spool_replayed
+
+        Записи, уже отмеченные как воспроизведенные (сбой между коммитом и
+        удалением из файла журнала), пропускаются - логи и счетчики не дублируются.
+        """
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("""
+                    INSERT INTO spool_replayed (record_id)
+                    SELECT unnest(%s::varchar[])
+                    ON CONFLICT (record_id) DO NOTHING
+                    RETURNING record_id
+                """, ([payload['id'] for payload in payloads],))
+                fresh = {row[0] for row in await cur.fetchall()}
+            rows = [row for payload in payloads if payload['id'] in fresh for row in payload['rows']]
+            if rows:
+                await getattr(self, self.SPOOLED_WRITES[op])(conn, source, rows)
+
+    async def _spool_replayer(self):
+        """Периодически воспроизводить журнал, даже если новых записей нет"""
+        while True:
+            await asyncio.sleep(WRITE_SPOOL_REPLAY_INTERVAL_SECONDS)
+            if self._spool.size() or self._db_down:
+                try:
+                    await self.replay_spool()
+                except Exception as e:
+                    logger.error(f"Ошибка воспроизведения журнала отложенных записей: {e}")
+
+    async def _users_listener(self):
+        """
+        Поддерживать кэш пользователей по уведомлениям users_changed
+
+        LISTEN выполняется до загрузки кэша, поэтому изменения, сделанные во
+        время загрузки, не теряются. Уведомления за время обрыва соединения
+        не доставляются, поэтому после переподключения кэш загружается заново.
+        """
+        while True:
+            conn = None
+            try:
+                conn = await psycopg.AsyncConnection.connect(autocommit=True, **self._conn_kwargs)
+                await conn.execute("LISTEN users_changed")
+                await self._load_users()
+                async for notify in conn.notifies():
+                    await self._reload_user(int(notify.payload))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Пока слушатель отключен, чтения идут мимо кэша; кэш будет загружен заново
+                self._users_loaded = False
+                self._users = {}
+                logger.warning(f"Слушатель users_changed отключен: {e}")
+            finally:
+                if conn and not conn.closed:
+                    await conn.close()
+            await asyncio.sleep(USER_CACHE_RECONNECT_SECONDS)
+
+    async def _load_users(self):
+        """Загрузить всех пользователей в кэш"""
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("SELECT * FROM users")
+            self._users = {row['user_id']: dict(row) for row in await cur.fetchall()}
+        self._users_loaded = True
+        logger.info(f"Кэш пользователей загружен: {len(self._users)}")
+
+    async def _reload_user(self, user_id: int):
+        """Перечитать пользователя из базы в кэш"""
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,), prepare=True)
+            self._cache_user(user_id, await cur.fetchone())
+
+    def _cache_user(self, user_id: int, row: Optional[Dict]):
+        """Записать строку пользователя в кэш (None - пользователь удален)"""
+        if row:
+            self._users[user_id] = dict(row)
+        else:
+            self._users.pop(user_id, None)
+
+    async def _cached_user(self, user_id: int) -> Optional[Dict]:
+        """
+        Строка пользователя из кэша
+
+        Пока кэш синхронизирован со слушателем, отсутствие в кэше означает
+        отсутствие в базе. Пока слушатель отключен, кэш может устареть
+        (например, снятые права админа), поэтому строка читается из базы.
+        """
+        if self._users_loaded:
+            return self._users.get(user_id)
+        async with self.cursor(dict_row) as cur:
+            await cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,), prepare=True)
+            return await cur.fetchone()
+
+    async def add_user(self, user_id: int, username: str = None, 
+                 first_name: str = None, last_name: str = None,
+                 source: str = None, nickname: str = None, is_admin: bool = False):
+        """Добавить нового пользователя"""
+        try:
+            async with self.cursor(dict_row) as cur:
+                # Проверяем существующего пользователя для сохранения статуса админа
+                await cur.execute("SELECT is_admin FROM users WHERE user_id = %s", (user_id,))
+                existing = await cur.fetchone()
+                if existing:
+                    is_admin = existing['is_admin'] or is_admin
+                
+                await cur.execute("""
+                    INSERT INTO users (user_id, username, first_name, last_name, source, nickname, is_admin)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = EXCLUDED.username,
+                        first_name = EXCLUDED.first_name,
+                        last_name = EXCLUDED.last_name,
+                        nickname = COALESCE(EXCLUDED.nickname, users.nickname),
+                        is_admin = COALESCE(EXCLUDED.is_admin, users.is_admin),
+                        updated_at = CURRENT_TIMESTAMP
+                    RETURNING *
+                """, (user_id, username, first_name, last_name, source, nickname, is_admin))
+                row = await cur.fetchone()
+            self._cache_user(user_id, row)
+            logger.info(f"Пользователь {user_id} добавлен/обновлен")
+        except Exception as e:
+            logger.error(f"Ошибка добавления пользователя: {e}")
+            raise
+    
+    async def update_user_nickname(self, user_id: int, nickname: str):
+        """Обновить никнейм пользователя"""
+        try:
+            async with self.cursor(dict_row) as cur:
+                await cur.execute("""
+                    UPDATE users SET nickname = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = %s
+                    RETURNING *
+                """, (nickname, user_id))
+                row = await cur.fetchone()
+            if row:
+                self._cache_user(user_id, row)
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка обновления никнейма: {e}")
+            return False
+    
+    async def is_admin(self, user_id: int) -> bool:
+        """Проверить является ли пользователь админом (из кэша пользователей)"""
+        try:
+            user = await self._cached_user(user_id)
+            return bool(user and user['is_admin'])
+        except Exception as e:
+            logger.error(f"Ошибка проверки статуса админа: {e}")
+            return False
+
+    async def add_log(self, user_id: int, action: str, message_text: str = None,
+                command: str = None, source: str = None):
+        """
+        Добавить лог взаимодействия с ботом
+
+        Запись только ставится в очередь - INSERT выполняет фоновая задача
+        пачками, поэтому обработчик не ждет коммита. При переполнении
+        очереди новые записи отбрасываются (счетчик dropped_logs).
+        """
+        try:
+            self._log_queue.put_nowait((user_id, action, message_text, command, source, datetime.now()))
+        except asyncio.QueueFull:
+            self.dropped_logs += 1
+            if self.dropped_logs % 1000 == 1:
+                logger.warning(f"Очередь логов переполнена, отброшено записей: {self.dropped_logs}")
+
+    async def _log_writer(self):
+        """
+        Фоновая запись логов: пачка сбрасывается по размеру или по интервалу
+
+        Останавливается маркером LOG_QUEUE_STOP из close(), а не отменой:
+        отмена посреди _flush_logs после коммита оставила бы пачку
+        в _pending_logs, и flush_logs() записал бы ее второй раз.
+        """
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            row = await self._log_queue.get()
+            if row is LOG_QUEUE_STOP:
+                break
+            self._pending_logs.append(row)
+            deadline = loop.time() + USER_LOG_FLUSH_INTERVAL_SECONDS
+            while len(self._pending_logs) < USER_LOG_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    row = await asyncio.wait_for(self._log_queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if row is LOG_QUEUE_STOP:
+                    stopping = True
+                    break
+                self._pending_logs.append(row)
+            await self._flush_logs()
+
+    async def _flush_logs(self):
+        """Записать накопленные логи одним INSERT (при недоступной базе - в журнал)"""
+        batch = self._pending_logs[:USER_LOG_BATCH_SIZE]
+        if not batch:
+            return
+        try:
+            await self._spooled_write('user_logs', None, [list(row) for row in batch])
+        except Exception as e:
+            logger.error(f"Ошибка записи пачки логов ({len(batch)} записей): {e}")
+        # Пачка снимается только после попытки записи
+        del self._pending_logs[:len(batch)]
+
+    async def _write_logs(self, conn, source: Optional[str], rows: List[list]):
+        """Записать пачку логов и увеличить счетчики профилей одним запросом"""
+        user_ids, actions, texts, commands, sources, created = (list(column) for column in zip(*rows))
+        async with conn.cursor() as cur:
+            # Логи пользователей, которых нет в users, нарушили бы внешний ключ всей пачки.
+            # Счетчики профиля увеличиваются тем же запросом
+            await cur.execute("""
+                WITH logged AS (
+                    INSERT INTO user_logs (user_id, action, message_text, command, source, created_at)
+                    SELECT t.user_id, t.action, t.message_text, t.command, t.source, t.created_at
+                    FROM unnest(
+                        %s::bigint[], %s::varchar[], %s::text[], %s::varchar[], %s::varchar[], %s::timestamp[]
+                    ) AS t(user_id, action, message_text, command, source, created_at)
+                    WHERE t.user_id IS NULL OR EXISTS (SELECT 1 FROM users u WHERE u.user_id = t.user_id)
+                    RETURNING user_id, command
+                )
+                UPDATE users u
+                SET actions_count = u.actions_count + c.actions_count,
+                    button_clicks = u.button_clicks + c.button_clicks
+                FROM (
+                    SELECT user_id,
+                           COUNT(*) AS actions_count,
+                           COUNT(*) FILTER (WHERE command = 'button') AS button_clicks
+                    FROM logged
+                    WHERE user_id IS NOT NULL
+                    GROUP BY user_id
+                ) c
+                WHERE u.user_id = c.user_id
+            """, (user_ids, actions, texts, commands, sources, created), prepare=True)
+
+    async def flush_logs(self):
+        """Записать все логи из очереди (вызывается при остановке)"""
+        while True:
+            try:
+                row = self._log_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            if row is not LOG_QUEUE_STOP:
+                self._pending_logs.append(row)
+        while self._pending_logs:
+            await self._flush_logs()
+    
+    async def execute_sql(self, query: str, limit: int = None) -> tuple:
+        """
+        Выполнить админский SQL запрос (только SELECT)
+
+        Запрос выполняется не на соединениях пула, а на отдельном read-only
+        соединении со statement_timeout. Строки читаются именованным
+        (серверным) курсором порциями по ADMIN_SQL_FETCH_SIZE, не больше
+        ADMIN_SQL_MAX_ROWS - остальное в память не попадает.
+
+        Возвращает (результаты, ошибка)
+        """
+        query_upper = query.strip().upper()
+        if not query_upper.startswith(('SELECT', 'WITH')):
+            return None, "Разрешены только SELECT запросы"
+        max_rows = min(limit or ADMIN_SQL_MAX_ROWS, ADMIN_SQL_MAX_ROWS)
+        
+        try:
+            async with self._admin_sql_guard:
+                if self._admin_conn is None or self._admin_conn.closed:
+                    self._admin_conn = await psycopg.AsyncConnection.connect(
+                        options=(
+                            "-c default_transaction_read_only=on "
+                            f"-c statement_timeout={ADMIN_SQL_STATEMENT_TIMEOUT_SECONDS * 1000}"
+                        ),
+                        **self._conn_kwargs
+                    )
+                
+                try:
+                    async with self._admin_conn.transaction(force_rollback=True):
+                        async with self._admin_conn.cursor(name='admin_sql') as cur:
+                            await cur.execute(query.strip().rstrip(';'))
+                            columns = [desc.name for desc in cur.description]
+                            rows = []
+                            while len(rows) < max_rows:
+                                page = await cur.fetchmany(min(ADMIN_SQL_FETCH_SIZE, max_rows - len(rows)))
+                                if not page:
+                                    break
+                                rows.extend(page)
+                            return (columns, rows), None
+                except psycopg.OperationalError:
+                    await self._admin_conn.close()
+                    raise
+        except Exception as e:
+            return None, str(e)
+    
+    async def get_analytics(self) -> dict:
+        """
+        Получить аналитику проекта
+
+        Читает одну строку материализованного представления analytics_summary,
+        которое пересчитывает планировщик (refresh_analytics), поэтому время
+        ответа не зависит от размера таблиц.
+        """
+        try:
+            async with self.cursor(dict_row) as cur:
+                await cur.execute("SELECT * FROM analytics_summary")
+                row = await cur.fetchone()
+                if not row:
+                    return {}
+                
+                top_users = "\n".join([
+                    f"• {item['nickname'] or item['username'] or 'ID:' + str(item['user_id'])}: {item['actions_count']} действий"
+                    for item in row['top_users']
+                ]) if row['top_users'] else "Нет данных"
+                
+                top_models = "\n".join([
+                    f"• {item['model']}: {item['count']} объявлений"
+                    for item in row['top_models']
+                ]) if row['top_models'] else "Нет данных"
+                
+                return {
+                    'total_users': row['total_users'],
+                    'active_users': row['active_users'],
+                    'avito_users': row['avito_users'],
+                    'kufar_users': row['kufar_users'],
+                    'total_ads': row['total_ads'],
+                    'avito_ads': row['avito_ads'],
+                    'kufar_ads': row['kufar_ads'],
+                    'sent_ads': row['sent_ads'],
+                    'top_users': top_users,
+                    'top_models': top_models,
+                    'refreshed_at': row['refreshed_at'],
+                }
+        except Exception as e:
+            logger.error(f"Ошибка получения аналитики: {e}")
+            return {}
+
+    async def refresh_analytics(self):
+        """Пересчитать сводку аналитики (не блокирует чтение текущей сводки)"""
+        async with self.cursor() as cur:
+            await cur.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY analytics_summary")
+    
+    async def get_user_profile(self, user_id: int) -> Optional[Dict]:
+        """
+        Получить профиль пользователя со статистикой
+
+        Счетчики (sent_ads_count, actions_count, button_clicks) хранятся в users
+        и увеличиваются при записи deliveries и user_logs - профиль читается
+        одним запросом по первичному ключу.
+        """
+        try:
+            async with self.cursor(dict_row) as cur:
+                await cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+                user = await cur.fetchone()
+                return dict(user) if user else None
+        except Exception as e:
+            logger.error(f"Ошибка получения профиля: {e}")
+            return None
+    
+    async def add_parsing_log(self, source: str, city: str = None, model: str = None,
+                       pages_parsed: int = 0, ads_found: int = 0, ads_processed: int = 0,
+                       ads_sent: int = 0, errors_count: int = 0, duration_seconds: float = 0,
+                       status: str = 'completed', error_message: str = None):
+        """Добавить лог парсинга (при недоступной базе - в журнал)"""
+        try:
+            await self._spooled_write('parsing_logs', source, [[
+                city, model, pages_parsed, ads_found, ads_processed, ads_sent,
+                errors_count, duration_seconds, status, error_message, datetime.now()
+            ]])
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка добавления лога парсинга: {e}")
+            return False
+
+    async def _write_parsing_logs(self, conn, source: str, rows: List[list]):
+        """Записать логи парсинга (см. add_parsing_log)"""
+        async with conn.cursor() as cur:
+            await cur.executemany("""
+                INSERT INTO parsing_logs 
+                (source, city, model, pages_parsed, ads_found, ads_processed, ads_sent, 
+                 errors_count, duration_seconds, status, error_message, created_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """, [[source, *row] for row in rows])
+    
+    async def get_parsing_stats(self, source: str = None, limit: int = 10) -> List[Dict]:
+        """Получить статистику парсинга"""
+        try:
+            async with self.cursor(dict_row) as cur:
+                if source:
+                    await cur.execute("""
+                        SELECT * FROM parsing_logs 
+                        WHERE source = %s 
+                        ORDER BY created_at DESC 
+                        LIMIT %s
+                    """, (source, limit))
+                else:
+                    await cur.execute("""
+                        SELECT * FROM parsing_logs 
+                        ORDER BY created_at DESC 
+                        LIMIT %s
+                    """, (limit,))
+                return [dict(row) for row in await cur.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения статистики парсинга: {e}")
+            return []
+
+    async def add_scheduler_run(self, job_name: str, started_at: datetime, duration_seconds: float,
+                          status: str, error_message: str = None):
+        """Записать результат запуска задачи планировщика"""
+        try:
+            async with self.cursor() as cur:
+                await cur.execute("""
+                    INSERT INTO scheduler_runs (job_name, started_at, duration_seconds, status, error_message)
+                    VALUES (%s, %s, %s, %s, %s)
+                """, (job_name, started_at, duration_seconds, status, error_message))
+                return True
+        except Exception as e:
+            logger.error(f"Ошибка записи запуска задачи {job_name}: {e}")
+            return False
+
+    async def get_last_scheduler_runs(self, status: str = 'completed', job_name: str = None) -> Dict[str, datetime]:
+        """Получить время последнего запуска каждой задачи (или одной задачи) с указанным статусом"""
+        try:
+            async with self.cursor() as cur:
+                if job_name:
+                    await cur.execute("""
+                        SELECT job_name, MAX(started_at)
+                        FROM scheduler_runs
+                        WHERE status = %s AND job_name = %s
+                        GROUP BY job_name
+                    """, (status, job_name))
+                else:
+                    await cur.execute("""
+                        SELECT job_name, MAX(started_at)
+                        FROM scheduler_runs
+                        WHERE status = %s
+                        GROUP BY job_name
+                    """, (status,))
+                return {row[0]: row[1] for row in await cur.fetchall()}
+        except Exception as e:
+            logger.error(f"Ошибка получения истории планировщика: {e}")
+            return {}
+
+    @staticmethod
+    def _advisory_key(name: str) -> int:
+        """Стабильный 64-битный ключ advisory lock для строкового имени"""
+        return int.from_bytes(hashlib.sha1(name.encode('utf-8')).digest()[:8], 'big', signed=True)
+
+    async def try_advisory_lock(self, name: str) -> bool:
+        """
+        Попытаться взять сессионную advisory-блокировку Postgres без ожидания
+
+        Блокировка общая для всех экземпляров приложения, подключенных к БД,
+        поэтому задачу с этим именем выполняет только один из них.
+        """
+        try:
+            async with self._lock_cursor() as cur:
+                await cur.execute("SELECT pg_try_advisory_lock(%s)", (self._advisory_key(name),))
+                acquired = (await cur.fetchone())[0]
+                return acquired
+        except Exception as e:
+            logger.error(f"Ошибка получения блокировки {name}: {e}")
+            return False
+
+    async def advisory_unlock(self, name: str):
+        """Освободить advisory-блокировку, взятую через try_advisory_lock"""
+        try:
+            async with self._lock_cursor() as cur:
+                await cur.execute("SELECT pg_advisory_unlock(%s)", (self._advisory_key(name),))
+        except Exception as e:
+            logger.error(f"Ошибка освобождения блокировки {name}: {e}")
+
+    async def claim_scrape_unit(self, source: str, city: str, min_interval_seconds: int) -> bool:
+        """
+        Отметить начало парсинга единицы (источник, город)
+
+        Возвращает False, если другой экземпляр уже парсил эту единицу
+        за последние min_interval_seconds (в текущем цикле).
+        """
+        try:
+            async with self.cursor() as cur:
+                await cur.execute("""
+                    INSERT INTO scrape_units (source, city, last_started_at)
+                    VALUES (%s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (source, city) DO UPDATE SET
+                        last_started_at = CURRENT_TIMESTAMP
+                    WHERE scrape_units.last_started_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+                    RETURNING 1
+                """, (source, city or '', min_interval_seconds))
+                claimed = (await cur.fetchone()) is not None
+                return claimed
+        except Exception as e:
+            logger.error(f"Ошибка отметки единицы парсинга {source}/{city}: {e}")
+            return False
+
+    async def update_user_settings(self, user_id: int, city: str = None, 
+                            model: str = None, max_price: int = None, 
+                            is_active: bool = None, source: str = None):
+        """Обновить настройки пользователя"""
+        try:
+            updates = []
+            params = []
+            
+            if city is not None:
+                updates.append("city = %s")
+                params.append(city)
+            if model is not None:
+                updates.append("model = %s")
+                params.append(model)
+            if max_price is not None:
+                updates.append("max_price = %s")
+                params.append(max_price)
+            if is_active is not None:
+                updates.append("is_active = %s")
+                params.append(is_active)
+            if source is not None:
+                updates.append("source = %s")
+                params.append(source)
+            
+            if updates:
+                updates.append("updated_at = CURRENT_TIMESTAMP")
+                params.append(user_id)
+                
+                async with self.cursor(dict_row) as cur:
+                    await cur.execute(f"""
+                        UPDATE users 
+                        SET {', '.join(updates)}
+                        WHERE user_id = %s
+                        RETURNING *
+                    """, params)
+                    row = await cur.fetchone()
+                if row:
+                    self._cache_user(user_id, row)
+                logger.info(f"Настройки пользователя {user_id} обновлены")
+        except Exception as e:
+            logger.error(f"Ошибка обновления настроек: {e}")
+            raise
+
+    async def get_user_settings(self, user_id: int) -> Optional[Dict]:
+        """
+        Получить настройки пользователя (из кэша пользователей)
+
+        Счетчики в кэшированной строке не обновляются - актуальные
+        значения возвращает get_user_profile.
+        """
+        try:
+            user = await self._cached_user(user_id)
+            return dict(user) if user else None
+        except Exception as e:
+            logger.error(f"Ошибка получения настроек пользователя: {e}")
+            return None
+
+    async def get_active_users(self, source: str = None) -> List[Dict]:
+        """Получить список активных пользователей"""
+        try:
+            if self._users_loaded:
+                return [
+                    dict(user) for user in self._users.values()
+                    if user['is_active'] and (not source or user['source'] == source)
+                ]
+            async with self.cursor(dict_row) as cur:
+                if source:
+                    await cur.execute("""
+                        SELECT * FROM users WHERE is_active = TRUE AND source = %s
+                    """, (source,))
+                else:
+                    await cur.execute("""
+                        SELECT * FROM users WHERE is_active = TRUE
+                    """)
+                return [dict(row) for row in await cur.fetchall()]
+        except Exception as e:
+            logger.error(f"Ошибка получения активных пользователей: {e}")
+            return []
+
+    async def add_advertisements_bulk(self, ads: List[Dict], source: str) -> Optional[Dict[str, Dict]]:
+        """
+        Сохранить страницу объявлений одним запросом
+
+        Объявления передаются массивами и разворачиваются через unnest, поэтому
+        число запросов не зависит от размера страницы. Для объявлений
+        с изменившейся ценой дописывает строку в ad_price_history.
+        Строка объявления переписывается только при изменении цены или памяти,
+        число записанных и пропущенных строк копится в ads_touched/ads_untouched.
+        Если база недоступна, страница откладывается в журнал (см. _spooled_write).
+
+        Args:
+            ads: Список {'ad_id', 'price', 'model', 'city', 'memory', 'url'}
+            source: Источник ('avito' или 'kufar')
+
+        Returns:
+            {ad_id: {'inserted', 'previous_price', 'created_at', 'touched'}} или None
+            при ошибке и если запись отложена в журнал
+        """
+        if not ads:
+            return {}
+
+        try:
+            return await self._spooled_write('ads', source, ads)
+        except Exception as e:
+            logger.error(f"Ошибка пакетного сохранения объявлений ({source}): {e}")
+            return None
+
+    async def _write_ads(self, conn, source: str, ads: List[Dict]) -> Dict[str, Dict]:
+        """Пакетный upsert объявлений (см. add_advertisements_bulk)"""
+        columns = {name: [] for name in ('ad_id', 'price', 'price_rub', 'price_byn', 'model', 'city', 'memory', 'url')}
+        for ad in ads:
+            price_rub, price_byn = self._convert_prices(ad['price'], source)
+            columns['ad_id'].append(str(ad['ad_id']))
+            columns['price'].append(ad['price'])
+            columns['price_rub'].append(price_rub)
+            columns['price_byn'].append(price_byn)
+            for name in ('model', 'city', 'memory', 'url'):
+                columns[name].append(ad.get(name))
+
+        async with conn.cursor(row_factory=dict_row) as cur:
+            # Повтор ID на странице оставляет последнее вхождение: ON CONFLICT
+            # не может обновить одну строку дважды в одном запросе
+            await cur.execute("""
+                WITH page AS (
+                    SELECT DISTINCT ON (ad_id) *
+                    FROM unnest(
+                        %(ad_id)s::varchar[], %(price)s::integer[], %(price_rub)s::numeric[],
+                        %(price_byn)s::numeric[], %(model)s::varchar[], %(city)s::varchar[],
+                        %(memory)s::varchar[], %(url)s::text[]
+                    ) WITH ORDINALITY AS t(ad_id, price, price_rub, price_byn, model, city, memory, url, ord)
+                    ORDER BY ad_id, ord DESC
+                ),
+                -- Реестр ключей задает created_at, а значит и секцию строки
+                known AS (
+                    SELECT k.external_id AS ad_id, k.created_at
+                    FROM advertisement_keys k
+                    JOIN page ON k.source = %(source)s AND k.external_id = page.ad_id
+                ),
+                new_keys AS (
+                    INSERT INTO advertisement_keys (source, external_id)
+                    SELECT %(source)s, ad_id FROM page
+                    WHERE ad_id NOT IN (SELECT ad_id FROM known)
+                    ON CONFLICT (source, external_id) DO NOTHING
+                    RETURNING external_id AS ad_id, created_at
+                ),
+                keys AS (
+                    SELECT * FROM known
+                    UNION ALL
+                    SELECT * FROM new_keys
+                ),
+                prev AS (
+                    SELECT a.external_id AS ad_id, a.price
+                    FROM advertisements a
+                    JOIN known ON a.source = %(source)s AND a.external_id = known.ad_id
+                              AND a.created_at = known.created_at
+                ),
+                upsert AS (
+                    INSERT INTO advertisements
+                    (source, external_id, created_at, price, price_rub, price_byn, model, city, memory, url)
+                    SELECT %(source)s, page.ad_id, keys.created_at, price, price_rub, price_byn, model, city, memory, url
+                    FROM page
+                    JOIN keys ON keys.ad_id = page.ad_id
+                    ON CONFLICT (source, external_id, created_at) DO UPDATE SET
+                        price = EXCLUDED.price,
+                        price_rub = EXCLUDED.price_rub,
+                        price_byn = EXCLUDED.price_byn,
+                        memory = EXCLUDED.memory,
+                        updated_at = CURRENT_TIMESTAMP
+                    -- Неизменившееся объявление не переписывается: ни мертвой версии строки, ни WAL
+                    WHERE (advertisements.price, advertisements.memory)
+                          IS DISTINCT FROM (EXCLUDED.price, EXCLUDED.memory)
+                    RETURNING external_id AS ad_id
+                ),
+                history AS (
+                    INSERT INTO ad_price_history (source, external_id, price, previous_price)
+                    SELECT %(source)s, page.ad_id, page.price, prev.price
+                    FROM page
+                    LEFT JOIN prev ON prev.ad_id = page.ad_id
+                    WHERE prev.price IS DISTINCT FROM page.price
+                )
+                SELECT keys.ad_id, prev.price AS previous_price,
+                       prev.ad_id IS NULL AS inserted, keys.created_at,
+                       upsert.ad_id IS NOT NULL AS touched
+                FROM keys
+                LEFT JOIN prev ON prev.ad_id = keys.ad_id
+                LEFT JOIN upsert ON upsert.ad_id = keys.ad_id
+            """, {'source': source, **columns}, prepare=True)
+            stored = {row.pop('ad_id'): row for row in await cur.fetchall()}
+
+        touched = sum(1 for row in stored.values() if row['touched'])
+        self.ads_touched += touched
+        self.ads_untouched += len(stored) - touched
+        logger.debug(f"Объявления {source}: записано {touched}, без изменений {len(stored) - touched}")
+        return stored
+
+    @staticmethod
+    def _convert_prices(price: int, source: str) -> tuple:
+        """Цена объявления в рублях и белорусских рублях: (price_rub, price_byn)"""
+        from utils.currency_converter import convert_byn_to_rub, convert_rub_to_byn
+
+        if source == 'avito':
+            return float(price), convert_rub_to_byn(price)
+        # kufar
+        return convert_byn_to_rub(price), float(price)
+
+    async def get_deliveries(self, source: str, external_ids: List[str],
+                             user_ids: List[int] = None) -> Dict[str, Dict[int, Optional[int]]]:
+        """
+        Узнать, каким пользователям и по какой цене уже отправлены объявления
+
+        Один запрос на весь набор объявлений (и пользователей, если указаны).
+
+        Returns:
+            {external_id: {user_id: цена при отправке}} - только для отправленных
+            объявлений; цена None у отправок, записанных до появления sent_price
+        """
+        if not external_ids:
+            return {}
+        try:
+            async with self.cursor() as cur:
+                await cur.execute("""
+                    SELECT external_id, user_id, sent_price FROM deliveries
+                    WHERE source = %s AND external_id = ANY(%s)
+                    AND (%s::bigint[] IS NULL OR user_id = ANY(%s::bigint[]))
+                """, (source, list(external_ids), user_ids, user_ids), prepare=True)
+                delivered = {}
+                for external_id, user_id, sent_price in await cur.fetchall():
+                    delivered.setdefault(external_id, {})[user_id] = sent_price
+                return delivered
+        except Exception as e:
+            logger.error(f"Ошибка проверки отправленных объявлений: {e}")
+            return {}
+
+    async def add_deliveries(self, source: str, deliveries: List[tuple]) -> int:
+        """
+        Записать отправки объявлений пользователям
+
+        Повторная отправка (например, после снижения цены) обновляет sent_at
+        и sent_price. Счетчик users.sent_ads_count увеличивается только за
+        новые пары (пользователь, объявление) - в том же запросе.
+
+        Args:
+            deliveries: Список (user_id, external_id, цена при отправке)
+
+        Returns:
+            Количество новых отправок
+        """
+        if not deliveries:
+            return 0
+        try:
+            return await self._spooled_write('deliveries', source, [list(row) for row in deliveries]) or 0
+        except Exception as e:
+            logger.error(f"Ошибка записи отправок объявлений: {e}")
+            return 0
+
+    async def _write_deliveries(self, conn, source: str, deliveries: List[list]) -> int:
+        """Записать отправки одним запросом (см. add_deliveries)"""
+        user_ids, external_ids, prices = (list(column) for column in zip(*deliveries))
+        async with conn.cursor() as cur:
+            # DISTINCT ON: при повторе журнала одна пара может встретиться дважды -
+            # остается последняя отправка
+            await cur.execute("""
+                WITH sent AS (
+                    INSERT INTO deliveries (user_id, source, external_id, sent_price)
+                    SELECT DISTINCT ON (user_id, external_id) user_id, %s, external_id, sent_price
+                    FROM unnest(%s::bigint[], %s::varchar[], %s::integer[])
+                         WITH ORDINALITY AS t(user_id, external_id, sent_price, ord)
+                    ORDER BY user_id, external_id, ord DESC
+                    ON CONFLICT (user_id, source, external_id) DO UPDATE SET
+                        sent_at = CURRENT_TIMESTAMP,
+                        sent_price = EXCLUDED.sent_price
+                    RETURNING user_id, (xmax = 0) AS inserted
+                ),
+                counters AS (
+                    UPDATE users u SET sent_ads_count = u.sent_ads_count + c.new_count
+                    FROM (
+                        SELECT user_id, COUNT(*) AS new_count FROM sent
+                        WHERE inserted GROUP BY user_id
+                    ) c
+                    WHERE u.user_id = c.user_id
+                )
+                SELECT COUNT(*) FILTER (WHERE inserted) FROM sent
+            """, (source, user_ids, external_ids, prices), prepare=True)
+            return (await cur.fetchone())[0]
+    
+    async def close(self):
+        """Сбросить очередь логов и закрыть все соединения с базой данных"""
+        if self._spool_replayer_task:
+            self._spool_replayer_task.cancel()
+            try:
+                await self._spool_replayer_task
+            except asyncio.CancelledError:
+                pass
+            self._spool_replayer_task = None
+        if self._users_listener_task:
+            self._users_listener_task.cancel()
+            try:
+                await self._users_listener_task
+            except asyncio.CancelledError:
+                pass
+            self._users_listener_task = None
+            self._users_loaded = False
+        if self._log_writer_task:
+            if not self._log_writer_task.done():
+                # Текущая пачка дописывается до конца, затем задача выходит сама
+                await self._log_queue.put(LOG_QUEUE_STOP)
+                await self._log_writer_task
+            self._log_writer_task = None
+        await self.flush_logs()
+        for conn in (self._lock_conn, self._admin_conn):
+            if conn and not conn.closed:
+                await conn.close()
+        await self.pool.close()
+        logger.info("Асинхронный пул соединений закрыт")
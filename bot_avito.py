@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from utils.logger import get_logger
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -5,7 +6,7 @@ from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, filters
 )
-from database import Database
+from async_database import AsyncDatabase
 from config.app_settings import ADMIN_USER_ID
 from config.cities import AVITO_CITIES
 from config.models import IPHONE_MODELS
@@ -15,9 +16,10 @@ logger = get_logger('avito_bot')
 
 
 class AvitoTelegramBot:
-    def __init__(self, token: str, db: Database):
+    def __init__(self, token: str, db: AsyncDatabase, median_calculator=None):
         self.token = token
         self.db = db
+        self.median_calculator = median_calculator  # для /refresh (работает с синхронным пулом)
         self.application = None
         self.user_states = {}  # Состояния пользователей (waiting_nickname, waiting_price, sql_mode)
         self.source = 'avito'
@@ -28,9 +30,9 @@ class AvitoTelegramBot:
         user_id = user.id
         
         # Проверяем является ли пользователь админом (из БД или по ID)
-        is_admin = self.db.is_admin(user_id) or (user_id == ADMIN_USER_ID)
+        is_admin = await self.db.is_admin(user_id) or (user_id == ADMIN_USER_ID)
         
-        self.db.add_user(
+        await self.db.add_user(
             user_id=user_id,
             username=user.username,
             first_name=user.first_name,
@@ -39,11 +41,11 @@ class AvitoTelegramBot:
             is_admin=is_admin
         )
         
-        self.db.update_user_settings(user_id, source='avito')
-        self.db.add_log(user_id, 'start', update.message.text, command='/start', source='avito')
+        await self.db.update_user_settings(user_id, source='avito')
+        await self.db.add_log(user_id, 'start', update.message.text, command='/start', source='avito')
         
         # Проверяем есть ли никнейм
-        settings = self.db.get_user_settings(user_id)
+        settings = await self.db.get_user_settings(user_id)
         if not settings.get('nickname'):
             # Запрашиваем никнейм
             self.user_states[user_id] = 'waiting_nickname'
@@ -83,7 +85,7 @@ class AvitoTelegramBot:
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /help"""
         user_id = update.effective_user.id
-        is_admin = self.db.is_admin(user_id)
+        is_admin = await self.db.is_admin(user_id)
         
         help_text = """
 📖 Справка по командам:
@@ -119,7 +121,7 @@ class AvitoTelegramBot:
         help_text += "\n/help - Показать эту справку"
         
         await update.message.reply_text(help_text)
-        self.db.add_log(user_id, 'help', None, command='/help', source='avito')
+        await self.db.add_log(user_id, 'help', None, command='/help', source='avito')
 
     async def city_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /city"""
@@ -145,7 +147,7 @@ class AvitoTelegramBot:
             "🏙 Выбери город для парсинга:",
             reply_markup=reply_markup
         )
-        self.db.add_log(update.effective_user.id, 'city_selection', None, command='/city', source='avito')
+        await self.db.add_log(update.effective_user.id, 'city_selection', None, command='/city', source='avito')
 
     async def model_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /model"""
@@ -176,7 +178,7 @@ class AvitoTelegramBot:
             "📱 Выбери модель iPhone:",
             reply_markup=reply_markup
         )
-        self.db.add_log(update.effective_user.id, 'model_selection', None, command='/model', source='avito')
+        await self.db.add_log(update.effective_user.id, 'model_selection', None, command='/model', source='avito')
 
     async def price_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /price"""
@@ -185,12 +187,12 @@ class AvitoTelegramBot:
             "Или отправь 0 чтобы убрать ограничение:"
         )
         self.user_states[update.effective_user.id] = 'waiting_price'
-        self.db.add_log(update.effective_user.id, 'price_setting', None, command='/price', source='avito')
+        await self.db.add_log(update.effective_user.id, 'price_setting', None, command='/price', source='avito')
 
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /status"""
         user_id = update.effective_user.id
-        settings = self.db.get_user_settings(user_id)
+        settings = await self.db.get_user_settings(user_id)
         
         if not settings:
             await update.message.reply_text("❌ Настройки не найдены. Используй /start")
@@ -205,21 +207,21 @@ class AvitoTelegramBot:
 🔄 Статус: {'🟢 Активен' if settings.get('is_active') else '🔴 На паузе'}
 """
         await update.message.reply_text(status_text)
-        self.db.add_log(user_id, 'status_check', None, command='/status', source='avito')
+        await self.db.add_log(user_id, 'status_check', None, command='/status', source='avito')
 
     async def pause_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /pause"""
         user_id = update.effective_user.id
-        self.db.update_user_settings(user_id, is_active=False)
+        await self.db.update_user_settings(user_id, is_active=False)
         await update.message.reply_text("⏸ Парсинг поставлен на паузу")
-        self.db.add_log(user_id, 'pause', None, command='/pause', source='avito')
+        await self.db.add_log(user_id, 'pause', None, command='/pause', source='avito')
 
     async def resume_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /resume"""
         user_id = update.effective_user.id
-        self.db.update_user_settings(user_id, is_active=True)
+        await self.db.update_user_settings(user_id, is_active=True)
         await update.message.reply_text("▶️ Парсинг возобновлен")
-        self.db.add_log(user_id, 'resume', None, command='/resume', source='avito')
+        await self.db.add_log(user_id, 'resume', None, command='/resume', source='avito')
 
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий на кнопки"""
@@ -232,40 +234,40 @@ class AvitoTelegramBot:
         if data.startswith('city_'):
             city_code = data.replace('city_', '')
             city_name = [name for name, code in AVITO_CITIES.items() if code == city_code][0]
-            self.db.update_user_settings(user_id, city=city_name)
+            await self.db.update_user_settings(user_id, city=city_name)
             await query.edit_message_text(f"✅ Город выбран: {city_name}")
-            self.db.add_log(user_id, f'city_selected_{city_name}', None, command='button', source='avito')
+            await self.db.add_log(user_id, f'city_selected_{city_name}', None, command='button', source='avito')
         
         elif data.startswith('model_'):
             model = data.replace('model_', '')
             if model == 'all':
                 model = None
-                self.db.update_user_settings(user_id, model=None)
+                await self.db.update_user_settings(user_id, model=None)
                 await query.edit_message_text("✅ Выбраны все модели")
             else:
-                self.db.update_user_settings(user_id, model=model)
+                await self.db.update_user_settings(user_id, model=model)
                 await query.edit_message_text(f"✅ Модель выбрана: {model}")
-            self.db.add_log(user_id, f'model_selected_{model}', None, command='button', source='avito')
+            await self.db.add_log(user_id, f'model_selected_{model}', None, command='button', source='avito')
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений"""
         user_id = update.effective_user.id
         text = update.message.text
         
-        self.db.add_log(user_id, 'message', text, command=None, source='avito')
+        await self.db.add_log(user_id, 'message', text, command=None, source='avito')
         
         # Обработка никнейма
         if user_id in self.user_states and self.user_states[user_id] == 'waiting_nickname':
             if text and len(text.strip()) > 0:
                 nickname = text.strip()[:50]  # Ограничиваем длину
-                self.db.update_user_nickname(user_id, nickname)
+                await self.db.update_user_nickname(user_id, nickname)
                 del self.user_states[user_id]
                 await update.message.reply_text(
                     f"✅ Никнейм сохранен: {nickname}\n\n"
                     "Теперь можешь использовать команды бота. /help - для справки"
                 )
                 # Показываем приветствие с настройками
-                settings = self.db.get_user_settings(user_id)
+                settings = await self.db.get_user_settings(user_id)
                 welcome_text = f"""
 👋 Привет, {update.effective_user.first_name}!
 
@@ -287,7 +289,7 @@ class AvitoTelegramBot:
 /resume - Возобновить парсинг
 /help - Помощь
 """
-                if self.db.is_admin(user_id):
+                if await self.db.is_admin(user_id):
                     welcome_text += "\n🔧 Админ команды:\n/refresh - Обновить цены\n/parser_status - Статус парсера\n/analytics - Аналитика\n/sql - SQL запросы"
                 await update.message.reply_text(welcome_text)
             else:
@@ -296,16 +298,16 @@ class AvitoTelegramBot:
         
         # Обработка SQL режима
         if user_id in self.user_states and self.user_states[user_id] == 'sql_mode':
-            if not self.db.is_admin(user_id):
+            if not await self.db.is_admin(user_id):
                 await update.message.reply_text("❌ У вас нет доступа к SQL режиму")
                 del self.user_states[user_id]
                 return
             
             query = text.strip()
-            self.db.add_log(user_id, 'sql_execute', query, command='sql_mode', source='avito')
+            await self.db.add_log(user_id, 'sql_execute', query, command='sql_mode', source='avito')
             
             try:
-                result, error = self.db.execute_sql(query)
+                result, error = await self.db.execute_sql(query)
                 
                 if error:
                     await update.message.reply_text(f"❌ Ошибка: {error}")
@@ -359,10 +361,10 @@ class AvitoTelegramBot:
                     return
                 
                 if price == 0:
-                    self.db.update_user_settings(user_id, max_price=None)
+                    await self.db.update_user_settings(user_id, max_price=None)
                     await update.message.reply_text("✅ Ограничение по цене снято")
                 else:
-                    self.db.update_user_settings(user_id, max_price=price)
+                    await self.db.update_user_settings(user_id, max_price=price)
                     await update.message.reply_text(f"✅ Максимальная цена установлена: {price} руб.")
                 
                 del self.user_states[user_id]
@@ -377,9 +379,9 @@ class AvitoTelegramBot:
         """Обработчик команды /sql (только для админа) - интерактивный режим"""
         user_id = update.effective_user.id
         
-        if not self.db.is_admin(user_id):
+        if not await self.db.is_admin(user_id):
             await update.message.reply_text("❌ У вас нет доступа к этой команде")
-            self.db.add_log(user_id, 'sql_denied', None, command='/sql', source='avito')
+            await self.db.add_log(user_id, 'sql_denied', None, command='/sql', source='avito')
             return
         
         # Включаем режим SQL
@@ -392,7 +394,7 @@ class AvitoTelegramBot:
             "SELECT COUNT(*) FROM advertisements\n"
             "SELECT * FROM user_logs ORDER BY created_at DESC LIMIT 20"
         )
-        self.db.add_log(user_id, 'sql_mode_started', None, command='/sql', source='avito')
+        await self.db.add_log(user_id, 'sql_mode_started', None, command='/sql', source='avito')
     
     async def stopsql_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /stopsql - выход из режима SQL"""
@@ -401,7 +403,7 @@ class AvitoTelegramBot:
         if user_id in self.user_states and self.user_states[user_id] == 'sql_mode':
             del self.user_states[user_id]
             await update.message.reply_text("✅ Режим SQL отключен")
-            self.db.add_log(user_id, 'sql_mode_stopped', None, command='/stopsql', source='avito')
+            await self.db.add_log(user_id, 'sql_mode_stopped', None, command='/stopsql', source='avito')
         else:
             await update.message.reply_text("ℹ️ Режим SQL не был активирован")
     
@@ -409,14 +411,14 @@ class AvitoTelegramBot:
         """Обработчик команды /analytics (только для админа)"""
         user_id = update.effective_user.id
         
-        if not self.db.is_admin(user_id):
+        if not await self.db.is_admin(user_id):
             await update.message.reply_text("❌ У вас нет доступа к этой команде")
-            self.db.add_log(user_id, 'analytics_denied', None, command='/analytics', source='avito')
+            await self.db.add_log(user_id, 'analytics_denied', None, command='/analytics', source='avito')
             return
         
         try:
             # Получаем статистику
-            stats = self.db.get_analytics()
+            stats = await self.db.get_analytics()
             
             analytics_text = f"""
 📊 Аналитика проекта
@@ -439,9 +441,12 @@ class AvitoTelegramBot:
 📈 Статистика по моделям:
 {stats.get('top_models', 'Нет данных')}
 """
+            refreshed_at = stats.get('refreshed_at')
+            if refreshed_at:
+                analytics_text += f"\n🕒 Данные на {refreshed_at.strftime('%d.%m.%Y %H:%M')}\n"
             
             await update.message.reply_text(analytics_text)
-            self.db.add_log(user_id, 'analytics_viewed', None, command='/analytics', source='avito')
+            await self.db.add_log(user_id, 'analytics_viewed', None, command='/analytics', source='avito')
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка получения аналитики: {str(e)}")
@@ -452,7 +457,7 @@ class AvitoTelegramBot:
         user_id = update.effective_user.id
         
         try:
-            profile = self.db.get_user_profile(user_id)
+            profile = await self.db.get_user_profile(user_id)
             
             if not profile:
                 await update.message.reply_text("❌ Профиль не найден. Используйте /start")
@@ -483,7 +488,7 @@ class AvitoTelegramBot:
 """
             
             await update.message.reply_text(profile_text)
-            self.db.add_log(user_id, 'profile_viewed', None, command='/profile', source='avito')
+            await self.db.add_log(user_id, 'profile_viewed', None, command='/profile', source='avito')
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка получения профиля: {str(e)}")
@@ -493,48 +498,69 @@ class AvitoTelegramBot:
         """Обработчик команды /refresh - пересчет медианных цен (только для админа)"""
         user_id = update.effective_user.id
         
-        if not self.db.is_admin(user_id):
+        if not await self.db.is_admin(user_id):
             await update.message.reply_text("❌ У вас нет доступа к этой команде")
-            self.db.add_log(user_id, 'refresh_denied', None, command='/refresh', source='avito')
+            await self.db.add_log(user_id, 'refresh_denied', None, command='/refresh', source='avito')
             return
         
         try:
-            await update.message.reply_text("🔄 Начинаю пересчет медианных цен...")
-            self.db.add_log(user_id, 'refresh_started', None, command='/refresh', source='avito')
+            progress_message = await update.message.reply_text("🔄 Начинаю пересчет медианных цен...")
+            await self.db.add_log(user_id, 'refresh_started', None, command='/refresh', source='avito')
             
-            # Импортируем MedianPriceCalculator
-            from utils.median_calculator import MedianPriceCalculator
-            calculator = MedianPriceCalculator(self.db)
+            calculator = self.median_calculator
+            if calculator is None:
+                await progress_message.edit_text("❌ Калькулятор медианных цен не подключен")
+                return
+            
+            async def edit_progress(text: str):
+                try:
+                    await progress_message.edit_text(text)
+                except Exception as e:
+                    logger.debug(f"Не удалось обновить прогресс пересчета: {e}")
             
-            # Пересчитываем для обоих источников
-            avito_count = calculator.recalculate_all_medians('avito')
-            kufar_count = calculator.recalculate_all_medians('kufar')
+            def report_progress(source_name: str):
+                """Обновлять сообщение о прогрессе примерно каждые 10%"""
+                def callback(done: int, total: int):
+                    step = max(1, total // 10)
+                    if done == total or done % step == 0:
+                        asyncio.create_task(edit_progress(
+                            f"🔄 Пересчет медианных цен ({source_name}): {done}/{total}"
+                        ))
+                return callback
+            
+            # Пересчитываем для обоих источников в рабочем потоке калькулятора
+            avito_count = await calculator.recalculate_all_medians_async(
+                'avito', progress_callback=report_progress('Avito')
+            )
+            kufar_count = await calculator.recalculate_all_medians_async(
+                'kufar', progress_callback=report_progress('Kufar')
+            )
             
             await update.message.reply_text(
                 f"✅ Пересчет завершен!\n\n"
                 f"• Avito: обновлено {avito_count} записей\n"
                 f"• Kufar: обновлено {kufar_count} записей"
             )
-            self.db.add_log(user_id, 'refresh_completed', None, command='/refresh', source='avito')
+            await self.db.add_log(user_id, 'refresh_completed', None, command='/refresh', source='avito')
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка пересчета: {str(e)}")
             logger.error(f"Ошибка пересчета медианных цен: {e}")
-            self.db.add_log(user_id, 'refresh_error', str(e), command='/refresh', source='avito')
+            await self.db.add_log(user_id, 'refresh_error', str(e), command='/refresh', source='avito')
     
     async def parser_status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /parser_status - статус парсера (только для админа)"""
         user_id = update.effective_user.id
         
-        if not self.db.is_admin(user_id):
+        if not await self.db.is_admin(user_id):
             await update.message.reply_text("❌ У вас нет доступа к этой команде")
-            self.db.add_log(user_id, 'parser_status_denied', None, command='/parser_status', source='avito')
+            await self.db.add_log(user_id, 'parser_status_denied', None, command='/parser_status', source='avito')
             return
         
         try:
             # Получаем последние логи парсинга
-            avito_stats = self.db.get_parsing_stats('avito', limit=5)
-            kufar_stats = self.db.get_parsing_stats('kufar', limit=5)
+            avito_stats = await self.db.get_parsing_stats('avito', limit=5)
+            kufar_stats = await self.db.get_parsing_stats('kufar', limit=5)
             
             status_text = "📊 Статус парсера\n\n"
             
@@ -573,7 +599,7 @@ class AvitoTelegramBot:
                 status_text += "🟢 Kufar: нет данных\n"
             
             await update.message.reply_text(status_text)
-            self.db.add_log(user_id, 'parser_status_viewed', None, command='/parser_status', source='avito')
+            await self.db.add_log(user_id, 'parser_status_viewed', None, command='/parser_status', source='avito')
             
         except Exception as e:
             await update.message.reply_text(f"❌ Ошибка получения статуса: {str(e)}")
@@ -598,6 +624,16 @@ class AvitoTelegramBot:
                     if isinstance(created_at, datetime):
                         date_str = f"\n📅 Дата: {created_at.strftime('%d.%m.%Y %H:%M')}"
             
+            # Размер выборки, по которой посчитана медиана (без выбросов)
+            sample_size = ad_data.get('median_sample_size')
+            sample_str = f", по {sample_size} объявл." if sample_size else ""
+            
+            # Снижение цены относительно прошлого сканирования
+            previous_price = ad_data.get('previous_price')
+            drop_str = ""
+            if previous_price:
+                drop_str = f"\n📉 Цена снижена: было {previous_price:,} ₽"
+            
             # Конвертируем в BYN для удобства
             from utils.currency_converter import convert_rub_to_byn
             price_byn = convert_rub_to_byn(price)
@@ -608,8 +644,8 @@ class AvitoTelegramBot:
 🎯 Найдено выгодное предложение на Avito!
 
 📱 Модель: {ad_data['model']}
-💰 Цена: {price:,} ₽ (~{price_byn:,.0f} BYN)
-📊 Медианная цена: {median_price:,.0f} ₽ (~{median_price_byn:,.0f} BYN)
+💰 Цена: {price:,} ₽ (~{price_byn:,.0f} BYN){drop_str}
+📊 Медианная цена: {median_price:,.0f} ₽ (~{median_price_byn:,.0f} BYN){sample_str}
 💵 Экономия: {price_difference:,.0f} ₽ (~{price_difference_byn:,.0f} BYN) ({discount_percent:.1f}%)
 
 🏙 Город: {ad_data['city']}
@@ -626,7 +662,7 @@ class AvitoTelegramBot:
             else:
                 logger.error(f"Application не инициализирован, не могу отправить сообщение пользователю {user_id}")
             
-            self.db.add_log(user_id, 'advertisement_sent', ad_data['url'], command=None, source='avito')
+            await self.db.add_log(user_id, 'advertisement_sent', ad_data['url'], command=None, source='avito')
             logger.info(f"Объявление отправлено пользователю {user_id}")
             
         except Exception as e:
@@ -5,7 +5,7 @@ from telegram.ext import (
     Application, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, filters
 )
-from database import Database
+from async_database import AsyncDatabase
 from config.app_settings import ADMIN_USER_ID
 from config.cities import KUFAR_CITIES
 from config.models import IPHONE_MODELS
@@ -15,7 +15,7 @@ logger = get_logger('kufar_bot')
 
 
 class KufarTelegramBot:
-    def __init__(self, token: str, db: Database):
+    def __init__(self, token: str, db: AsyncDatabase):
         self.token = token
         self.db = db
         self.application = None
@@ -28,9 +28,9 @@ class KufarTelegramBot:
         user_id = user.id
         
         # Проверяем является ли пользователь админом (из БД или по ID)
-        is_admin = self.db.is_admin(user_id) or (user_id == ADMIN_USER_ID)
+        is_admin = await self.db.is_admin(user_id) or (user_id == ADMIN_USER_ID)
         
-        self.db.add_user(
+        await self.db.add_user(
             user_id=user_id,
             username=user.username,
             first_name=user.first_name,
@@ -39,11 +39,11 @@ class KufarTelegramBot:
             is_admin=is_admin
         )
         
-        self.db.update_user_settings(user_id, source='kufar')
-        self.db.add_log(user_id, 'start', update.message.text, command='/start', source='kufar')
+        await self.db.update_user_settings(user_id, source='kufar')
+        await self.db.add_log(user_id, 'start', update.message.text, command='/start', source='kufar')
         
         # Проверяем есть ли никнейм
-        settings = self.db.get_user_settings(user_id)
+        settings = await self.db.get_user_settings(user_id)
         if not settings.get('nickname'):
             # Запрашиваем никнейм
             self.user_states[user_id] = 'waiting_nickname'
@@ -83,7 +83,7 @@ class KufarTelegramBot:
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /help"""
         user_id = update.effective_user.id
-        is_admin = self.db.is_admin(user_id)
+        is_admin = await self.db.is_admin(user_id)
         
         help_text = """
 📖 Справка по командам:
@@ -119,7 +119,7 @@ class KufarTelegramBot:
         help_text += "\n/help - Показать эту справку"
         
         await update.message.reply_text(help_text)
-        self.db.add_log(user_id, 'help', None, command='/help', source='kufar')
+        await self.db.add_log(user_id, 'help', None, command='/help', source='kufar')
 
     async def city_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /city"""
@@ -145,7 +145,7 @@ class KufarTelegramBot:
             "🏙 Выбери город для парсинга:",
             reply_markup=reply_markup
         )
-        self.db.add_log(update.effective_user.id, 'city_selection', None, command='/city', source='kufar')
+        await self.db.add_log(update.effective_user.id, 'city_selection', None, command='/city', source='kufar')
 
     async def model_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /model"""
@@ -176,7 +176,7 @@ class KufarTelegramBot:
             "📱 Выбери модель iPhone:",
             reply_markup=reply_markup
         )
-        self.db.add_log(update.effective_user.id, 'model_selection', None, command='/model', source='kufar')
+        await self.db.add_log(update.effective_user.id, 'model_selection', None, command='/model', source='kufar')
 
     async def price_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /price"""
@@ -185,12 +185,12 @@ class KufarTelegramBot:
             "Или отправь 0 чтобы убрать ограничение:"
         )
         self.user_states[update.effective_user.id] = 'waiting_price'
-        self.db.add_log(update.effective_user.id, 'price_setting', None, command='/price', source='kufar')
+        await self.db.add_log(update.effective_user.id, 'price_setting', None, command='/price', source='kufar')
 
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /status"""
         user_id = update.effective_user.id
-        settings = self.db.get_user_settings(user_id)
+        settings = await self.db.get_user_settings(user_id)
         
         if not settings:
             await update.message.reply_text("❌ Настройки не найдены. Используй /start")
@@ -205,21 +205,21 @@ class KufarTelegramBot:
 🔄 Статус: {'🟢 Активен' if settings.get('is_active') else '🔴 На паузе'}
 """
         await update.message.reply_text(status_text)
-        self.db.add_log(user_id, 'status_check', None, command='/status', source='kufar')
+        await self.db.add_log(user_id, 'status_check', None, command='/status', source='kufar')
 
     async def pause_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /pause"""
         user_id = update.effective_user.id
-        self.db.update_user_settings(user_id, is_active=False)
+        await self.db.update_user_settings(user_id, is_active=False)
         await update.message.reply_text("⏸ Парсинг поставлен на паузу")
-        self.db.add_log(user_id, 'pause', None, command='/pause', source='kufar')
+        await self.db.add_log(user_id, 'pause', None, command='/pause', source='kufar')
 
     async def resume_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /resume"""
         user_id = update.effective_user.id
-        self.db.update_user_settings(user_id, is_active=True)
+        await self.db.update_user_settings(user_id, is_active=True)
         await update.message.reply_text("▶️ Парсинг возобновлен")
-        self.db.add_log(user_id, 'resume', None, command='/resume', source='kufar')
+        await self.db.add_log(user_id, 'resume', None, command='/resume', source='kufar')
 
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик нажатий на кнопки"""
@@ -232,40 +232,40 @@ class KufarTelegramBot:
         if data.startswith('city_'):
             city_code = data.replace('city_', '')
             city_name = [name for name, code in KUFAR_CITIES.items() if code == city_code][0]
-            self.db.update_user_settings(user_id, city=city_name)
+            await self.db.update_user_settings(user_id, city=city_name)
             await query.edit_message_text(f"✅ Город выбран: {city_name}")
-            self.db.add_log(user_id, f'city_selected_{city_name}', None, command='button', source='kufar')
+            await self.db.add_log(user_id, f'city_selected_{city_name}', None, command='button', source='kufar')
         
         elif data.startswith('model_'):
             model = data.replace('model_', '')
             if model == 'all':
                 model = None
-                self.db.update_user_settings(user_id, model=None)
+                await self.db.update_user_settings(user_id, model=None)
                 await query.edit_message_text("✅ Выбраны все модели")
             else:
-                self.db.update_user_settings(user_id, model=model)
+                await self.db.update_user_settings(user_id, model=model)
                 await query.edit_message_text(f"✅ Модель выбрана: {model}")
-            self.db.add_log(user_id, f'model_selected_{model}', None, command='button', source='kufar')
+            await self.db.add_log(user_id, f'model_selected_{model}', None, command='button', source='kufar')
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик текстовых сообщений"""
         user_id = update.effective_user.id
         text = update.message.text
         
-        self.db.add_log(user_id, 'message', text, command=None, source='kufar')
+        await self.db.add_log(user_id, 'message', text, command=None, source='kufar')
         
         # Обработка никнейма
         if user_id in self.user_states and self.user_states[user_id] == 'waiting_nickname':
             if text and len(text.strip()) > 0:
                 nickname = text.strip()[:50]  # Ограничиваем длину
-                self.db.update_user_nickname(user_id, nickname)
+                await self.db.update_user_nickname(user_id, nickname)
                 del self.user_states[user_id]
                 await update.message.reply_text(
                     f"✅ Никнейм сохранен: {nickname}\n\n"
                     "Теперь можешь использовать команды бота. /help - для справки"
                 )
                 # Показываем приветствие с настройками
-                settings = self.db.get_user_settings(user_id)
+                settings = await self.db.get_user_settings(user_id)
                 welcome_text = f"""
 👋 Привет, {update.effective_user.first_name}!
 
@@ -287,7 +287,7 @@ class KufarTelegramBot:
 /resume - Возобновить парсинг
 /help - Помощь
 """
-                if self.db.is_admin(user_id):
+                if await self.db.is_admin(user_id):
                     welcome_text += "\n🔧 Админ команды:\n/refresh - Обновить цены\n/parser_status - Статус парсера\n/analytics - Аналитика\n/sql - SQL запросы"
                 await update.message.reply_text(welcome_text)
             else:
@@ -296,16 +296,16 @@ class KufarTelegramBot:
         
         # Обработка SQL режима
         if user_id in self.user_states and self.user_states[user_id] == 'sql_mode':
-            if not self.db.is_admin(user_id):
+            if not await self.db.is_admin(user_id):
                 await update.message.reply_text("❌ У вас нет доступа к SQL режиму")
                 del self.user_states[user_id]
                 return
             
             query = text.strip()
-            self.db.add_log(user_id, 'sql_execute', query, command='sql_mode', source='kufar')
+            await self.db.add_log(user_id, 'sql_execute', query, command='sql_mode', source='kufar')
             
             try:
-                result, error = self.db.execute_sql(query)
+                result, error = await self.db.execute_sql(query)
                 
                 if error:
                     await update.message.reply_text(f"❌ Ошибка: {error}")
@@ -359,10 +359,10 @@ class KufarTelegramBot:
                     return
                 
                 if price == 0:
-                    self.db.update_user_settings(user_id, max_price=None)
+                    await self.db.update_user_settings(user_id, max_price=None)
                     await update.message.reply_text("✅ Ограничение по цене снято")
                 else:
-                    self.db.update_user_settings(user_id, max_price=price)
+                    await self.db.update_user_settings(user_id, max_price=price)
                     await update.message.reply_text(f"✅ Максимальная цена установлена: {price} BYN")
                 
                 del self.user_states[user_id]
@@ -379,7 +379,7 @@ class KufarTelegramBot:
         
         if user_id != ADMIN_USER_ID:
             await update.message.reply_text("❌ У вас нет доступа к этой команде")
-            self.db.add_log(user_id, 'sql_denied', None, command='/sql', source='kufar')
+            await self.db.add_log(user_id, 'sql_denied', None, command='/sql', source='kufar')
             return
         
         # Проверяем есть ли SQL запрос в сообщении
@@ -389,14 +389,14 @@ class KufarTelegramBot:
                 "Использование: /sql SELECT * FROM users LIMIT 10\n\n"
                 "⚠️ Разрешены только SELECT запросы!"
             )
-            self.db.add_log(user_id, 'sql_help', None, command='/sql', source='kufar')
+            await self.db.add_log(user_id, 'sql_help', None, command='/sql', source='kufar')
             return
         
         query = ' '.join(context.args)
-        self.db.add_log(user_id, 'sql_execute', query, command='/sql', source='kufar')
+        await self.db.add_log(user_id, 'sql_execute', query, command='/sql', source='kufar')
         
         try:
-            result, error = self.db.execute_sql(query)
+            result, error = await self.db.execute_sql(query)
             
             if error:
                 await update.message.reply_text(f"❌ Ошибка: {error}")
@@ -460,6 +460,16 @@ class KufarTelegramBot:
                     if isinstance(created_at, datetime):
                         date_str = f"\n📅 Дата: {created_at.strftime('%d.%m.%Y %H:%M')}"
             
+            # Размер выборки, по которой посчитана медиана (без выбросов)
+            sample_size = ad_data.get('median_sample_size')
+            sample_str = f", по {sample_size} объявл." if sample_size else ""
+            
+            # Снижение цены относительно прошлого сканирования
+            previous_price = ad_data.get('previous_price')
+            drop_str = ""
+            if previous_price:
+                drop_str = f"\n📉 Цена снижена: было {previous_price:,} BYN"
+            
             # Конвертируем в рубли для удобства
             from utils.currency_converter import convert_byn_to_rub
             price_rub = convert_byn_to_rub(price)
@@ -470,8 +480,8 @@ class KufarTelegramBot:
 🎯 Найдено выгодное предложение на Kufar!
 
 📱 Модель: {ad_data['model']}
-💰 Цена: {price:,} BYN (~{price_rub:,.0f} ₽)
-📊 Медианная цена: {median_price:,.0f} BYN (~{median_price_rub:,.0f} ₽)
+💰 Цена: {price:,} BYN (~{price_rub:,.0f} ₽){drop_str}
+📊 Медианная цена: {median_price:,.0f} BYN (~{median_price_rub:,.0f} ₽){sample_str}
 💵 Экономия: {price_difference:,.0f} BYN (~{price_difference_rub:,.0f} ₽) ({discount_percent:.1f}%)
 
 🏙 Город: {ad_data['city']}
@@ -488,7 +498,7 @@ class KufarTelegramBot:
             else:
                 logger.error(f"Application не инициализирован, не могу отправить сообщение пользователю {user_id}")
             
-            self.db.add_log(user_id, 'advertisement_sent', ad_data['url'], command=None, source='kufar')
+            await self.db.add_log(user_id, 'advertisement_sent', ad_data['url'], command=None, source='kufar')
             logger.info(f"Объявление отправлено пользователю {user_id}")
             
         except Exception as e:
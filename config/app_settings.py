@@ -2,6 +2,7 @@
 Основные настройки приложения
 """
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -15,3 +16,75 @@ MEDIAN_RECALCULATION_INTERVAL_HOURS = int(os.getenv('MEDIAN_RECALCULATION_INTERV
 # Admin Settings
 ADMIN_USER_ID = int(os.getenv('ADMIN_USER_ID', 8507895419))
 
+
+# Интервал обновления курсов валют (часы)
+CURRENCY_REFRESH_INTERVAL_HOURS = int(os.getenv('CURRENCY_REFRESH_INTERVAL_HOURS', 6))
+
+# Случайный разброс времени запуска задач планировщика (секунды)
+SCHEDULER_JITTER_SECONDS = int(os.getenv('SCHEDULER_JITTER_SECONDS', 60))
+
+# Максимальная длительность пересчета медианных цен (минуты)
+MEDIAN_RECALCULATION_TIMEOUT_MINUTES = int(os.getenv('MEDIAN_RECALCULATION_TIMEOUT_MINUTES', 30))
+
+# Оценка медианной цены: plain (обычная медиана), trimmed (усеченное среднее),
+# mad (медиана после отсечения выбросов по MAD - чехлы, битые телефоны, "цена по запросу")
+MEDIAN_ESTIMATOR = os.getenv('MEDIAN_ESTIMATOR', 'mad')
+MEDIAN_TRIM_PERCENT = float(os.getenv('MEDIAN_TRIM_PERCENT', 10))
+MEDIAN_MAD_THRESHOLD = float(os.getenv('MEDIAN_MAD_THRESHOLD', 3.0))
+# Минимальный масштаб разброса для mad, % от медианы (когда MAD = 0 - половина окна по одной цене)
+MEDIAN_MAD_MIN_SCALE_PERCENT = float(os.getenv('MEDIAN_MAD_MIN_SCALE_PERCENT', 5))
+
+# Пул соединений с PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', 2))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 10))
+# Сколько ждать свободное соединение из пула (секунды)
+DB_POOL_CHECKOUT_TIMEOUT_SECONDS = int(os.getenv('DB_POOL_CHECKOUT_TIMEOUT_SECONDS', 30))
+# Соединения, простаивавшие дольше, проверяются SELECT 1 перед выдачей (секунды)
+DB_POOL_HEALTHCHECK_IDLE_SECONDS = int(os.getenv('DB_POOL_HEALTHCHECK_IDLE_SECONDS', 60))
+# Количество попыток переподключения при недоступности БД
+DB_RECONNECT_ATTEMPTS = int(os.getenv('DB_RECONNECT_ATTEMPTS', 3))
+
+# Асинхронный пул соединений (psycopg 3) для ботов, парсера и планировщика
+ASYNC_DB_POOL_MIN_SIZE = int(os.getenv('ASYNC_DB_POOL_MIN_SIZE', 2))
+ASYNC_DB_POOL_MAX_SIZE = int(os.getenv('ASYNC_DB_POOL_MAX_SIZE', 10))
+
+# Секционирование объявлений по месяцам: сколько будущих месяцев создавать заранее
+ADS_PARTITION_MONTHS_AHEAD = int(os.getenv('ADS_PARTITION_MONTHS_AHEAD', 2))
+
+# Буферизованная запись user_logs: размер очереди, размер пачки и интервал сброса
+USER_LOG_QUEUE_SIZE = int(os.getenv('USER_LOG_QUEUE_SIZE', 10000))
+USER_LOG_BATCH_SIZE = int(os.getenv('USER_LOG_BATCH_SIZE', 200))
+USER_LOG_FLUSH_INTERVAL_SECONDS = float(os.getenv('USER_LOG_FLUSH_INTERVAL_SECONDS', 2))
+
+# Кэш пользователей в AsyncDatabase: пауза перед переподключением слушателя LISTEN users_changed
+USER_CACHE_RECONNECT_SECONDS = float(os.getenv('USER_CACHE_RECONNECT_SECONDS', 5))
+
+# Журнал отложенных записей: объявления, отправки и логи, пока база недоступна.
+# Каталог logs монтируется в контейнер, поэтому журнал переживает перезапуск;
+# у каждого экземпляра (hostname контейнера) свой файл
+WRITE_SPOOL_PATH = os.getenv('WRITE_SPOOL_PATH', f'logs/db_write_spool.{socket.gethostname()}.bin')
+WRITE_SPOOL_MAX_MB = int(os.getenv('WRITE_SPOOL_MAX_MB', 256))
+WRITE_SPOOL_REPLAY_INTERVAL_SECONDS = float(os.getenv('WRITE_SPOOL_REPLAY_INTERVAL_SECONDS', 10))
+WRITE_SPOOL_REPLAY_BATCH_SIZE = int(os.getenv('WRITE_SPOOL_REPLAY_BATCH_SIZE', 1000))
+# Сколько дней хранить отметки воспроизведенных записей журнала (spool_replayed)
+SPOOL_REPLAYED_RETENTION_DAYS = int(os.getenv('SPOOL_REPLAYED_RETENTION_DAYS', 7))
+
+# Интервал пересчета сводки для /analytics (минуты)
+ANALYTICS_REFRESH_INTERVAL_MINUTES = int(os.getenv('ANALYTICS_REFRESH_INTERVAL_MINUTES', 10))
+
+# Админские /sql-запросы: отдельное read-only соединение с таймаутом и жестким лимитом строк
+ADMIN_SQL_STATEMENT_TIMEOUT_SECONDS = int(os.getenv('ADMIN_SQL_STATEMENT_TIMEOUT_SECONDS', 10))
+ADMIN_SQL_MAX_ROWS = int(os.getenv('ADMIN_SQL_MAX_ROWS', 100))
+ADMIN_SQL_FETCH_SIZE = int(os.getenv('ADMIN_SQL_FETCH_SIZE', 50))
+
+# Хранение данных (дни, 0 - хранить бессрочно). Объявления удаляются помесячными
+# секциями, их дневная статистика (ad_daily_stats) хранится бессрочно
+ADS_RETENTION_DAYS = int(os.getenv('ADS_RETENTION_DAYS', 90))
+USER_LOG_RETENTION_DAYS = int(os.getenv('USER_LOG_RETENTION_DAYS', 30))
+PARSING_LOG_RETENTION_DAYS = int(os.getenv('PARSING_LOG_RETENTION_DAYS', 30))
+SCHEDULER_RUN_RETENTION_DAYS = int(os.getenv('SCHEDULER_RUN_RETENTION_DAYS', 90))
+# Удаление пачками с паузами, чтобы не создавать всплесков блокировок и WAL
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 5000))
+RETENTION_BATCH_PAUSE_SECONDS = float(os.getenv('RETENTION_BATCH_PAUSE_SECONDS', 0.5))
+# Каталог для архива удаляемых строк (.csv.gz); пусто - без архива
+RETENTION_ARCHIVE_DIR = os.getenv('RETENTION_ARCHIVE_DIR', '')
@@ -1,773 +1,996 @@
+import re
+import threading
+import time
+import weakref
+from contextlib import contextmanager
 import psycopg2
+import psycopg2.errors
+import psycopg2.pool
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from datetime import datetime
 from typing import Optional, List, Dict
 import logging
 from utils.logger import get_logger
+from config.app_settings import (
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_CHECKOUT_TIMEOUT_SECONDS,
+    DB_POOL_HEALTHCHECK_IDLE_SECONDS, DB_RECONNECT_ATTEMPTS, ADS_PARTITION_MONTHS_AHEAD
+)
 
 logger = get_logger('database')
 
+# Управляемый набор индексов: {имя: определение}. Создаются миграцией схемы, если их нет
+# (новый индекс требует новой миграции в Database.SCHEMA_MIGRATIONS)
+MANAGED_INDEXES = {
+    'idx_parsing_logs_source_created': 'ON parsing_logs(source, created_at DESC)',
+    'idx_scheduler_runs_job_started': 'ON scheduler_runs(job_name, started_at DESC)',
+    'idx_price_history_ad': 'ON ad_price_history(source, external_id, created_at DESC)',
+    'idx_ads_city_model': 'ON advertisements(city, model)',
+    # Покрывающий индекс для окна медианы (MedianPriceCalculator.MEDIAN_WINDOW_QUERY):
+    # фильтр, сортировка и цена берутся из индекса - index-only scan без сортировки
+    'idx_ads_median_window': 'ON advertisements(source, city, model, created_at DESC) INCLUDE (price)',
+    # Частичный индекс по горячему подмножеству: get_active_users() читает только активных
+    'idx_users_active_source': 'ON users(source) WHERE is_active',
+    # Проверка "кому уже отправлены эти объявления" без фильтра по пользователю
+    'idx_deliveries_ad': 'ON deliveries(source, external_id)',
+    # BRIN для журналов, которые пишутся только в конец и очищаются по сроку хранения
+    # диапазоном created_at (RetentionService.purge_table): несколько страниц вместо B-tree
+    'idx_user_logs_created_brin': 'ON user_logs USING brin (created_at)',
+    'idx_parsing_logs_created_brin': 'ON parsing_logs USING brin (created_at)',
+    'idx_price_history_created_brin': 'ON ad_price_history USING brin (created_at)',
+}
+
+# Индексы, которые больше не нужны и удаляются миграцией схемы.
+# Поиск по (source, external_id) и по source обслуживает уникальный ключ объявлений,
+# B-tree по булеву is_active заменен частичным idx_users_active_source. BRIN по времени
+# объявлений и отправок не читал ни один запрос: объявления удаляются секциями, а
+# deliveries.sent_at переписывается при повторной отправке и диапазонами не читается
+RETIRED_INDEXES = (
+    'idx_ads_avito_id', 'idx_ads_kufar_id', 'idx_ads_source', 'idx_users_active',
+    'idx_ads_created_brin', 'idx_deliveries_sent_brin',
+)
+
+# Именованные подготовленные запросы горячих путей: {имя: (типы параметров, запрос с $n)}.
+# Готовятся один раз на соединение при первом вызове Database.execute_prepared
+PREPARED_STATEMENTS = {
+    # Окно цен для медианы (текст совпадает с MedianPriceCalculator.MEDIAN_WINDOW_QUERY)
+    'median_window': (
+        ('varchar', 'varchar', 'varchar', 'timestamp', 'integer'),
+        """
+            SELECT price FROM advertisements
+            WHERE city = $1 AND model = $2 AND source = $3 AND created_at >= $4
+            ORDER BY created_at DESC
+            LIMIT $5
+        """
+    ),
+    'median_window_all_sources': (
+        ('varchar', 'varchar', 'timestamp', 'integer'),
+        """
+            SELECT price FROM advertisements
+            WHERE city = $1 AND model = $2 AND created_at >= $3
+            ORDER BY created_at DESC
+            LIMIT $4
+        """
+    ),
+    'deal_threshold_upsert': (
+        ('varchar', 'varchar', 'varchar', 'numeric', 'integer', 'integer', 'integer'),
+        """
+            INSERT INTO deal_thresholds
+            (source, city, model, median_price, price_ceiling, sample_size, outliers_removed)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            ON CONFLICT (source, city, model) DO UPDATE SET
+                median_price = EXCLUDED.median_price,
+                price_ceiling = EXCLUDED.price_ceiling,
+                sample_size = EXCLUDED.sample_size,
+                outliers_removed = EXCLUDED.outliers_removed,
+                updated_at = CURRENT_TIMESTAMP
+        """
+    ),
+    # Медиана объявлений комбинации; строки с актуальной медианой не переписываются
+    'ads_set_median': (
+        ('numeric', 'varchar', 'varchar', 'varchar'),
+        """
+            UPDATE advertisements
+            SET median_price = $1, price_difference = price - $1, updated_at = CURRENT_TIMESTAMP
+            WHERE city = $2 AND model = $3 AND source = $4
+              AND (median_price, price_difference) IS DISTINCT FROM ($1, price - $1)
+        """
+    ),
+    'ads_set_median_all_sources': (
+        ('numeric', 'varchar', 'varchar'),
+        """
+            UPDATE advertisements
+            SET median_price = $1, price_difference = price - $1, updated_at = CURRENT_TIMESTAMP
+            WHERE city = $2 AND model = $3
+              AND (median_price, price_difference) IS DISTINCT FROM ($1, price - $1)
+        """
+    ),
+}
+
+# Объявления секционированы по месяцам created_at: уникальные ключи секционированной
+# таблицы обязаны включать created_at, поэтому глобальную уникальность объявления
+# (source, external_id) обеспечивает реестр advertisement_keys
+ADVERTISEMENTS_DDL = """
+    CREATE TABLE IF NOT EXISTS advertisements (
+        id SERIAL,
+        source VARCHAR(20) NOT NULL CHECK (source IN ('avito', 'kufar')),
+        external_id VARCHAR(100) NOT NULL,
+        price INTEGER NOT NULL,
+        price_rub DECIMAL(10, 2),
+        price_byn DECIMAL(10, 2),
+        model VARCHAR(100) NOT NULL,
+        city VARCHAR(100) NOT NULL,
+        memory VARCHAR(50),
+        url TEXT NOT NULL,
+        median_price DECIMAL(10, 2),
+        price_difference DECIMAL(10, 2),
+        created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, created_at),
+        CONSTRAINT advertisements_source_external_id_key UNIQUE (source, external_id, created_at)
+    ) PARTITION BY RANGE (created_at)
+"""
+# Сводка для /analytics: один запрос по всем таблицам, пересчитывается планировщиком
+# (REFRESH ... CONCURRENTLY требует уникальный индекс, поэтому строка имеет id)
+ANALYTICS_VIEW_DDL = """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS analytics_summary AS
+    SELECT
+        1 AS id,
+        u.total_users, u.active_users, u.avito_users, u.kufar_users,
+        a.total_ads, a.avito_ads, a.kufar_ads,
+        -- Отправленные объявления, а не отправки: одно объявление могло уйти нескольким пользователям
+        (SELECT COUNT(DISTINCT (source, external_id)) FROM deliveries) AS sent_ads,
+        (
+            SELECT COALESCE(json_agg(top ORDER BY top.actions_count DESC), '[]'::json)
+            FROM (
+                SELECT user_id, nickname, username, actions_count
+                FROM users
+                ORDER BY actions_count DESC
+                LIMIT 10
+            ) top
+        ) AS top_users,
+        (
+            SELECT COALESCE(json_agg(top ORDER BY top.count DESC), '[]'::json)
+            FROM (
+                SELECT model, COUNT(*) AS count
+                FROM advertisements
+                GROUP BY model
+                ORDER BY count DESC
+                LIMIT 10
+            ) top
+        ) AS top_models,
+        CURRENT_TIMESTAMP AS refreshed_at
+    FROM (
+        SELECT
+            COUNT(*) AS total_users,
+            COUNT(*) FILTER (WHERE is_active) AS active_users,
+            COUNT(*) FILTER (WHERE is_active AND source = 'avito') AS avito_users,
+            COUNT(*) FILTER (WHERE is_active AND source = 'kufar') AS kufar_users
+        FROM users
+    ) u
+    CROSS JOIN (
+        SELECT
+            COUNT(*) AS total_ads,
+            COUNT(*) FILTER (WHERE source = 'avito') AS avito_ads,
+            COUNT(*) FILTER (WHERE source = 'kufar') AS kufar_ads
+        FROM advertisements
+    ) a
+"""
+ADS_PARTITION_NAME = re.compile(r'^advertisements_(\d{4})_(\d{2})$')
+
+
+def _month_start(value: datetime, shift: int = 0) -> datetime:
+    """Начало месяца для value, сдвинутого на shift месяцев"""
+    month_index = value.year * 12 + value.month - 1 + shift
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
 
 class Database:
     def __init__(self, db_config: dict):
         self.db_config = db_config
-        self.conn = None
+        self.pool = None
+        self._pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)
+        self._last_used = {}  # id(conn) -> time.monotonic() последнего возврата в пул
+        # Соединение -> имена подготовленных на нем запросов (закрытые соединения выпадают сами)
+        self._prepared = weakref.WeakKeyDictionary()
+        self._prepared_lock = threading.Lock()
         self._connect()
-        self._create_tables()
+        self._migrate_schema()
 
     def _connect(self):
-        """Установить соединение с базой данных"""
+        """Создать пул соединений с базой данных"""
         try:
-            self.conn = psycopg2.connect(**self.db_config)
-            logger.info("Подключение к базе данных установлено")
+            self.pool = ThreadedConnectionPool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, **self.db_config)
+            logger.info(
+                f"Пул соединений с базой данных создан (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})"
+            )
         except Exception as e:
             logger.error(f"Ошибка подключения к базе данных: {e}")
             raise
 
-    def _create_tables(self):
-        """Создать таблицы если их нет"""
+    def _is_healthy(self, conn) -> bool:
+        """Проверить соединение перед выдачей (SELECT 1, если оно долго простаивало)"""
+        if conn.closed:
+            return False
+        idle = time.monotonic() - self._last_used.get(id(conn), 0)
+        if idle < DB_POOL_HEALTHCHECK_IDLE_SECONDS:
+            return True
         try:
-            with self.conn.cursor() as cur:
-                # Таблица пользователей
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id BIGINT PRIMARY KEY,
-                        username VARCHAR(255),
-                        nickname VARCHAR(255),
-                        first_name VARCHAR(255),
-                        last_name VARCHAR(255),
-                        city VARCHAR(100),
-                        model VARCHAR(100),
-                        max_price INTEGER,
-                        source VARCHAR(20) DEFAULT 'avito' CHECK (source IN ('avito', 'kufar')),
-                        is_active BOOLEAN DEFAULT TRUE,
-                        is_admin BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # Миграция: добавляем колонки nickname и is_admin если их нет
-                try:
-                    cur.execute("""
-                        DO $$ 
-                        BEGIN 
-                            IF NOT EXISTS (
-                                SELECT 1 FROM information_schema.columns 
-                                WHERE table_name='users' AND column_name='nickname'
-                            ) THEN
-                                ALTER TABLE users ADD COLUMN nickname VARCHAR(255);
-                            END IF;
-                            IF NOT EXISTS (
-                                SELECT 1 FROM information_schema.columns 
-                                WHERE table_name='users' AND column_name='is_admin'
-                            ) THEN
-                                ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT FALSE;
-                            END IF;
-                        END $$;
-                    """)
-                except Exception as e:
-                    logger.warning(f"Не удалось добавить колонки в users: {e}")
-
-                # Таблица логов взаимодействия с ботом
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS user_logs (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
-                        action VARCHAR(255),
-                        message_text TEXT,
-                        command VARCHAR(100),
-                        source VARCHAR(20),
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # Таблица логов парсинга
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS parsing_logs (
-                        id SERIAL PRIMARY KEY,
-                        source VARCHAR(20) NOT NULL CHECK (source IN ('avito', 'kufar')),
-                        city VARCHAR(100),
-                        model VARCHAR(100),
-                        pages_parsed INTEGER DEFAULT 0,
-                        ads_found INTEGER DEFAULT 0,
-                        ads_processed INTEGER DEFAULT 0,
-                        ads_sent INTEGER DEFAULT 0,
-                        errors_count INTEGER DEFAULT 0,
-                        duration_seconds DECIMAL(10, 2),
-                        status VARCHAR(50) DEFAULT 'completed',
-                        error_message TEXT,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                
-                # Индекс для быстрого поиска
-                cur.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_parsing_logs_source_created 
-                    ON parsing_logs(source, created_at DESC)
-                """)
-                
-                # Миграция: добавляем колонки command и source если их нет
-                try:
-                    cur.execute("""
-                        DO $$ 
-                        BEGIN 
-                            IF NOT EXISTS (
-                                SELECT 1 FROM information_schema.columns 
-                                WHERE table_name='user_logs' AND column_name='command'
-                            ) THEN
-                                ALTER TABLE user_logs ADD COLUMN command VARCHAR(100);
-                            END IF;
-                            IF NOT EXISTS (
-                                SELECT 1 FROM information_schema.columns 
-                                WHERE table_name='user_logs' AND column_name='source'
-                            ) THEN
-                                ALTER TABLE user_logs ADD COLUMN source VARCHAR(20);
-                            END IF;
-                        END $$;
-                    """)
-                except Exception as e:
-                    logger.warning(f"Не удалось добавить колонки в user_logs: {e}")
-
-                # Таблица объявлений
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS advertisements (
-                        id SERIAL PRIMARY KEY,
-                        avito_id VARCHAR(100),
-                        kufar_id VARCHAR(100),
-                        source VARCHAR(20) NOT NULL CHECK (source IN ('avito', 'kufar')),
-                        price INTEGER NOT NULL,
-                        price_rub DECIMAL(10, 2),
-                        price_byn DECIMAL(10, 2),
-                        model VARCHAR(100) NOT NULL,
-                        city VARCHAR(100) NOT NULL,
-                        memory VARCHAR(50),
-                        url TEXT NOT NULL,
-                        median_price DECIMAL(10, 2),
-                        price_difference DECIMAL(10, 2),
-                        notified BOOLEAN DEFAULT FALSE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        UNIQUE(avito_id, source),
-                        UNIQUE(kufar_id, source)
-                    )
-                """)
-                
-                # Миграция: добавляем колонки для валют если их нет
-                try:
-                    cur.execute("""
-                        DO $$ 
-                        BEGIN 
-                            IF NOT EXISTS (
-                                SELECT 1 FROM information_schema.columns 
-                                WHERE table_name='advertisements' AND column_name='price_rub'
-                            ) THEN
-                                ALTER TABLE advertisements ADD COLUMN price_rub DECIMAL(10, 2);
-                            END IF;
-                            IF NOT EXISTS (
-                                SELECT 1 FROM information_schema.columns 
-                                WHERE table_name='advertisements' AND column_name='price_byn'
-                            ) THEN
-                                ALTER TABLE advertisements ADD COLUMN price_byn DECIMAL(10, 2);
-                            END IF;
-                        END $$;
-                    """)
-                except Exception as e:
-                    logger.warning(f"Не удалось добавить колонки валют в advertisements: {e}")
-
-                # Индексы для быстрого поиска
-                cur.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_ads_city_model 
-                    ON advertisements(city, model)
-                """)
-                
-                cur.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_ads_avito_id 
-                    ON advertisements(avito_id)
-                """)
-                
-                cur.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_ads_kufar_id 
-                    ON advertisements(kufar_id)
-                """)
-                
-                cur.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_ads_source 
-                    ON advertisements(source)
-                """)
-
-                cur.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_users_active 
-                    ON users(is_active)
-                """)
-                
-                # Миграция: добавляем колонку notified если её нет
-                try:
-                    cur.execute("""
-                        DO $$ 
-                        BEGIN 
-                            IF NOT EXISTS (
-                                SELECT 1 FROM information_schema.columns 
-                                WHERE table_name='advertisements' AND column_name='notified'
-                            ) THEN
-                                ALTER TABLE advertisements ADD COLUMN notified BOOLEAN DEFAULT FALSE;
-                            END IF;
-                        END $$;
-                    """)
-                except Exception as e:
-                    logger.warning(f"Не удалось добавить колонку notified (возможно уже существует): {e}")
-                
-                # Устанавливаем админа (пользователь 8507895419)
-                try:
-                    from config import ADMIN_USER_ID
-                    cur.execute("""
-                        UPDATE users SET is_admin = TRUE 
-                        WHERE user_id = %s
-                    """, (ADMIN_USER_ID,))
-                except Exception as e:
-                    logger.warning(f"Не удалось установить админа: {e}")
-                
-                self.conn.commit()
-                logger.info("Таблицы созданы успешно")
-        except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка создания таблиц: {e}")
-            raise
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
 
-    def add_user(self, user_id: int, username: str = None, 
-                 first_name: str = None, last_name: str = None,
-                 source: str = None, nickname: str = None, is_admin: bool = False):
-        """Добавить нового пользователя"""
+    def _checkout(self):
+        """Взять здоровое соединение из пула (с переподключением при обрыве)"""
+        if not self._pool_slots.acquire(timeout=DB_POOL_CHECKOUT_TIMEOUT_SECONDS):
+            raise psycopg2.pool.PoolError("Нет свободных соединений в пуле")
+        
         try:
-            with self.conn.cursor() as cur:
-                # Проверяем существующего пользователя для сохранения статуса админа
-                cur.execute("SELECT is_admin FROM users WHERE user_id = %s", (user_id,))
-                existing = cur.fetchone()
-                if existing:
-                    is_admin = existing[0] or is_admin
-                
-                cur.execute("""
-                    INSERT INTO users (user_id, username, first_name, last_name, source, nickname, is_admin)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (user_id) DO UPDATE SET
-                        username = EXCLUDED.username,
-                        first_name = EXCLUDED.first_name,
-                        last_name = EXCLUDED.last_name,
-                        nickname = COALESCE(EXCLUDED.nickname, users.nickname),
-                        is_admin = COALESCE(EXCLUDED.is_admin, users.is_admin),
-                        updated_at = CURRENT_TIMESTAMP
-                """, (user_id, username, first_name, last_name, source, nickname, is_admin))
-                self.conn.commit()
-                logger.info(f"Пользователь {user_id} добавлен/обновлен")
-        except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка добавления пользователя: {e}")
+            last_error = None
+            for attempt in range(DB_RECONNECT_ATTEMPTS):
+                try:
+                    conn = self.pool.getconn()
+                except psycopg2.OperationalError as e:
+                    # База недоступна - ждем и пробуем снова
+                    last_error = e
+                    time.sleep(min(2 ** attempt * 0.5, 5))
+                    continue
+                
+                if self._is_healthy(conn):
+                    return conn
+                
+                # Битое соединение закрываем, пул создаст новое
+                logger.warning("Соединение из пула неисправно, переподключаемся")
+                self._last_used.pop(id(conn), None)
+                self.pool.putconn(conn, close=True)
+            
+            raise last_error or psycopg2.OperationalError("Не удалось получить исправное соединение")
+        except Exception:
+            self._pool_slots.release()
             raise
-    
-    def update_user_nickname(self, user_id: int, nickname: str):
-        """Обновить никнейм пользователя"""
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    UPDATE users SET nickname = %s, updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = %s
-                """, (nickname, user_id))
-                self.conn.commit()
-                return True
-        except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка обновления никнейма: {e}")
-            return False
-    
-    def is_admin(self, user_id: int) -> bool:
-        """Проверить является ли пользователь админом"""
+
+    def _release(self, conn):
+        """Вернуть соединение в пул (битые соединения закрываются)"""
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT is_admin FROM users WHERE user_id = %s", (user_id,))
-                result = cur.fetchone()
-                return result[0] if result else False
-        except Exception as e:
-            logger.error(f"Ошибка проверки статуса админа: {e}")
-            return False
+            broken = conn.closed or conn.get_transaction_status() == TRANSACTION_STATUS_UNKNOWN
+            if broken:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            self.pool.putconn(conn, close=broken)
+        finally:
+            self._pool_slots.release()
 
-    def add_log(self, user_id: int, action: str, message_text: str = None,
-                command: str = None, source: str = None):
-        """Добавить лог взаимодействия с ботом"""
+    @contextmanager
+    def connection(self):
+        """
+        Соединение из пула на одну транзакцию
+
+        При выходе из блока транзакция фиксируется, при исключении
+        откатывается, соединение возвращается в пул.
+        """
+        conn = self._checkout()
         try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO user_logs (user_id, action, message_text, command, source)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (user_id, action, message_text, command, source))
-                self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка добавления лога: {e}")
-    
-    def execute_sql(self, query: str, limit: int = 100) -> tuple:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            raise
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def cursor(self, cursor_factory=None):
+        """Курсор на соединении из пула в рамках одной транзакции"""
+        with self.connection() as conn:
+            with conn.cursor(cursor_factory=cursor_factory) as cur:
+                yield cur
+
+    def execute_prepared(self, cur, name: str, params: tuple = ()):
         """
-        Выполнить SQL запрос (только SELECT)
-        Возвращает (результаты, ошибка)
+        Выполнить запрос из PREPARED_STATEMENTS
+
+        На каждом соединении (пула или выделенном) PREPARE выполняется один
+        раз, дальше сервер получает только EXECUTE с параметрами и не разбирает
+        и не планирует текст запроса заново.
         """
+        conn = cur.connection
+        with self._prepared_lock:
+            prepared = self._prepared.setdefault(conn, set())
+        if name not in prepared:
+            types, query = PREPARED_STATEMENTS[name]
+            cur.execute(f"PREPARE {name} ({', '.join(types)}) AS {query}")
+            prepared.add(name)
         try:
-            # Проверяем что это SELECT запрос
-            query_upper = query.strip().upper()
-            if not query_upper.startswith('SELECT'):
-                return None, "Разрешены только SELECT запросы"
-            
-            # Добавляем LIMIT если его нет (только для запросов без GROUP BY, ORDER BY с LIMIT)
-            if 'LIMIT' not in query_upper and 'GROUP BY' not in query_upper:
-                query = f"{query.rstrip(';')} LIMIT {limit}"
-            
-            with self.conn.cursor() as cur:
-                cur.execute(query)
-                
-                # Получаем результаты
-                if cur.description:
-                    columns = [desc[0] for desc in cur.description]
-                    rows = cur.fetchall()
-                    return (columns, rows), None
-                else:
-                    return None, "Запрос не вернул результаты"
-        except Exception as e:
-            return None, str(e)
-    
-    def get_analytics(self) -> dict:
-        """Получить аналитику проекта"""
+            cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+        except psycopg2.errors.InvalidSqlStatementName:
+            # Сессия сброшена на сервере (DISCARD ALL) - подготовим запрос заново при следующем вызове
+            prepared.discard(name)
+            raise
+
+    # Версии схемы: (версия, имя, метод). Миграции применяются по порядку и только
+    # если версия в schema_version отстает; новые изменения схемы - новой записью в конце
+    SCHEMA_MIGRATIONS = [
+        (1, 'baseline', '_migration_001_baseline'),
+        (2, 'analytics_top_users_from_counters', '_migration_002_analytics_top_users_from_counters'),
+        (3, 'ad_daily_stats', '_migration_003_ad_daily_stats'),
+        (4, 'brin_and_partial_indexes', '_migration_004_brin_and_partial_indexes'),
+        (5, 'users_changed_notify', '_migration_005_users_changed_notify'),
+        (6, 'deliveries_sent_price', '_migration_006_deliveries_sent_price'),
+        (7, 'spool_replayed', '_migration_007_spool_replayed'),
+        (8, 'analytics_sent_ads_distinct', '_migration_008_analytics_sent_ads_distinct'),
+        (9, 'drop_unused_brin_indexes', '_migration_009_drop_unused_brin_indexes'),
+    ]
+
+    def _schema_version(self) -> int:
+        """Текущая версия схемы (0 - схема еще не версионировалась)"""
         try:
-            with self.conn.cursor() as cur:
-                # Всего пользователей
-                cur.execute("SELECT COUNT(*) FROM users")
-                total_users = cur.fetchone()[0]
-                
-                # Активных пользователей
-                cur.execute("SELECT COUNT(*) FROM users WHERE is_active = TRUE")
-                active_users = cur.fetchone()[0]
-                
-                # Пользователей по источникам
-                cur.execute("SELECT COUNT(*) FROM users WHERE source = 'avito' AND is_active = TRUE")
-                avito_users = cur.fetchone()[0]
-                
-                cur.execute("SELECT COUNT(*) FROM users WHERE source = 'kufar' AND is_active = TRUE")
-                kufar_users = cur.fetchone()[0]
-                
-                # Всего объявлений
-                cur.execute("SELECT COUNT(*) FROM advertisements")
-                total_ads = cur.fetchone()[0]
-                
-                # Объявления по источникам
-                cur.execute("SELECT COUNT(*) FROM advertisements WHERE source = 'avito'")
-                avito_ads = cur.fetchone()[0]
-                
-                cur.execute("SELECT COUNT(*) FROM advertisements WHERE source = 'kufar'")
-                kufar_ads = cur.fetchone()[0]
-                
-                # Отправленных объявлений
-                cur.execute("SELECT COUNT(*) FROM advertisements WHERE notified = TRUE")
-                sent_ads = cur.fetchone()[0]
-                
-                # Топ пользователей по действиям
-                cur.execute("""
-                    SELECT u.user_id, u.nickname, u.username, COUNT(l.id) as actions_count
-                    FROM users u
-                    LEFT JOIN user_logs l ON u.user_id = l.user_id
-                    GROUP BY u.user_id, u.nickname, u.username
-                    ORDER BY actions_count DESC
-                    LIMIT 10
-                """)
-                top_users_rows = cur.fetchall()
-                top_users = "\n".join([
-                    f"• {row[1] or row[2] or f'ID:{row[0]}'}: {row[3]} действий"
-                    for row in top_users_rows
-                ]) if top_users_rows else "Нет данных"
-                
-                # Топ моделей
-                cur.execute("""
-                    SELECT model, COUNT(*) as count
-                    FROM advertisements
-                    GROUP BY model
-                    ORDER BY count DESC
-                    LIMIT 10
-                """)
-                top_models_rows = cur.fetchall()
-                top_models = "\n".join([
-                    f"• {row[0]}: {row[1]} объявлений"
-                    for row in top_models_rows
-                ]) if top_models_rows else "Нет данных"
-                
-                return {
-                    'total_users': total_users,
-                    'active_users': active_users,
-                    'avito_users': avito_users,
-                    'kufar_users': kufar_users,
-                    'total_ads': total_ads,
-                    'avito_ads': avito_ads,
-                    'kufar_ads': kufar_ads,
-                    'sent_ads': sent_ads,
-                    'top_users': top_users,
-                    'top_models': top_models,
-                }
-        except Exception as e:
-            logger.error(f"Ошибка получения аналитики: {e}")
-            return {}
-    
-    def get_user_profile(self, user_id: int) -> Optional[Dict]:
-        """Получить профиль пользователя со статистикой"""
+            with self.cursor() as cur:
+                cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                return cur.fetchone()[0]
+        except psycopg2.errors.UndefinedTable:
+            return 0
+
+    def _migrate_schema(self):
+        """
+        Применить недостающие миграции схемы
+
+        При актуальной схеме старт стоит одного запроса к schema_version.
+        Каждая миграция выполняется в своей транзакции под advisory-блокировкой,
+        поэтому одновременно стартующие экземпляры не применяют ее дважды.
+        """
+        current = self._schema_version()
+        pending = [migration for migration in self.SCHEMA_MIGRATIONS if migration[0] > current]
+        if not pending:
+            logger.info(f"Схема БД актуальна (версия {current})")
+            return
+        
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                # Основная информация о пользователе
-                cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-                user = cur.fetchone()
-                
-                if not user:
-                    return None
-                
-                user_dict = dict(user)
-                
-                # Статистика: высланных объявлений
-                cur.execute("""
-                    SELECT COUNT(*) FROM advertisements 
-                    WHERE notified = TRUE 
-                    AND EXISTS (
-                        SELECT 1 FROM users u 
-                        WHERE u.user_id = %s 
-                        AND u.city = advertisements.city 
-                        AND (u.model = advertisements.model OR u.model IS NULL)
+            for version, name, method_name in pending:
+                with self.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migrations'))")
+                    cur.execute("""
+                        CREATE TABLE IF NOT EXISTS schema_version (
+                            version INTEGER PRIMARY KEY,
+                            name VARCHAR(255) NOT NULL,
+                            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                        )
+                    """)
+                    cur.execute("SELECT 1 FROM schema_version WHERE version = %s", (version,))
+                    if cur.fetchone():
+                        # Применена другим экземпляром, пока мы ждали блокировку
+                        continue
+                    
+                    logger.info(f"Применение миграции схемы {version}: {name}")
+                    getattr(self, method_name)(cur)
+                    cur.execute(
+                        "INSERT INTO schema_version (version, name) VALUES (%s, %s)",
+                        (version, name)
                     )
-                """, (user_id,))
-                sent_ads_count = cur.fetchone()[0]
-                
-                # Статистика: действий в боте
-                cur.execute("SELECT COUNT(*) FROM user_logs WHERE user_id = %s", (user_id,))
-                actions_count = cur.fetchone()[0]
-                
-                # Статистика: нажатий кнопок
-                cur.execute("""
-                    SELECT COUNT(*) FROM user_logs 
-                    WHERE user_id = %s AND command = 'button'
-                """, (user_id,))
-                button_clicks = cur.fetchone()[0]
-                
-                user_dict['sent_ads_count'] = sent_ads_count
-                user_dict['actions_count'] = actions_count
-                user_dict['button_clicks'] = button_clicks
-                
-                return user_dict
+            logger.info(f"Схема БД обновлена до версии {pending[-1][0]}")
         except Exception as e:
-            logger.error(f"Ошибка получения профиля: {e}")
-            return None
-    
-    def add_parsing_log(self, source: str, city: str = None, model: str = None,
-                       pages_parsed: int = 0, ads_found: int = 0, ads_processed: int = 0,
-                       ads_sent: int = 0, errors_count: int = 0, duration_seconds: float = 0,
-                       status: str = 'completed', error_message: str = None):
-        """Добавить лог парсинга"""
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO parsing_logs 
-                    (source, city, model, pages_parsed, ads_found, ads_processed, ads_sent, 
-                     errors_count, duration_seconds, status, error_message)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (source, city, model, pages_parsed, ads_found, ads_processed, ads_sent,
-                      errors_count, duration_seconds, status, error_message))
-                self.conn.commit()
-                return True
-        except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка добавления лога парсинга: {e}")
-            return False
-    
-    def get_parsing_stats(self, source: str = None, limit: int = 10) -> List[Dict]:
-        """Получить статистику парсинга"""
+            logger.error(f"Ошибка миграции схемы БД: {e}")
+            raise
+
+    def _migration_001_baseline(self, cur):
+        """
+        Исходная схема: таблицы, миграции колонок прежних версий, секции, индексы
+
+        Идемпотентна - на базах, созданных до появления schema_version,
+        доводит схему до текущей без потери данных.
+        """
+        # Таблица пользователей
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id BIGINT PRIMARY KEY,
+                username VARCHAR(255),
+                nickname VARCHAR(255),
+                first_name VARCHAR(255),
+                last_name VARCHAR(255),
+                city VARCHAR(100),
+                model VARCHAR(100),
+                max_price INTEGER,
+                source VARCHAR(20) DEFAULT 'avito' CHECK (source IN ('avito', 'kufar')),
+                is_active BOOLEAN DEFAULT TRUE,
+                is_admin BOOLEAN DEFAULT FALSE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Миграция: добавляем колонки nickname и is_admin если их нет
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                if source:
-                    cur.execute("""
-                        SELECT * FROM parsing_logs 
-                        WHERE source = %s 
-                        ORDER BY created_at DESC 
-                        LIMIT %s
-                    """, (source, limit))
-                else:
-                    cur.execute("""
-                        SELECT * FROM parsing_logs 
-                        ORDER BY created_at DESC 
-                        LIMIT %s
-                    """, (limit,))
-                return [dict(row) for row in cur.fetchall()]
+            cur.execute("""
+                DO $$ 
+                BEGIN 
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='users' AND column_name='nickname'
+                    ) THEN
+                        ALTER TABLE users ADD COLUMN nickname VARCHAR(255);
+                    END IF;
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='users' AND column_name='is_admin'
+                    ) THEN
+                        ALTER TABLE users ADD COLUMN is_admin BOOLEAN DEFAULT FALSE;
+                    END IF;
+                END $$;
+            """)
         except Exception as e:
-            logger.error(f"Ошибка получения статистики парсинга: {e}")
-            return []
+            logger.warning(f"Не удалось добавить колонки в users: {e}")
 
-    def update_user_settings(self, user_id: int, city: str = None, 
-                            model: str = None, max_price: int = None, 
-                            is_active: bool = None, source: str = None):
-        """Обновить настройки пользователя"""
+        # Таблица логов взаимодействия с ботом
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS user_logs (
+                id SERIAL PRIMARY KEY,
+                user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+                action VARCHAR(255),
+                message_text TEXT,
+                command VARCHAR(100),
+                source VARCHAR(20),
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Таблица логов парсинга
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS parsing_logs (
+                id SERIAL PRIMARY KEY,
+                source VARCHAR(20) NOT NULL CHECK (source IN ('avito', 'kufar')),
+                city VARCHAR(100),
+                model VARCHAR(100),
+                pages_parsed INTEGER DEFAULT 0,
+                ads_found INTEGER DEFAULT 0,
+                ads_processed INTEGER DEFAULT 0,
+                ads_sent INTEGER DEFAULT 0,
+                errors_count INTEGER DEFAULT 0,
+                duration_seconds DECIMAL(10, 2),
+                status VARCHAR(50) DEFAULT 'completed',
+                error_message TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # История запусков задач планировщика
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS scheduler_runs (
+                id SERIAL PRIMARY KEY,
+                job_name VARCHAR(100) NOT NULL,
+                started_at TIMESTAMP NOT NULL,
+                duration_seconds DECIMAL(10, 2),
+                status VARCHAR(50) NOT NULL,
+                error_message TEXT
+            )
+        """)
+
+        # Единицы парсинга (источник, город) для координации нескольких экземпляров
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS scrape_units (
+                source VARCHAR(20) NOT NULL,
+                city VARCHAR(100) NOT NULL,
+                last_started_at TIMESTAMP NOT NULL,
+                PRIMARY KEY (source, city)
+            )
+        """)
+
+        # Миграция: добавляем колонки command и source если их нет
         try:
-            updates = []
-            params = []
-            
-            if city is not None:
-                updates.append("city = %s")
-                params.append(city)
-            if model is not None:
-                updates.append("model = %s")
-                params.append(model)
-            if max_price is not None:
-                updates.append("max_price = %s")
-                params.append(max_price)
-            if is_active is not None:
-                updates.append("is_active = %s")
-                params.append(is_active)
-            if source is not None:
-                updates.append("source = %s")
-                params.append(source)
-            
-            if updates:
-                updates.append("updated_at = CURRENT_TIMESTAMP")
-                params.append(user_id)
-                
-                with self.conn.cursor() as cur:
-                    cur.execute(f"""
-                        UPDATE users 
-                        SET {', '.join(updates)}
-                        WHERE user_id = %s
-                    """, params)
-                    self.conn.commit()
-                    logger.info(f"Настройки пользователя {user_id} обновлены")
+            cur.execute("""
+                DO $$ 
+                BEGIN 
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='user_logs' AND column_name='command'
+                    ) THEN
+                        ALTER TABLE user_logs ADD COLUMN command VARCHAR(100);
+                    END IF;
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='user_logs' AND column_name='source'
+                    ) THEN
+                        ALTER TABLE user_logs ADD COLUMN source VARCHAR(20);
+                    END IF;
+                END $$;
+            """)
         except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка обновления настроек: {e}")
-            raise
+            logger.warning(f"Не удалось добавить колонки в user_logs: {e}")
+
+        # Таблица объявлений (секции по месяцам создаются в _ensure_partitions)
+        cur.execute(ADVERTISEMENTS_DDL)
+
+        # Реестр объявлений: дата создания определяет секцию строки в advertisements
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS advertisement_keys (
+                source VARCHAR(20) NOT NULL,
+                external_id VARCHAR(100) NOT NULL,
+                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (source, external_id)
+            )
+        """)
 
-    def get_user_settings(self, user_id: int) -> Optional[Dict]:
-        """Получить настройки пользователя"""
+        # Миграция: avito_id/kufar_id -> единая колонка external_id с одним уникальным ключом
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT * FROM users WHERE user_id = %s
-                """, (user_id,))
-                result = cur.fetchone()
-                return dict(result) if result else None
+            cur.execute("""
+                DO $$ 
+                BEGIN 
+                    IF EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='advertisements' AND column_name='avito_id'
+                    ) THEN
+                        ALTER TABLE advertisements ADD COLUMN IF NOT EXISTS external_id VARCHAR(100);
+                        UPDATE advertisements
+                        SET external_id = CASE WHEN source = 'avito' THEN avito_id ELSE kufar_id END
+                        WHERE external_id IS NULL;
+                        -- Строки без ID источника не могли участвовать в upsert'е
+                        DELETE FROM advertisements WHERE external_id IS NULL;
+                        ALTER TABLE advertisements ALTER COLUMN external_id SET NOT NULL;
+                        ALTER TABLE advertisements
+                            ADD CONSTRAINT advertisements_source_external_id_key UNIQUE (source, external_id);
+                        -- Вместе с колонками удаляются их UNIQUE-ограничения
+                        ALTER TABLE advertisements DROP COLUMN avito_id, DROP COLUMN kufar_id;
+                    END IF;
+                END $$;
+            """)
         except Exception as e:
-            logger.error(f"Ошибка получения настроек пользователя: {e}")
-            return None
+            logger.warning(f"Не удалось перенести ID объявлений в external_id: {e}")
 
-    def get_active_users(self, source: str = None) -> List[Dict]:
-        """Получить список активных пользователей"""
+        # Миграция: добавляем колонки для валют если их нет
         try:
-            with self.conn.cursor(cursor_factory=RealDictCursor) as cur:
-                if source:
-                    cur.execute("""
-                        SELECT * FROM users WHERE is_active = TRUE AND source = %s
-                    """, (source,))
-                else:
-                    cur.execute("""
-                        SELECT * FROM users WHERE is_active = TRUE
-                    """)
-                return [dict(row) for row in cur.fetchall()]
+            cur.execute("""
+                DO $$ 
+                BEGIN 
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='advertisements' AND column_name='price_rub'
+                    ) THEN
+                        ALTER TABLE advertisements ADD COLUMN price_rub DECIMAL(10, 2);
+                    END IF;
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='advertisements' AND column_name='price_byn'
+                    ) THEN
+                        ALTER TABLE advertisements ADD COLUMN price_byn DECIMAL(10, 2);
+                    END IF;
+                END $$;
+            """)
         except Exception as e:
-            logger.error(f"Ошибка получения активных пользователей: {e}")
-            return []
+            logger.warning(f"Не удалось добавить колонки валют в advertisements: {e}")
+
+        # Предрассчитанные пороги выгодности (обновляются вместе с медианами)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS deal_thresholds (
+                source VARCHAR(20) NOT NULL CHECK (source IN ('avito', 'kufar')),
+                city VARCHAR(100) NOT NULL,
+                model VARCHAR(100) NOT NULL,
+                median_price DECIMAL(10, 2) NOT NULL,
+                price_ceiling INTEGER NOT NULL,
+                sample_size INTEGER,
+                outliers_removed INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (source, city, model)
+            )
+        """)
 
-    def add_advertisement(self, ad_id: str, price: int, model: str, 
-                         city: str, memory: str, url: str, source: str,
-                         median_price: float = None, price_difference: float = None,
-                         notified: bool = False):
-        """Добавить объявление в базу данных"""
+        # Миграция: размер выборки медианы для порогов, созданных до его появления
         try:
-            # Конвертируем валюты
-            from utils.currency_converter import convert_byn_to_rub, convert_rub_to_byn
-            
-            if source == 'avito':
-                price_rub = float(price)
-                price_byn = convert_rub_to_byn(price)
-            else:  # kufar
-                price_byn = float(price)
-                price_rub = convert_byn_to_rub(price)
-            
-            with self.conn.cursor() as cur:
-                if source == 'avito':
-                    cur.execute("""
-                        INSERT INTO advertisements 
-                        (avito_id, source, price, price_rub, price_byn, model, city, memory, url, median_price, price_difference, notified)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (avito_id, source) DO UPDATE SET
-                            price = EXCLUDED.price,
-                            price_rub = EXCLUDED.price_rub,
-                            price_byn = EXCLUDED.price_byn,
-                            memory = EXCLUDED.memory,
-                            median_price = EXCLUDED.median_price,
-                            price_difference = EXCLUDED.price_difference,
-                            updated_at = CURRENT_TIMESTAMP
-                    """, (ad_id, source, price, price_rub, price_byn, model, city, memory, url, median_price, price_difference, notified))
-                elif source == 'kufar':
-                    cur.execute("""
-                        INSERT INTO advertisements 
-                        (kufar_id, source, price, price_rub, price_byn, model, city, memory, url, median_price, price_difference, notified)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT (kufar_id, source) DO UPDATE SET
-                            price = EXCLUDED.price,
-                            price_rub = EXCLUDED.price_rub,
-                            price_byn = EXCLUDED.price_byn,
-                            memory = EXCLUDED.memory,
-                            median_price = EXCLUDED.median_price,
-                            price_difference = EXCLUDED.price_difference,
-                            updated_at = CURRENT_TIMESTAMP
-                    """, (ad_id, source, price, price_rub, price_byn, model, city, memory, url, median_price, price_difference, notified))
-                self.conn.commit()
-                return True
+            cur.execute("""
+                ALTER TABLE deal_thresholds ADD COLUMN IF NOT EXISTS sample_size INTEGER;
+                ALTER TABLE deal_thresholds ADD COLUMN IF NOT EXISTS outliers_removed INTEGER DEFAULT 0;
+            """)
         except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка добавления объявления: {e}")
-            return False
-    
-    def mark_advertisement_notified(self, ad_id: str, source: str):
-        """Пометить объявление как отправленное"""
+            logger.warning(f"Не удалось добавить колонки выборки в deal_thresholds: {e}")
+
+        # История цен объявлений (append-only, строка пишется только при изменении цены)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ad_price_history (
+                id SERIAL PRIMARY KEY,
+                source VARCHAR(20) NOT NULL CHECK (source IN ('avito', 'kufar')),
+                external_id VARCHAR(100) NOT NULL,
+                price INTEGER NOT NULL,
+                previous_price INTEGER,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+        # Отправки объявлений пользователям (заменяют общий флаг advertisements.notified)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS deliveries (
+                user_id BIGINT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+                source VARCHAR(20) NOT NULL CHECK (source IN ('avito', 'kufar')),
+                external_id VARCHAR(100) NOT NULL,
+                sent_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, source, external_id)
+            )
+        """)
+
+        # Миграция: счетчик отправленных объявлений пользователя (ведется при записи в deliveries)
+        # и удаление общего флага notified - он не позволял отправить объявление второму пользователю.
+        # Уже отправленные объявления переносятся в deliveries по тому же совпадению города
+        # и модели, по которому их считал старый профиль, иначе после обновления они
+        # ушли бы всем подходящим пользователям повторно
         try:
-            with self.conn.cursor() as cur:
-                if source == 'avito':
-                    cur.execute("""
-                        UPDATE advertisements
-                        SET notified = TRUE, updated_at = CURRENT_TIMESTAMP
-                        WHERE avito_id = %s AND source = %s
-                    """, (ad_id, source))
-                elif source == 'kufar':
-                    cur.execute("""
-                        UPDATE advertisements
-                        SET notified = TRUE, updated_at = CURRENT_TIMESTAMP
-                        WHERE kufar_id = %s AND source = %s
-                    """, (ad_id, source))
-                self.conn.commit()
+            cur.execute("""
+                ALTER TABLE users ADD COLUMN IF NOT EXISTS sent_ads_count INTEGER NOT NULL DEFAULT 0;
+                DO $$ 
+                BEGIN 
+                    IF EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='advertisements' AND column_name='notified'
+                    ) THEN
+                        ALTER TABLE deliveries ADD COLUMN IF NOT EXISTS sent_price INTEGER;
+                        INSERT INTO deliveries (user_id, source, external_id, sent_at, sent_price)
+                        SELECT u.user_id, a.source, a.external_id,
+                               COALESCE(a.updated_at, a.created_at, CURRENT_TIMESTAMP), a.price
+                        FROM advertisements a
+                        JOIN users u
+                          ON u.city = a.city
+                         AND (u.model = a.model OR u.model IS NULL)
+                        WHERE a.notified = TRUE
+                        ON CONFLICT DO NOTHING;
+                        UPDATE users u
+                        SET sent_ads_count = d.sent
+                        FROM (SELECT user_id, COUNT(*) AS sent FROM deliveries GROUP BY user_id) d
+                        WHERE u.user_id = d.user_id;
+                        ALTER TABLE advertisements DROP COLUMN notified;
+                    END IF;
+                END $$;
+            """)
         except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка пометки объявления как отправленного: {e}")
-    
-    def is_advertisement_notified(self, ad_id: str, source: str) -> bool:
-        """Проверить было ли объявление отправлено"""
+            logger.warning(f"Не удалось перейти на таблицу deliveries: {e}")
+
+        # Миграция: счетчики профиля, которые ведутся при записи user_logs.
+        # При первом добавлении заполняются по уже накопленным логам
         try:
-            with self.conn.cursor() as cur:
-                if source == 'avito':
-                    cur.execute("""
-                        SELECT notified FROM advertisements
-                        WHERE avito_id = %s AND source = %s
-                    """, (ad_id, source))
-                elif source == 'kufar':
-                    cur.execute("""
-                        SELECT notified FROM advertisements
-                        WHERE kufar_id = %s AND source = %s
-                    """, (ad_id, source))
-                else:
-                    return False
-                
-                result = cur.fetchone()
-                return result[0] if result else False
+            cur.execute("""
+                DO $$ 
+                BEGIN 
+                    IF NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns 
+                        WHERE table_name='users' AND column_name='actions_count'
+                    ) THEN
+                        ALTER TABLE users ADD COLUMN actions_count INTEGER NOT NULL DEFAULT 0;
+                        ALTER TABLE users ADD COLUMN button_clicks INTEGER NOT NULL DEFAULT 0;
+                        UPDATE users u
+                        SET actions_count = l.actions_count, button_clicks = l.button_clicks
+                        FROM (
+                            SELECT user_id,
+                                   COUNT(*) AS actions_count,
+                                   COUNT(*) FILTER (WHERE command = 'button') AS button_clicks
+                            FROM user_logs
+                            GROUP BY user_id
+                        ) l
+                        WHERE u.user_id = l.user_id;
+                    END IF;
+                END $$;
+            """)
         except Exception as e:
-            logger.error(f"Ошибка проверки статуса объявления: {e}")
-            return False
-    
-    def get_advertisement_created_at(self, ad_id: str, source: str):
-        """Получить дату создания объявления"""
+            logger.warning(f"Не удалось добавить счетчики профиля в users: {e}")
+
+        # Старая несекционированная таблица переносится в секции
+        self._migrate_advertisements_to_partitions(cur)
+        self._ensure_partitions(cur)
+
+        # Индексы создаются после всех таблиц и миграций колонок
+        self._ensure_indexes(cur)
+
+        # Сводка аналитики создается последней - она читает все таблицы
+        cur.execute(ANALYTICS_VIEW_DDL)
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_analytics_summary_id ON analytics_summary(id)")
+
+        # Устанавливаем админа (пользователь 8507895419)
         try:
-            with self.conn.cursor() as cur:
-                if source == 'avito':
-                    cur.execute("""
-                        SELECT created_at FROM advertisements
-                        WHERE avito_id = %s AND source = %s
-                    """, (ad_id, source))
-                elif source == 'kufar':
-                    cur.execute("""
-                        SELECT created_at FROM advertisements
-                        WHERE kufar_id = %s AND source = %s
-                    """, (ad_id, source))
-                else:
-                    return None
-                
-                result = cur.fetchone()
-                return result[0] if result else None
+            from config import ADMIN_USER_ID
+            cur.execute("""
+                UPDATE users SET is_admin = TRUE 
+                WHERE user_id = %s
+            """, (ADMIN_USER_ID,))
         except Exception as e:
-            logger.error(f"Ошибка получения даты объявления: {e}")
-            return None
+            logger.warning(f"Не удалось установить админа: {e}")
+
+    def _migration_002_analytics_top_users_from_counters(self, cur):
+        """Сводка аналитики: топ пользователей по users.actions_count вместо join с user_logs"""
+        cur.execute("DROP MATERIALIZED VIEW IF EXISTS analytics_summary")
+        cur.execute(ANALYTICS_VIEW_DDL)
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_analytics_summary_id ON analytics_summary(id)")
+
+    def _migration_003_ad_daily_stats(self, cur):
+        """Дневная статистика объявлений - хранится бессрочно после удаления старых секций"""
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS ad_daily_stats (
+                day DATE NOT NULL,
+                source VARCHAR(20) NOT NULL,
+                city VARCHAR(100) NOT NULL,
+                model VARCHAR(100) NOT NULL,
+                ads_count INTEGER NOT NULL,
+                min_price INTEGER,
+                avg_price DECIMAL(10, 2),
+                median_price DECIMAL(10, 2),
+                PRIMARY KEY (day, source, city, model)
+            )
+        """)
+
+    def _migration_004_brin_and_partial_indexes(self, cur):
+        """BRIN по времени для журналов и объявлений, частичный индекс активных пользователей"""
+        self._ensure_indexes(cur)
+
+    def _migration_005_users_changed_notify(self, cur):
+        """
+        NOTIFY users_changed с user_id при изменении профиля или настроек пользователя
+
+        По уведомлениям AsyncDatabase обновляет свой кэш пользователей. Счетчики
+        (sent_ads_count, actions_count, button_clicks) в список колонок не входят:
+        их частые обновления уведомлений не порождают.
+        """
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION notify_users_changed() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('users_changed', COALESCE(NEW.user_id, OLD.user_id)::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS users_changed_notify ON users")
+        cur.execute("""
+            CREATE TRIGGER users_changed_notify
+            AFTER INSERT OR DELETE OR UPDATE OF
+                username, nickname, first_name, last_name, city, model,
+                max_price, source, is_active, is_admin
+            ON users
+            FOR EACH ROW EXECUTE FUNCTION notify_users_changed()
+        """)
+
+    def _migration_006_deliveries_sent_price(self, cur):
+        """Цена, по которой объявление отправлено пользователю: снижение считается от нее"""
+        cur.execute("ALTER TABLE deliveries ADD COLUMN IF NOT EXISTS sent_price INTEGER")
 
-    def advertisement_exists(self, ad_id: str, source: str) -> bool:
-        """Проверить существует ли объявление"""
+    def _migration_007_spool_replayed(self, cur):
+        """Записи локального журнала, уже воспроизведенные в базу (защита от повторной записи)"""
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS spool_replayed (
+                record_id VARCHAR(32) PRIMARY KEY,
+                replayed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    def _migration_008_analytics_sent_ads_distinct(self, cur):
+        """Сводка аналитики: sent_ads считает различные отправленные объявления, а не отправки"""
+        cur.execute("DROP MATERIALIZED VIEW IF EXISTS analytics_summary")
+        cur.execute(ANALYTICS_VIEW_DDL)
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_analytics_summary_id ON analytics_summary(id)")
+
+    def _migration_009_drop_unused_brin_indexes(self, cur):
+        """Удалить BRIN по времени объявлений и отправок (см. RETIRED_INDEXES)"""
+        self._ensure_indexes(cur)
+
+    def _migrate_advertisements_to_partitions(self, cur):
+        """
+        Перенести данные из несекционированной advertisements в секционированную
+
+        Старая таблица переименовывается вместе с индексами (имена индексов
+        общие для схемы), данные копируются в помесячные секции, реестр
+        advertisement_keys заполняется из них же.
+        """
+        cur.execute("""
+            SELECT relkind FROM pg_class
+            WHERE oid = to_regclass('advertisements')
+        """)
+        row = cur.fetchone()
+        if not row or row[0] != 'r':
+            return
+        
+        logger.info("Перенос advertisements в помесячные секции...")
+        cur.execute("ALTER TABLE advertisements RENAME TO advertisements_unpartitioned")
+        cur.execute("""
+            DO $$
+            DECLARE
+                idx TEXT;
+            BEGIN
+                FOR idx IN
+                    SELECT c.relname FROM pg_index i
+                    JOIN pg_class c ON c.oid = i.indexrelid
+                    WHERE i.indrelid = 'advertisements_unpartitioned'::regclass
+                LOOP
+                    EXECUTE format('ALTER INDEX %I RENAME TO %I', idx, left(idx, 48) || '_unpartitioned');
+                END LOOP;
+            END $$;
+        """)
+        cur.execute(ADVERTISEMENTS_DDL)
+        
+        cur.execute("SELECT MIN(created_at) FROM advertisements_unpartitioned")
+        oldest = cur.fetchone()[0]
+        self._ensure_partitions(cur, since=oldest)
+        
+        cur.execute("""
+            INSERT INTO advertisements
+            (id, source, external_id, price, price_rub, price_byn, model, city, memory, url,
+             median_price, price_difference, created_at, updated_at)
+            SELECT id, source, external_id, price, price_rub, price_byn, model, city, memory, url,
+                   median_price, price_difference,
+                   COALESCE(created_at, updated_at, CURRENT_TIMESTAMP), updated_at
+            FROM advertisements_unpartitioned
+        """)
+        moved = cur.rowcount
+        cur.execute("""
+            INSERT INTO advertisement_keys (source, external_id, created_at)
+            SELECT source, external_id, created_at FROM advertisements
+            ON CONFLICT (source, external_id) DO NOTHING
+        """)
+        cur.execute("""
+            SELECT setval(pg_get_serial_sequence('advertisements', 'id'),
+                          COALESCE((SELECT MAX(id) FROM advertisements), 0) + 1, false)
+        """)
+        cur.execute("DROP TABLE advertisements_unpartitioned")
+        logger.info(f"Перенесено объявлений в секции: {moved}")
+
+    def _ensure_partitions(self, cur, since: datetime = None) -> List[str]:
+        """
+        Создать недостающие помесячные секции advertisements
+
+        Создаются секции от месяца since (по умолчанию текущего) до
+        ADS_PARTITION_MONTHS_AHEAD месяцев вперед.
+
+        Returns:
+            Имена созданных секций
+        """
+        now = datetime.now()
+        month = _month_start(since or now)
+        last = _month_start(now, ADS_PARTITION_MONTHS_AHEAD)
+        
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'advertisements'::regclass
+        """)
+        existing = {row[0] for row in cur.fetchall()}
+        
+        created = []
+        while month <= last:
+            name = f"advertisements_{month:%Y_%m}"
+            if name not in existing:
+                cur.execute(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF advertisements "
+                    f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{_month_start(month, 1):%Y-%m-%d}')"
+                )
+                created.append(name)
+            month = _month_start(month, 1)
+        
+        if created:
+            logger.info(f"Созданы секции объявлений: {', '.join(created)}")
+        return created
+
+    def ensure_partitions(self) -> List[str]:
+        """Создать секции объявлений на ближайшие месяцы (задача планировщика)"""
         try:
-            with self.conn.cursor() as cur:
-                if source == 'avito':
-                    cur.execute("""
-                        SELECT 1 FROM advertisements WHERE avito_id = %s AND source = %s
-                    """, (ad_id, source))
-                elif source == 'kufar':
-                    cur.execute("""
-                        SELECT 1 FROM advertisements WHERE kufar_id = %s AND source = %s
-                    """, (ad_id, source))
-                else:
-                    return False
-                return cur.fetchone() is not None
+            with self.cursor() as cur:
+                return self._ensure_partitions(cur)
         except Exception as e:
-            logger.error(f"Ошибка проверки объявления: {e}")
-            return False
+            logger.error(f"Ошибка создания секций объявлений: {e}")
+            return []
 
-    def calculate_median_price(self, city: str, model: str, source: str = None) -> Optional[float]:
+    def list_ad_partitions(self, cur) -> List[tuple]:
         """
-        Рассчитать медианную цену для модели в городе
-        ВНИМАНИЕ: Используйте MedianPriceCalculator для оптимизированного расчета
+        Помесячные секции advertisements по возрастанию
+
+        Returns:
+            [(имя, начало месяца, начало следующего месяца), ...]
+        """
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'advertisements'::regclass
+            ORDER BY c.relname
+        """)
+        partitions = []
+        for (name,) in cur.fetchall():
+            match = ADS_PARTITION_NAME.match(name)
+            if match:
+                start = datetime(int(match.group(1)), int(match.group(2)), 1)
+                partitions.append((name, start, _month_start(start, 1)))
+        return partitions
+
+    def detach_partitions_before(self, cutoff: datetime, drop: bool = False, before_detach=None,
+                                 stop_event: threading.Event = None) -> List[str]:
         """
+        Отсоединить секции объявлений, целиком лежащие раньше cutoff
+
+        Args:
+            before_detach: Вызывается как before_detach(cur, name) перед отсоединением
+                           секции в той же транзакции (свертка, архив)
+            stop_event: Установленное событие прерывает отсоединение перед следующей секцией
+
+        Вместе с секцией удаляются ключи ее объявлений и отправки этих объявлений.
+
+        Returns:
+            Имена отсоединенных секций
+        """
+        detached = []
         try:
-            with self.conn.cursor() as cur:
-                if source:
-                    cur.execute("""
-                        SELECT PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY price) as median
-                        FROM advertisements
-                        WHERE city = %s AND model = %s AND source = %s
-                    """, (city, model, source))
-                else:
+            for name, _, partition_end in self._partitions_before(cutoff):
+                if stop_event is not None and stop_event.is_set():
+                    logger.warning(f"Отсоединение секций объявлений прервано перед {name}")
+                    break
+                # Каждая секция - отдельная транзакция: короткие блокировки каталога
+                with self.cursor() as cur:
+                    if before_detach:
+                        before_detach(cur, name)
+                    cur.execute(f"ALTER TABLE advertisements DETACH PARTITION {name}")
+                    if drop:
+                        cur.execute(f"DROP TABLE {name}")
+                    # Ключи отсоединенных объявлений указывают на секцию, которой больше нет;
+                    # отправки удаляются вместе с ключами, а не по своему sent_at: иначе
+                    # объявление, еще живущее в базе, снова уйдет пользователю
                     cur.execute("""
-                        SELECT PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY price) as median
-                        FROM advertisements
-                        WHERE city = %s AND model = %s
-                    """, (city, model))
-                result = cur.fetchone()
-                return float(result[0]) if result and result[0] else None
+                        WITH pruned AS (
+                            DELETE FROM advertisement_keys WHERE created_at < %s
+                            RETURNING source, external_id
+                        )
+                        DELETE FROM deliveries d USING pruned p
+                        WHERE d.source = p.source AND d.external_id = p.external_id
+                    """, (partition_end,))
+                detached.append(name)
+            if detached:
+                logger.info(f"Отсоединены секции объявлений: {', '.join(detached)}")
+            return detached
         except Exception as e:
-            logger.error(f"Ошибка расчета медианной цены: {e}")
-            return None
+            logger.error(f"Ошибка отсоединения секций объявлений: {e}")
+            return detached
 
-    def update_median_prices(self, city: str, model: str, source: str = None):
-        """Обновить медианные цены для всех объявлений модели в городе"""
+    def _partitions_before(self, cutoff: datetime) -> List[tuple]:
+        """Секции объявлений, конец которых не позже cutoff"""
+        with self.cursor() as cur:
+            return [partition for partition in self.list_ad_partitions(cur) if partition[2] <= cutoff]
+
+    def _ensure_indexes(self, cur):
+        """Создать недостающие индексы из MANAGED_INDEXES и удалить RETIRED_INDEXES"""
+        for name in RETIRED_INDEXES:
+            cur.execute(f"DROP INDEX IF EXISTS {name}")
+        for name, definition in MANAGED_INDEXES.items():
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} {definition}")
+
+    def get_deal_thresholds(self, key: Optional[tuple] = None) -> Dict[tuple, Dict]:
+        """
+        Получить пороги выгодности
+
+        Args:
+            key: (source, city, model) - только порог этой комбинации
+
+        Returns:
+            {(source, city, model): {'median_price', 'price_ceiling', 'sample_size', 'outliers_removed'}}
+        """
         try:
-            median_price = self.calculate_median_price(city, model, source)
-            if median_price:
-                with self.conn.cursor() as cur:
-                    if source:
-                        cur.execute("""
-                            UPDATE advertisements
-                            SET median_price = %s,
-                                price_difference = %s - price,
-                                updated_at = CURRENT_TIMESTAMP
-                            WHERE city = %s AND model = %s AND source = %s
-                        """, (median_price, median_price, city, model, source))
-                    else:
-                        cur.execute("""
-                            UPDATE advertisements
-                            SET median_price = %s,
-                                price_difference = %s - price,
-                                updated_at = CURRENT_TIMESTAMP
-                            WHERE city = %s AND model = %s
-                        """, (median_price, median_price, city, model))
-                    self.conn.commit()
-                    return median_price
-            return None
+            with self.cursor(RealDictCursor) as cur:
+                query = """
+                    SELECT source, city, model, median_price, price_ceiling, sample_size, outliers_removed
+                    FROM deal_thresholds
+                """
+                if key:
+                    cur.execute(query + " WHERE source = %s AND city = %s AND model = %s", key)
+                else:
+                    cur.execute(query)
+                return {
+                    (row['source'], row['city'], row['model']): {
+                        'median_price': float(row['median_price']),
+                        'price_ceiling': row['price_ceiling'],
+                        'sample_size': row['sample_size'],
+                        'outliers_removed': row['outliers_removed'] or 0,
+                    }
+                    for row in cur.fetchall()
+                }
         except Exception as e:
-            self.conn.rollback()
-            logger.error(f"Ошибка обновления медианных цен: {e}")
-            return None
+            logger.error(f"Ошибка получения порогов выгодности: {e}")
+            return {}
 
     def close(self):
-        """Закрыть соединение с базой данных"""
-        if self.conn:
-            self.conn.close()
+        """Закрыть все соединения с базой данных"""
+        if self.pool:
+            self.pool.closeall()
             logger.info("Соединение с базой данных закрыто")
-
-
@@ -5,6 +5,7 @@ import asyncio
 import logging
 import sys
 from database import Database
+from async_database import AsyncDatabase
 from bot_avito import AvitoTelegramBot
 from bot_kufar import KufarTelegramBot
 from services.parser_service import ParserService
@@ -24,6 +25,8 @@ logger = main_logger
 async def main():
     """Главная функция"""
     db = None
+    async_db = None
+    median_calculator = None
     avito_bot = None
     kufar_bot = None
     parser_service = None
@@ -34,6 +37,8 @@ async def main():
         logger.info("=" * 60)
         logger.info("Инициализация базы данных...")
         db = Database(DB_CONFIG)
+        async_db = AsyncDatabase(DB_CONFIG)
+        await async_db.open()
         logger.info("База данных инициализирована успешно")
         
         # Инициализируем калькулятор медианных цен
@@ -49,18 +54,18 @@ async def main():
         
         # Инициализируем ботов
         logger.info("Инициализация Telegram ботов...")
-        avito_bot = AvitoTelegramBot(TELEGRAM_AVITO_BOT_TOKEN, db)
-        kufar_bot = KufarTelegramBot(TELEGRAM_KUFAR_BOT_TOKEN, db)
+        avito_bot = AvitoTelegramBot(TELEGRAM_AVITO_BOT_TOKEN, async_db, median_calculator)
+        kufar_bot = KufarTelegramBot(TELEGRAM_KUFAR_BOT_TOKEN, async_db)
         logger.info("Боты инициализированы")
         
         # Инициализируем сервис парсинга
         logger.info("Инициализация сервиса парсинга...")
-        parser_service = ParserService(db, avito_bot, kufar_bot, median_calculator)
+        parser_service = ParserService(async_db, avito_bot, kufar_bot, median_calculator)
         logger.info("Сервис парсинга инициализирован")
         
         # Инициализируем планировщик
         logger.info("Инициализация планировщика задач...")
-        scheduler_service = SchedulerService(median_calculator)
+        scheduler_service = SchedulerService(median_calculator, async_db)
         logger.info("Планировщик задач инициализирован")
         
         # Инициализируем ботов (создаем application)
@@ -141,6 +146,12 @@ async def main():
             except Exception as e:
                 logger.error(f"Ошибка при остановке бота Kufar: {e}")
         
+        if median_calculator:
+            median_calculator.close()
+        
+        if async_db:
+            await async_db.close()
+        
         if db:
             db.close()
             logger.info("Соединение с базой данных закрыто")
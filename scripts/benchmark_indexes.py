@@ -0,0 +1,178 @@
+"""
+Бенчмарк BRIN и частичных индексов на синтетических данных
+
+Создает во временной схеме таблицы объявлений (5 млн строк, created_at по
+возрастанию - как при реальной вставке) и пользователей (доля активных мала),
+замеряет запросы по диапазону времени и по активным пользователям до и после
+создания индексов, печатает время выполнения и размеры индексов.
+Схема удаляется после замера.
+
+Запуск: python scripts/benchmark_indexes.py [--rows 5000000] [--users 200000]
+"""
+import argparse
+import os
+import sys
+import time
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+from config.main import DB_CONFIG
+
+SCHEMA = 'bench_indexes'
+
+QUERIES = {
+    'ads_last_day': (
+        f"SELECT COUNT(*), AVG(price) FROM {SCHEMA}.advertisements "
+        f"WHERE created_at >= (SELECT MAX(created_at) FROM {SCHEMA}.advertisements) - INTERVAL '1 day'"
+    ),
+    'logs_week_range': (
+        f"SELECT action, COUNT(*) FROM {SCHEMA}.user_logs "
+        f"WHERE created_at BETWEEN NOW() - INTERVAL '60 days' AND NOW() - INTERVAL '53 days' "
+        f"GROUP BY action"
+    ),
+    'active_users_source': (
+        f"SELECT * FROM {SCHEMA}.users WHERE is_active = TRUE AND source = 'avito'"
+    ),
+}
+
+# Было: B-tree по created_at и по булеву is_active; стало: BRIN и частичный индекс
+BTREE_INDEXES = [
+    f"CREATE INDEX bench_ads_created_btree ON {SCHEMA}.advertisements(created_at)",
+    f"CREATE INDEX bench_logs_created_btree ON {SCHEMA}.user_logs(created_at)",
+    f"CREATE INDEX bench_users_active ON {SCHEMA}.users(is_active)",
+]
+NEW_INDEXES = [
+    f"CREATE INDEX bench_ads_created_brin ON {SCHEMA}.advertisements USING brin (created_at)",
+    f"CREATE INDEX bench_logs_created_brin ON {SCHEMA}.user_logs USING brin (created_at)",
+    f"CREATE INDEX bench_users_active_source ON {SCHEMA}.users(source) WHERE is_active",
+]
+
+
+def create_data(cur, rows: int, users: int):
+    """Синтетические таблицы: строки вставляются в порядке времени, как в рабочей базе"""
+    cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"""
+        CREATE TABLE {SCHEMA}.advertisements AS
+        SELECT g AS id,
+               (ARRAY['avito', 'kufar'])[1 + mod(g, 2)] AS source,
+               'iPhone ' || (11 + mod(g, 6)) AS model,
+               20000 + mod(g::bigint * 7919, 80000) AS price,
+               NOW() - INTERVAL '180 days' + g * (INTERVAL '180 days' / %s) AS created_at
+        FROM generate_series(1, %s) AS g
+    """, (rows, rows))
+    cur.execute(f"""
+        CREATE TABLE {SCHEMA}.user_logs AS
+        SELECT g AS id,
+               1 + mod(g, {users}) AS user_id,
+               (ARRAY['start', 'settings', 'search', 'click'])[1 + mod(g, 4)] AS action,
+               NOW() - INTERVAL '180 days' + g * (INTERVAL '180 days' / %s) AS created_at
+        FROM generate_series(1, %s) AS g
+    """, (rows, rows))
+    # Активных пользователей около 2%: горячее подмножество
+    cur.execute(f"""
+        CREATE TABLE {SCHEMA}.users AS
+        SELECT g AS user_id,
+               (ARRAY['avito', 'kufar'])[1 + mod(g, 2)] AS source,
+               (mod(g, 50) = 0) AS is_active,
+               'settings' AS payload
+        FROM generate_series(1, %s) AS g
+    """, (users,))
+    for table in ('advertisements', 'user_logs', 'users'):
+        cur.execute(f"VACUUM ANALYZE {SCHEMA}.{table}")
+
+
+def measure(cur, repeats: int) -> dict:
+    """Лучшее время выполнения каждого запроса (мс) по EXPLAIN ANALYZE"""
+    results = {}
+    for name, query in QUERIES.items():
+        best = None
+        plan_node = None
+        for _ in range(repeats):
+            cur.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) {query}")
+            plan = cur.fetchone()[0][0]
+            elapsed = plan['Execution Time']
+            if best is None or elapsed < best:
+                best = elapsed
+                plan_node = _scan_types(plan['Plan'])
+        results[name] = (best, plan_node)
+    return results
+
+
+def _scan_types(node: dict) -> str:
+    """Типы сканирования в плане (для наглядности: Seq Scan / Bitmap Heap Scan / Index Scan)"""
+    return ', '.join(dict.fromkeys(_collect_scans(node)))
+
+
+def _collect_scans(node: dict) -> list:
+    scans = [node['Node Type']] if 'Scan' in node['Node Type'] else []
+    for child in node.get('Plans', []):
+        scans.extend(_collect_scans(child))
+    return scans
+
+
+def index_sizes(cur, prefix: str) -> dict:
+    """Размеры индексов бенчмарка"""
+    cur.execute("""
+        SELECT indexname, pg_size_pretty(pg_relation_size(format('%%I.%%I', schemaname, indexname)::regclass))
+        FROM pg_indexes
+        WHERE schemaname = %s AND indexname LIKE %s
+        ORDER BY indexname
+    """, (SCHEMA, prefix + '%'))
+    return dict(cur.fetchall())
+
+
+def print_results(title: str, results: dict, sizes: dict):
+    print(f"\n{title}")
+    for name, (elapsed, scans) in results.items():
+        print(f"  {name:<22} {elapsed:>10.2f} мс   {scans}")
+    for name, size in sizes.items():
+        print(f"  индекс {name:<30} {size}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк BRIN и частичных индексов')
+    parser.add_argument('--rows', type=int, default=5_000_000, help='строк в объявлениях и журнале')
+    parser.add_argument('--users', type=int, default=200_000, help='строк в пользователях')
+    parser.add_argument('--repeats', type=int, default=5, help='повторов каждого запроса')
+    parser.add_argument('--keep', action='store_true', help='не удалять схему после замера')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(**DB_CONFIG)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            started = time.monotonic()
+            create_data(cur, args.rows, args.users)
+            print(f"Данные созданы за {time.monotonic() - started:.1f} с "
+                  f"({args.rows} строк, {args.users} пользователей)")
+
+            for statement in BTREE_INDEXES:
+                cur.execute(statement)
+            before = measure(cur, args.repeats)
+            print_results('До (B-tree по created_at и is_active):', before, index_sizes(cur, 'bench_'))
+
+            for statement in BTREE_INDEXES:
+                cur.execute(f"DROP INDEX {SCHEMA}.{statement.split()[2]}")
+            for statement in NEW_INDEXES:
+                cur.execute(statement)
+            for table in ('advertisements', 'user_logs', 'users'):
+                cur.execute(f"ANALYZE {SCHEMA}.{table}")
+            after = measure(cur, args.repeats)
+            print_results('После (BRIN по created_at, частичный WHERE is_active):', after, index_sizes(cur, 'bench_'))
+
+            print('\nИтог:')
+            for name in QUERIES:
+                was, now = before[name][0], after[name][0]
+                print(f"  {name:<22} {was:>10.2f} -> {now:>10.2f} мс  (x{was / now if now else 0:.1f})")
+    finally:
+        if not args.keep:
+            with conn.cursor() as cur:
+                cur.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
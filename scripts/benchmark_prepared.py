@@ -0,0 +1,89 @@
+"""
+Микробенчмарк подготовленных запросов
+
+Сравнивает время одного вызова запроса окна медианы, отправляемого полным
+текстом (разбор и планирование на каждом вызове), и того же запроса через
+Database.execute_prepared (PREPARE один раз на соединение, дальше EXECUTE).
+Запросы только читают advertisements; берется самая частая комбинация
+источник-город-модель.
+
+Запуск: python scripts/benchmark_prepared.py [--calls 2000]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config.main import DB_CONFIG
+from database import Database
+from utils.median_calculator import MedianPriceCalculator
+
+
+def run_calls(db: Database, calls: int, params: tuple, prepared: bool) -> float:
+    """Среднее время одного вызова (мкс) на одном соединении пула"""
+    with db.cursor() as cur:
+        # Прогрев: соединение, кэш страниц и (для prepared) сам PREPARE
+        for _ in range(10):
+            _execute(db, cur, params, prepared)
+        started = time.perf_counter()
+        for _ in range(calls):
+            _execute(db, cur, params, prepared)
+        return (time.perf_counter() - started) / calls * 1_000_000
+
+
+def _execute(db: Database, cur, params: tuple, prepared: bool):
+    if prepared:
+        db.execute_prepared(cur, 'median_window', params)
+    else:
+        cur.execute(MedianPriceCalculator.MEDIAN_WINDOW_QUERY, params)
+    cur.fetchall()
+
+
+def planning_time(db: Database, params: tuple) -> float:
+    """Время планирования запроса полным текстом на сервере (мс)"""
+    with db.cursor() as cur:
+        cur.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + MedianPriceCalculator.MEDIAN_WINDOW_QUERY, params)
+        return cur.fetchone()[0][0]['Planning Time']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарк подготовленных запросов')
+    parser.add_argument('--calls', type=int, default=2000, help='вызовов в каждом режиме')
+    args = parser.parse_args()
+
+    db = Database(DB_CONFIG)
+    try:
+        with db.cursor() as cur:
+            cur.execute("""
+                SELECT source, city, model FROM advertisements
+                GROUP BY source, city, model
+                ORDER BY COUNT(*) DESC
+                LIMIT 1
+            """)
+            sample = cur.fetchone()
+        if not sample:
+            print("В advertisements нет данных для замера")
+            return
+
+        source, city, model = sample
+        date_threshold = datetime.now() - timedelta(days=MedianPriceCalculator.MEDIAN_CALCULATION_PERIOD_DAYS)
+        params = (city, model, source, date_threshold, MedianPriceCalculator.MAX_RECORDS_FOR_MEDIAN)
+
+        plain = run_calls(db, args.calls, params, prepared=False)
+        prepared = run_calls(db, args.calls, params, prepared=True)
+
+        print(f"Окно медианы: {source}, {city}, {model}; вызовов: {args.calls}")
+        print(f"  полный текст:   {plain:>10.1f} мкс/вызов")
+        print(f"  подготовленный: {prepared:>10.1f} мкс/вызов")
+        print(f"  экономия:       {plain - prepared:>10.1f} мкс/вызов ({(1 - prepared / plain) * 100:.0f}%)")
+        print(f"  планирование полного текста на сервере: {planning_time(db, params):.3f} мс")
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,13 @@ import asyncio
 import logging
 import sys
 import os
+import random
+from typing import Dict, List, Optional
 
 # Добавляем корневую директорию в путь
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from database import Database
+from async_database import AsyncDatabase
 from parsers.avito_parser import AvitoParser
 from parsers.kufar_parser import KufarParser
 from bot_avito import AvitoTelegramBot
@@ -29,7 +31,7 @@ class ParserService:
     
     def __init__(
         self, 
-        db: Database, 
+        db: AsyncDatabase, 
         avito_bot: AvitoTelegramBot, 
         kufar_bot: KufarTelegramBot,
         median_calculator: MedianPriceCalculator
@@ -41,95 +43,135 @@ class ParserService:
         self.kufar_parser = KufarParser()
         self.median_calculator = median_calculator
         self.running = False
+        self.price_drops_in_cycle = 0
+        # Комбинации (источник, город, модель), порог которых уже искали в текущем цикле
+        self._thresholds_checked = set()
 
-    async def process_advertisement(self, ad: dict, user_settings: dict, source: str):
-        """Обработать объявление для пользователя"""
-        try:
-            city = user_settings.get('city')
-            model = ad['model']
-            
-            # Определяем ID объявления в зависимости от источника
-            ad_id = ad.get('avito_id') if source == 'avito' else ad.get('kufar_id')
+    @staticmethod
+    def _ad_id(ad: dict, source: str) -> Optional[str]:
+        """ID объявления в зависимости от источника"""
+        return ad.get('avito_id') if source == 'avito' else ad.get('kufar_id')
+
+    async def _store_ads(self, ads: List[Dict], source: str, city: str) -> Dict[str, Dict]:
+        """
+        Сохранить найденные объявления одним пакетным upsert'ом
+
+        Returns:
+            {ad_id: сохраненное состояние} - прежняя цена, статус отправки, дата создания
+        """
+        rows = []
+        for ad in ads:
+            ad_id = self._ad_id(ad, source)
             if not ad_id:
                 logger.warning(f"Не найден ID объявления для источника {source}")
-                return False
-            
-            # Проверяем существует ли объявление и было ли оно уже отправлено
-            if self.db.advertisement_exists(ad_id, source):
-                # Проверяем, было ли оно уже отправлено
-                if self.db.is_advertisement_notified(ad_id, source):
-                    logger.debug(f"Объявление уже было отправлено: {ad_id}, {source}")
-                    return False
-                logger.debug(f"Объявление уже существует, но не было отправлено: {ad_id}, {source}")
-                # Продолжаем обработку, чтобы обновить данные и проверить снова
-            
-            # Сначала добавляем объявление в БД без медианной цены
+                continue
             # Память может быть None, проверяем и нормализуем
             memory = ad.get('memory')
             if memory and memory.startswith('\\'):  # Исправляем ошибку парсинга "\1 ГБ"
                 memory = None
+            rows.append({
+                'ad_id': ad_id,
+                'price': ad['price'],
+                'model': ad['model'],
+                'city': city,
+                'memory': memory,
+                'url': ad['url'],
+            })
+        
+        stored = await self.db.add_advertisements_bulk(rows, source)
+        return stored or {}
+
+    async def _delivered_to_user(self, source: str, stored_ads: Dict[str, Dict],
+                                 user_id: int) -> Dict[str, Optional[int]]:
+        """Объявления страницы, уже отправленные пользователю: {ad_id: цена при отправке} (один запрос)"""
+        deliveries = await self.db.get_deliveries(source, list(stored_ads), [user_id])
+        return {ad_id: users[user_id] for ad_id, users in deliveries.items()}
+
+    @staticmethod
+    def _reference_price(stored: Dict, already_sent: bool, sent_price: Optional[int]) -> Optional[int]:
+        """
+        Цена, от которой считается снижение для пользователя
+
+        Для отправленного объявления - цена при отправке: upsert страницы
+        повторяется для каждого пользователя единицы, и его previous_price
+        после первого из них уже равна текущей цене.
+        """
+        if already_sent and sent_price is not None:
+            return sent_price
+        return stored['previous_price']
+
+    async def _ensure_thresholds(self, source: str, city: str, ads: List[Dict], stored_ads: Dict[str, Dict]):
+        """
+        Подгрузить пороги выгодности моделей страницы, которых нет в кэше
+
+        Пороги рассчитывает плановый пересчет медиан, парсинг их только читает:
+        сравнение объявления с порогом - одно сравнение без запросов. Промах
+        по комбинации (источник, город, модель) обрабатывается не чаще раза
+        за цикл парсинга.
+        """
+        for model in sorted({ad['model'] for ad in ads if self._ad_id(ad, source) in stored_ads}):
+            key = (source, city, model)
+            if key in self._thresholds_checked or self.median_calculator.get_deal_threshold(*key):
+                continue
+            self._thresholds_checked.add(key)
+            await self.median_calculator.refresh_deal_threshold_async(*key)
+
+    async def process_advertisement(self, ad: dict, user_settings: dict, source: str,
+                                    stored: Optional[Dict], already_sent: bool = False,
+                                    sent_price: Optional[int] = None):
+        """
+        Обработать объявление для пользователя
+
+        Args:
+            stored: Состояние объявления из пакетного upsert'а (_store_ads)
+            already_sent: Объявление уже отправлялось этому пользователю (deliveries)
+            sent_price: Цена, по которой оно было отправлено этому пользователю
+        """
+        try:
+            city = user_settings.get('city')
+            model = ad['model']
+            ad_id = self._ad_id(ad, source)
+            if stored is None:
+                # Объявление не сохранено (нет ID или ошибка пакетной записи)
+                return False
             
-            self.db.add_advertisement(
-                ad_id=ad_id,
-                price=ad['price'],
-                model=model,
-                city=city,
-                memory=memory,
-                url=ad['url'],
-                source=source
+            previous_price = self._detect_price_drop(
+                ad['price'], self._reference_price(stored, already_sent, sent_price)
             )
+            if already_sent and previous_price is None:
+                logger.debug(f"Объявление уже было отправлено: {ad_id}, {source}")
+                return False
+            if previous_price is not None:
+                # Переоцененное объявление снова становится кандидатом в выгодные
+                logger.info(
+                    f"Снижение цены: {ad_id}, {source}, {previous_price} -> {ad['price']}"
+                )
             
-            # Рассчитываем медианную цену используя оптимизированный калькулятор
-            median_price = self.median_calculator.calculate_median_price(city, model, source)
-            
-            # Если медианной цены еще нет (первое объявление), используем текущую цену как базовую
-            if not median_price:
-                median_price = float(ad['price'])
-                logger.info(f"Первое объявление для {city}, {model}, {source}. Используем цену как медиану: {median_price}")
-            
-            # Обновляем медианную цену для всех объявлений этой модели в городе
-            self.median_calculator.recalculate_all_medians(source)
+            # Порог выгодности рассчитан плановым пересчетом медиан (_ensure_thresholds)
+            threshold = self.median_calculator.get_deal_threshold(source, city, model)
+            if threshold is None:
+                # Медиана не рассчитана - сравнивать не с чем
+                logger.info(f"Нет медианной цены для {city}, {model}, {source}. Порог выгодности не рассчитан")
+                return False
+            median_price = threshold['median_price']
+            price_ceiling = threshold['price_ceiling']
             
-            # Получаем актуальную медианную цену после пересчета
-            median_price = self.median_calculator.calculate_median_price(city, model, source)
-            if not median_price:
-                median_price = float(ad['price'])
+            # Порог заранее учитывает и скидку от медианы (15% или фиксированная сумма),
+            # и максимальную цену пользователя - проверка сводится к одному сравнению
+            max_price = user_settings.get('max_price')
+            if max_price:
+                price_ceiling = min(price_ceiling, max_price)
+            is_good_deal = ad['price'] <= price_ceiling
             
             # Рассчитываем разницу (экономия - положительное значение)
             # price_difference = median_price - price (экономия в рублях)
             price_difference = median_price - ad['price']
-            
-            # Определяем пороги для разных источников
-            if source == 'kufar':
-                min_discount_rubles = 200  # BYN
-            else:  # avito
-                min_discount_rubles = 6000  # RUB
-            
-            # Проверяем условие: цена должна быть ниже медианной на 15% ИЛИ на фиксированную сумму
             discount_percent = (price_difference / median_price * 100) if median_price > 0 else 0
-            is_good_deal = price_difference > 0 and (discount_percent >= 15 or price_difference >= min_discount_rubles)
             
             if is_good_deal:
-                # Обновляем объявление с медианной ценой
-                # Память может быть None, проверяем и нормализуем
-                memory = ad.get('memory')
-                if memory and memory.startswith('\\'):  # Исправляем ошибку парсинга "\1 ГБ"
-                    memory = None
-                
-                self.db.add_advertisement(
-                    ad_id=ad_id,
-                    price=ad['price'],
-                    model=model,
-                    city=city,
-                    memory=memory,
-                    url=ad['url'],
-                    source=source,
-                    median_price=median_price,
-                    price_difference=price_difference
-                )
-                
-                # Получаем дату создания объявления из БД
-                ad_created_at = self.db.get_advertisement_created_at(ad_id, source)
+                # Медианная цена берется из порога, дата создания пришла
+                # из upsert'а - повторных запросов не нужно
+                ad_created_at = stored['created_at']
                 
                 # Отправляем пользователю через соответствующий бот
                 ad_data = {
@@ -139,8 +181,10 @@ class ParserService:
                     'memory': ad.get('memory'),
                     'url': ad['url'],
                     'median_price': median_price,
+                    'median_sample_size': threshold['sample_size'],  # Объявлений в выборке медианы
                     'price_difference': price_difference,
-                    'created_at': ad_created_at  # Дата создания объявления
+                    'created_at': ad_created_at,  # Дата создания объявления
+                    'previous_price': previous_price  # Прежняя цена, если она снизилась
                 }
                 
                 if source == 'avito':
@@ -148,8 +192,8 @@ class ParserService:
                 else:
                     await self.kufar_bot.send_advertisement(user_settings['user_id'], ad_data)
                 
-                # Помечаем объявление как отправленное
-                self.db.mark_advertisement_notified(ad_id, source)
+                # Запоминаем отправку этому пользователю
+                await self.db.add_deliveries(source, [(user_settings['user_id'], ad_id, ad['price'])])
                 
                 logger.info(
                     f"Выгодное предложение отправлено: {model} за {ad['price']} "
@@ -168,6 +212,18 @@ class ParserService:
             logger.error(f"Ошибка обработки объявления: {e}", exc_info=True)
             return False
 
+    def _detect_price_drop(self, price: int, previous_price: Optional[int]) -> Optional[int]:
+        """
+        Проверить снизилась ли цена относительно сохраненной в БД или отправленной пользователю
+
+        Returns:
+            Прежняя цена, если цена снизилась, иначе None
+        """
+        if previous_price is None or price >= previous_price:
+            return None
+        self.price_drops_in_cycle += 1
+        return previous_price
+
     async def parse_for_user_avito(self, user_settings: dict):
         """Парсить объявления Avito для конкретного пользователя"""
         start_time = time.time()
@@ -202,10 +258,19 @@ class ParserService:
             
             logger.info(f"Найдено {len(ads)} объявлений Avito для пользователя {user_settings['user_id']}")
             
+            # Сохраняем страницу одним запросом и подгружаем недостающие пороги ее моделей
+            stored_ads = await self._store_ads(ads, 'avito', city)
+            delivered = await self._delivered_to_user('avito', stored_ads, user_settings['user_id'])
+            await self._ensure_thresholds('avito', city, ads, stored_ads)
+            
             # Обрабатываем каждое объявление
             for ad in ads:
                 try:
-                    if await self.process_advertisement(ad, user_settings, 'avito'):
+                    ad_id = self._ad_id(ad, 'avito')
+                    if await self.process_advertisement(
+                        ad, user_settings, 'avito', stored_ads.get(ad_id),
+                        already_sent=ad_id in delivered, sent_price=delivered.get(ad_id)
+                    ):
                         ads_sent += 1
                     ads_processed += 1
                     await asyncio.sleep(0.5)
@@ -223,7 +288,7 @@ class ParserService:
         finally:
             # Логируем результат парсинга
             duration = time.time() - start_time
-            self.db.add_parsing_log(
+            await self.db.add_parsing_log(
                 source='avito',
                 city=user_settings.get('city'),
                 model=user_settings.get('model'),
@@ -270,10 +335,19 @@ class ParserService:
             
             logger.info(f"Найдено {len(ads)} объявлений Kufar для пользователя {user_settings['user_id']}")
             
+            # Сохраняем страницу одним запросом и подгружаем недостающие пороги ее моделей
+            stored_ads = await self._store_ads(ads, 'kufar', city)
+            delivered = await self._delivered_to_user('kufar', stored_ads, user_settings['user_id'])
+            await self._ensure_thresholds('kufar', city, ads, stored_ads)
+            
             # Обрабатываем каждое объявление
             for ad in ads:
                 try:
-                    if await self.process_advertisement(ad, user_settings, 'kufar'):
+                    ad_id = self._ad_id(ad, 'kufar')
+                    if await self.process_advertisement(
+                        ad, user_settings, 'kufar', stored_ads.get(ad_id),
+                        already_sent=ad_id in delivered, sent_price=delivered.get(ad_id)
+                    ):
                         ads_sent += 1
                     ads_processed += 1
                     await asyncio.sleep(0.5)
@@ -291,7 +365,7 @@ class ParserService:
         finally:
             # Логируем результат парсинга
             duration = time.time() - start_time
-            self.db.add_parsing_log(
+            await self.db.add_parsing_log(
                 source='kufar',
                 city=user_settings.get('city'),
                 model=user_settings.get('model'),
@@ -305,13 +379,53 @@ class ParserService:
                 error_message=error_message
             )
 
+    @staticmethod
+    def _group_users_by_unit(avito_users: List[Dict], kufar_users: List[Dict]) -> Dict[tuple, List[Dict]]:
+        """Сгруппировать активных пользователей по единицам парсинга (источник, город)"""
+        units = {}
+        for source, users in (('avito', avito_users), ('kufar', kufar_users)):
+            for user_settings in users:
+                if user_settings.get('is_active'):
+                    units.setdefault((source, user_settings.get('city')), []).append(user_settings)
+        return units
+
+    async def _parse_unit(self, source: str, city: Optional[str], users: List[Dict]):
+        """
+        Распарсить единицу (источник, город) для всех ее пользователей
+
+        Единица выполняется под advisory-блокировкой Postgres и только если
+        другой экземпляр не обработал ее в текущем цикле, поэтому при
+        горизонтальном масштабировании нет дублей парсинга и уведомлений.
+        """
+        lock_name = f"scrape:{source}:{city}"
+        if not await self.db.try_advisory_lock(lock_name):
+            logger.info(f"Единица {source}/{city} обрабатывается другим экземпляром, пропускаем")
+            return
+        
+        try:
+            min_interval = int(PARSING_INTERVAL_MINUTES * 60 * 0.9)
+            if not await self.db.claim_scrape_unit(source, city, min_interval):
+                logger.info(f"Единица {source}/{city} уже обработана в текущем цикле, пропускаем")
+                return
+            
+            parse_for_user = self.parse_for_user_avito if source == 'avito' else self.parse_for_user_kufar
+            for user_settings in users:
+                await parse_for_user(user_settings)
+                await asyncio.sleep(1)
+        finally:
+            await self.db.advisory_unlock(lock_name)
+
     async def run_parsing_cycle(self):
         """Запустить цикл парсинга"""
         while self.running:
             try:
+                self.price_drops_in_cycle = 0
+                self._thresholds_checked = set()
+                touched_before, untouched_before = self.db.ads_touched, self.db.ads_untouched
+                
                 # Получаем активных пользователей для каждого источника
-                avito_users = self.db.get_active_users('avito')
-                kufar_users = self.db.get_active_users('kufar')
+                avito_users = await self.db.get_active_users('avito')
+                kufar_users = await self.db.get_active_users('kufar')
                 
                 total_users = len(avito_users) + len(kufar_users)
                 
@@ -323,19 +437,21 @@ class ParserService:
                         f"{len(kufar_users)} пользователей Kufar"
                     )
                     
-                    # Парсим для пользователей Avito
-                    for user_settings in avito_users:
-                        if user_settings.get('is_active'):
-                            await self.parse_for_user_avito(user_settings)
-                            await asyncio.sleep(1)
+                    # Пороги, пересчитанные с прошлого цикла (в том числе другими экземплярами)
+                    await self.median_calculator.reload_deal_thresholds_async()
                     
-                    # Парсим для пользователей Kufar
-                    for user_settings in kufar_users:
-                        if user_settings.get('is_active'):
-                            await self.parse_for_user_kufar(user_settings)
-                            await asyncio.sleep(1)
+                    # Парсим по единицам (источник, город) в случайном порядке, чтобы
+                    # несколько экземпляров приложения разбирали разные единицы
+                    units = self._group_users_by_unit(avito_users, kufar_users)
+                    for (source, city), users in random.sample(list(units.items()), len(units)):
+                        await self._parse_unit(source, city, users)
                     
-                    logger.info(f"Цикл парсинга завершен. Следующий цикл через {PARSING_INTERVAL_MINUTES} минут")
+                    logger.info(
+                        f"Цикл парсинга завершен. Снижений цены: {self.price_drops_in_cycle}. "
+                        f"Объявлений записано: {self.db.ads_touched - touched_before}, "
+                        f"без изменений: {self.db.ads_untouched - untouched_before}. "
+                        f"Следующий цикл через {PARSING_INTERVAL_MINUTES} минут"
+                    )
                 
             except Exception as e:
                 logger.error(f"Ошибка в цикле парсинга: {e}", exc_info=True)
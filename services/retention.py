@@ -0,0 +1,182 @@
+"""
+Сервис хранения данных: удаление устаревших строк по политикам таблиц
+
+Объявления удаляются целыми помесячными секциями (перед этим их дневная
+статистика сворачивается в ad_daily_stats, а отправки удаляются вместе
+с ключами объявлений), остальные таблицы - небольшими пачками с паузами.
+Перед удалением строки можно выгрузить в архив .csv.gz.
+"""
+import csv
+import gzip
+import io
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+# Добавляем корневую директорию в путь
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+from utils.logger import get_logger
+from config.app_settings import (
+    ADS_RETENTION_DAYS, USER_LOG_RETENTION_DAYS, PARSING_LOG_RETENTION_DAYS,
+    SCHEDULER_RUN_RETENTION_DAYS, RETENTION_BATCH_SIZE, RETENTION_BATCH_PAUSE_SECONDS,
+    RETENTION_ARCHIVE_DIR, SPOOL_REPLAYED_RETENTION_DAYS
+)
+
+logger = get_logger('retention')
+
+
+class RetentionService:
+    """Удаление устаревших данных по политикам хранения"""
+
+    # (таблица, колонка времени, срок хранения в днях; 0 - бессрочно)
+    POLICIES = [
+        ('user_logs', 'created_at', USER_LOG_RETENTION_DAYS),
+        ('parsing_logs', 'created_at', PARSING_LOG_RETENTION_DAYS),
+        ('scheduler_runs', 'started_at', SCHEDULER_RUN_RETENTION_DAYS),
+        ('ad_price_history', 'created_at', ADS_RETENTION_DAYS),
+        ('spool_replayed', 'replayed_at', SPOOL_REPLAYED_RETENTION_DAYS),
+    ]
+
+    def __init__(self, db: Database, archive_dir: Optional[str] = None):
+        self.db = db
+        self.archive_dir = archive_dir if archive_dir is not None else RETENTION_ARCHIVE_DIR
+        if self.archive_dir:
+            os.makedirs(self.archive_dir, exist_ok=True)
+
+    def run(self, stop_event: threading.Event = None) -> Dict[str, int]:
+        """
+        Применить все политики хранения (выполняется в отдельном потоке)
+
+        Args:
+            stop_event: Установленное событие прерывает очистку между пачками
+                        и секциями (таймаут задачи планировщика, остановка)
+
+        Returns:
+            {таблица: удалено строк}; для объявлений - число удаленных секций
+        """
+        removed = {}
+        if ADS_RETENTION_DAYS:
+            removed['advertisements'] = len(self.purge_ad_partitions(ADS_RETENTION_DAYS, stop_event))
+        for table, time_column, days in self.POLICIES:
+            if stop_event is not None and stop_event.is_set():
+                logger.warning(f"Очистка устаревших данных прервана: {removed}")
+                return removed
+            if days:
+                removed[table] = self.purge_table(table, time_column, days, stop_event)
+        logger.info(f"Очистка устаревших данных завершена: {removed}")
+        return removed
+
+    def purge_ad_partitions(self, days: int, stop_event: threading.Event = None) -> List[str]:
+        """
+        Удалить секции объявлений, целиком старше days дней
+
+        Перед отсоединением каждой секции ее дневная статистика сворачивается
+        в ad_daily_stats и (если задан каталог) секция выгружается в архив.
+        """
+        cutoff = datetime.now() - timedelta(days=days)
+
+        def before_detach(cur, name: str):
+            self._rollup_partition(cur, name)
+            if self.archive_dir:
+                self._archive_query(cur, f"SELECT * FROM {name}", name)
+
+        return self.db.detach_partitions_before(
+            cutoff, drop=True, before_detach=before_detach, stop_event=stop_event
+        )
+
+    def purge_table(self, table: str, time_column: str, days: int, stop_event: threading.Event = None) -> int:
+        """
+        Удалить строки старше days дней пачками по RETENTION_BATCH_SIZE
+
+        Каждая пачка - отдельная короткая транзакция, между пачками пауза;
+        установленный stop_event прерывает очистку перед следующей пачкой.
+
+        Returns:
+            Количество удаленных строк
+        """
+        cutoff = datetime.now() - timedelta(days=days)
+        total = 0
+        archive_name = f"{table}_{datetime.now():%Y%m%d_%H%M%S}"
+
+        try:
+            while stop_event is None or not stop_event.is_set():
+                archive = None
+                with self.db.cursor() as cur:
+                    # ctid позволяет удалять пачками в таблицах без суррогатного ключа
+                    cur.execute(f"""
+                        DELETE FROM {table}
+                        WHERE ctid IN (
+                            SELECT ctid FROM {table}
+                            WHERE {time_column} < %s
+                            LIMIT %s
+                        )
+                        RETURNING *
+                    """, (cutoff, RETENTION_BATCH_SIZE))
+                    rows = cur.fetchall()
+                    if rows and self.archive_dir:
+                        columns = [desc[0] for desc in cur.description]
+                        archive = self._archive_member(archive_name, columns, rows)
+                # Архив дописывается после коммита: если коммит не прошел, строки
+                # останутся в таблице и не попадут в архив дважды при следующем запуске
+                if archive:
+                    self._append_archive(archive_name, archive)
+
+                total += len(rows)
+                if len(rows) < RETENTION_BATCH_SIZE:
+                    break
+                if stop_event is not None:
+                    stop_event.wait(RETENTION_BATCH_PAUSE_SECONDS)
+                else:
+                    time.sleep(RETENTION_BATCH_PAUSE_SECONDS)
+
+            if total:
+                logger.info(f"{table}: удалено {total} строк старше {days} дн.")
+            return total
+        except Exception as e:
+            logger.error(f"Ошибка очистки {table}: {e}")
+            return total
+
+    def _rollup_partition(self, cur, name: str):
+        """Свернуть объявления секции в дневную статистику ad_daily_stats"""
+        cur.execute(f"""
+            INSERT INTO ad_daily_stats (day, source, city, model, ads_count, min_price, avg_price, median_price)
+            SELECT created_at::date, source, city, model,
+                   COUNT(*), MIN(price), AVG(price),
+                   PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY price)
+            FROM {name}
+            GROUP BY created_at::date, source, city, model
+            ON CONFLICT (day, source, city, model) DO UPDATE SET
+                ads_count = EXCLUDED.ads_count,
+                min_price = EXCLUDED.min_price,
+                avg_price = EXCLUDED.avg_price,
+                median_price = EXCLUDED.median_price
+        """)
+
+    def _archive_query(self, cur, query: str, archive_name: str):
+        """Выгрузить результат запроса в архив через COPY (без загрузки строк в память)"""
+        path = os.path.join(self.archive_dir, f"{archive_name}.csv.gz")
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as archive:
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", archive)
+        logger.info(f"Архив сохранен: {path}")
+
+    def _archive_member(self, archive_name: str, columns: List[str], rows: List[tuple]) -> bytes:
+        """Сжать пачку строк для архива таблицы (заголовок - только в первой пачке файла)"""
+        path = os.path.join(self.archive_dir, f"{archive_name}.csv.gz")
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if not os.path.exists(path):
+            writer.writerow(columns)
+        writer.writerows(rows)
+        return gzip.compress(buffer.getvalue().encode('utf-8'))
+
+    def _append_archive(self, archive_name: str, member: bytes):
+        """Дописать сжатую пачку в архив таблицы"""
+        path = os.path.join(self.archive_dir, f"{archive_name}.csv.gz")
+        # Каждая пачка - отдельный gzip-член: файл остается читаемым целиком
+        with open(path, 'ab') as archive:
+            archive.write(member)
@@ -1,72 +1,324 @@
 """
-Сервис для планирования задач (ежедневный пересчет медианной цены)
+Сервис для планирования задач (пересчет медианных цен, обновление курсов валют)
+
+Задачи хранятся в реестре и упорядочены по времени следующего запуска:
+планировщик спит ровно до ближайшей задачи, а не опрашивает часы раз в час.
+Каждый запуск берет advisory-блокировку Postgres, поэтому при нескольких
+экземплярах приложения задачу выполняет только один из них.
 """
 import asyncio
+import heapq
 import logging
+import random
 import sys
 import os
-from datetime import datetime, time
+import threading
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
 
 # Добавляем корневую директорию в путь
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from async_database import AsyncDatabase
 from utils.median_calculator import MedianPriceCalculator
 from utils.logger import get_logger
-from config.app_settings import MEDIAN_RECALCULATION_INTERVAL_HOURS
+from config.app_settings import (
+    MEDIAN_RECALCULATION_INTERVAL_HOURS, MEDIAN_RECALCULATION_TIMEOUT_MINUTES,
+    CURRENCY_REFRESH_INTERVAL_HOURS, SCHEDULER_JITTER_SECONDS, ANALYTICS_REFRESH_INTERVAL_MINUTES
+)
 
 logger = get_logger('scheduler')
 
 
+class ScheduledJob:
+    """Периодическая задача планировщика"""
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[], Awaitable],
+        interval_seconds: float,
+        timeout_seconds: Optional[float] = None,
+        jitter_seconds: float = 0
+    ):
+        self.name = name
+        self.func = func
+        self.interval_seconds = interval_seconds
+        self.timeout_seconds = timeout_seconds
+        self.jitter_seconds = jitter_seconds
+        self.next_run = 0.0  # time.monotonic()
+        self.running = False
+
+    def schedule_next(self, from_time: float):
+        """Запланировать следующий запуск через интервал (+ случайный разброс)"""
+        jitter = random.uniform(0, self.jitter_seconds) if self.jitter_seconds else 0
+        self.next_run = from_time + self.interval_seconds + jitter
+
+
 class SchedulerService:
     """Сервис для планирования периодических задач"""
-    
-    def __init__(self, median_calculator: MedianPriceCalculator):
+
+    def __init__(self, median_calculator: MedianPriceCalculator, db: AsyncDatabase):
         self.median_calculator = median_calculator
+        self.db = db
         self.running = False
-        self.last_recalculation_time = None
-    
-    async def periodic_median_recalculation(self):
-        """Периодический пересчет медианных цен (каждые N часов)"""
+        self.jobs: Dict[str, ScheduledJob] = {}
+        self._queue: List[tuple] = []  # (next_run, job_name)
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+        self._register_default_jobs()
+
+    def _register_default_jobs(self):
+        """Зарегистрировать стандартные задачи приложения"""
+        self.add_job(
+            'median_recalculation',
+            self.recalculate_medians,
+            interval_seconds=MEDIAN_RECALCULATION_INTERVAL_HOURS * 3600,
+            timeout_seconds=MEDIAN_RECALCULATION_TIMEOUT_MINUTES * 60,
+            jitter_seconds=SCHEDULER_JITTER_SECONDS
+        )
+        self.add_job(
+            'currency_refresh',
+            self.refresh_currency_rates,
+            interval_seconds=CURRENCY_REFRESH_INTERVAL_HOURS * 3600,
+            timeout_seconds=60,
+            jitter_seconds=SCHEDULER_JITTER_SECONDS
+        )
+        self.add_job(
+            'ads_partition_maintenance',
+            self.maintain_partitions,
+            interval_seconds=24 * 3600,
+            timeout_seconds=300,
+            jitter_seconds=SCHEDULER_JITTER_SECONDS
+        )
+        self.add_job(
+            'analytics_refresh',
+            self.refresh_analytics,
+            interval_seconds=ANALYTICS_REFRESH_INTERVAL_MINUTES * 60,
+            timeout_seconds=300,
+            jitter_seconds=min(SCHEDULER_JITTER_SECONDS, ANALYTICS_REFRESH_INTERVAL_MINUTES * 6)
+        )
+        self.add_job(
+            'data_retention',
+            self.apply_retention,
+            interval_seconds=24 * 3600,
+            timeout_seconds=3600,
+            jitter_seconds=SCHEDULER_JITTER_SECONDS
+        )
+        self.add_job(
+            'median_index_check',
+            self.check_median_index,
+            interval_seconds=24 * 3600,
+            timeout_seconds=60,
+            jitter_seconds=SCHEDULER_JITTER_SECONDS
+        )
+
+    def add_job(
+        self,
+        name: str,
+        func: Callable[[], Awaitable],
+        interval_seconds: float,
+        timeout_seconds: Optional[float] = None,
+        jitter_seconds: float = 0
+    ) -> ScheduledJob:
+        """
+        Зарегистрировать периодическую задачу
+
+        Args:
+            name: Уникальное имя задачи (используется в истории запусков)
+            func: Корутина без аргументов
+            interval_seconds: Интервал между запусками
+            timeout_seconds: Максимальная длительность запуска (None - без ограничения)
+            jitter_seconds: Максимальный случайный сдвиг следующего запуска
+        """
+        job = ScheduledJob(name, func, interval_seconds, timeout_seconds, jitter_seconds)
+        self.jobs[name] = job
+        if self.running:
+            self._push(job)
+        return job
+
+    def _push(self, job: ScheduledJob):
+        """Поставить задачу в очередь и разбудить цикл планировщика"""
+        heapq.heappush(self._queue, (job.next_run, job.name))
+        self._wakeup.set()
+
+    async def _restore_schedule(self):
+        """Вычислить первый запуск каждой задачи по истории запусков в БД"""
+        last_runs = await self.db.get_last_scheduler_runs()
+        now_wall = datetime.now()
+        now = time.monotonic()
+
+        for job in self.jobs.values():
+            last_run = last_runs.get(job.name)
+            if last_run is None:
+                # Задача еще ни разу не выполнялась - запускаем сразу
+                job.next_run = now
+            else:
+                elapsed = (now_wall - last_run).total_seconds()
+                job.next_run = now + max(0.0, job.interval_seconds - elapsed)
+            self._push(job)
+
+    def _lock_name(self, job: ScheduledJob) -> str:
+        """Имя advisory-блокировки задачи (общее для всех экземпляров)"""
+        return f"scheduler:{job.name}"
+
+    async def _already_done_elsewhere(self, job: ScheduledJob) -> bool:
+        """Проверить, не выполнил ли задачу другой экземпляр в текущем интервале"""
+        last_runs = await self.db.get_last_scheduler_runs(job_name=job.name)
+        last_run = last_runs.get(job.name)
+        if last_run is None:
+            return False
+        elapsed = (datetime.now() - last_run).total_seconds()
+        return elapsed < job.interval_seconds - job.jitter_seconds
+
+    async def _run_job(self, job: ScheduledJob):
+        """Выполнить задачу под advisory-блокировкой"""
+        lock_name = self._lock_name(job)
+        if not await self.db.try_advisory_lock(lock_name):
+            logger.info(f"Задача {job.name} выполняется другим экземпляром, запуск пропущен")
+            return
+
+        job.running = True
+        try:
+            if await self._already_done_elsewhere(job):
+                logger.info(f"Задача {job.name} уже выполнена другим экземпляром в текущем интервале")
+                return
+            await self._execute_job(job)
+        finally:
+            job.running = False
+            await self.db.advisory_unlock(lock_name)
+
+    async def _execute_job(self, job: ScheduledJob):
+        """Выполнить задачу с таймаутом и записать результат в историю"""
+        started_at = datetime.now()
+        start = time.monotonic()
+        status = 'completed'
+        error_message = None
+
+        try:
+            logger.info(f"Запуск задачи {job.name}")
+            if job.timeout_seconds:
+                await asyncio.wait_for(job.func(), timeout=job.timeout_seconds)
+            else:
+                await job.func()
+            logger.info(f"Задача {job.name} завершена за {time.monotonic() - start:.1f}с")
+        except asyncio.TimeoutError:
+            status = 'timeout'
+            error_message = f"Превышен таймаут {job.timeout_seconds}с"
+            logger.error(f"Задача {job.name}: {error_message}")
+        except asyncio.CancelledError:
+            status = 'cancelled'
+            raise
+        except Exception as e:
+            status = 'error'
+            error_message = str(e)
+            logger.error(f"Ошибка выполнения задачи {job.name}: {e}", exc_info=True)
+        finally:
+            await self.db.add_scheduler_run(
+                job_name=job.name,
+                started_at=started_at,
+                duration_seconds=round(time.monotonic() - start, 2),
+                status=status,
+                error_message=error_message
+            )
+
+    def _dispatch(self, job: ScheduledJob, now: float):
+        """Запустить задачу в фоне и запланировать следующий запуск"""
+        if job.running:
+            # Предыдущий запуск еще не завершился - не запускаем параллельно
+            logger.warning(f"Задача {job.name} еще выполняется, запуск пропущен")
+        else:
+            task = asyncio.create_task(self._run_job(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        job.schedule_next(now)
+        self._push(job)
+
+    async def run(self):
+        """Основной цикл: спать до ближайшей задачи и запускать ее"""
         while self.running:
-            try:
-                now = datetime.now()
-                
-                # Проверяем, нужно ли пересчитывать
-                should_recalculate = False
-                if self.last_recalculation_time is None:
-                    # Первый запуск - пересчитываем сразу
-                    should_recalculate = True
-                else:
-                    # Проверяем прошло ли достаточно времени
-                    time_diff = (now - self.last_recalculation_time).total_seconds() / 3600
-                    if time_diff >= MEDIAN_RECALCULATION_INTERVAL_HOURS:
-                        should_recalculate = True
-                
-                if should_recalculate:
-                    logger.info(f"Начало пересчета медианных цен (интервал: {MEDIAN_RECALCULATION_INTERVAL_HOURS} часов)")
-                    
-                    # Пересчитываем для обоих источников
-                    self.median_calculator.recalculate_all_medians('avito')
-                    self.median_calculator.recalculate_all_medians('kufar')
-                    
-                    self.last_recalculation_time = now
-                    logger.info("Пересчет медианных цен завершен")
-                
-                # Проверяем каждые час
-                await asyncio.sleep(60 * 60)
-                
-            except Exception as e:
-                logger.error(f"Ошибка в пересчете медианных цен: {e}")
-                await asyncio.sleep(60 * 60)  # Ждем час перед повтором
-    
+            self._wakeup.clear()
+
+            if not self._queue:
+                await self._wakeup.wait()
+                continue
+
+            next_run, name = self._queue[0]
+            job = self.jobs.get(name)
+            if job is None or job.next_run != next_run:
+                # Устаревшая запись (задача перепланирована или удалена)
+                heapq.heappop(self._queue)
+                continue
+
+            delay = next_run - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._queue)
+            self._dispatch(job, time.monotonic())
+
+    async def recalculate_medians(self):
+        """Задача: пересчет медианных цен для обоих источников (в рабочем потоке)"""
+        await self.median_calculator.recalculate_all_medians_async('avito')
+        await self.median_calculator.recalculate_all_medians_async('kufar')
+
+    async def check_median_index(self):
+        """Задача: проверка, что запрос окна медианы использует покрывающий индекс"""
+        await self.median_calculator.check_index_usage_async()
+
+    async def maintain_partitions(self):
+        """Задача: создание помесячных секций объявлений на ближайшие месяцы"""
+        await asyncio.to_thread(self.median_calculator.db.ensure_partitions)
+
+    async def refresh_analytics(self):
+        """Задача: пересчет сводки аналитики для /analytics"""
+        await self.db.refresh_analytics()
+
+    async def apply_retention(self):
+        """
+        Задача: удаление устаревших объявлений и логов (пачками, в отдельном потоке)
+
+        Отмена корутины (таймаут, остановка) не останавливает поток, поэтому
+        очистке передается stop_event, а корутина завершается только после
+        возврата потока: блокировка задачи не снимается, пока идут удаления.
+        """
+        from services.retention import RetentionService
+        retention = RetentionService(self.median_calculator.db)
+        stop_event = threading.Event()
+        future = asyncio.ensure_future(asyncio.to_thread(retention.run, stop_event))
+        try:
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Поток остановится между пачками или секциями
+            stop_event.set()
+            await asyncio.wait([future])
+            raise
+
+    async def refresh_currency_rates(self):
+        """Задача: обновление курсов валют (HTTP-запрос выполняется в отдельном потоке)"""
+        from utils.currency_converter import update_currency_rates
+        await asyncio.to_thread(update_currency_rates)
+
     async def start(self):
         """Запустить планировщик"""
         self.running = True
-        logger.info(f"Планировщик задач запущен (пересчет каждые {MEDIAN_RECALCULATION_INTERVAL_HOURS} часов)")
-        await self.periodic_median_recalculation()
-    
+        await self._restore_schedule()
+        jobs_info = ", ".join(
+            f"{job.name} (каждые {job.interval_seconds / 3600:g} ч)" for job in self.jobs.values()
+        )
+        logger.info(f"Планировщик задач запущен: {jobs_info}")
+        await self.run()
+
     def stop(self):
         """Остановить планировщик"""
         self.running = False
+        self._wakeup.set()
+        for task in list(self._tasks):
+            task.cancel()
         logger.info("Планировщик задач остановлен")
-
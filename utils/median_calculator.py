@@ -1,21 +1,94 @@
 """
 Модуль для расчета медианной цены с оптимизацией производительности
 """
+import asyncio
+import json
 import logging
-from typing import Optional
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
 from datetime import datetime, timedelta
 import sys
 import os
+import psycopg2
 
 # Добавляем корневую директорию в путь
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from database import Database
 from utils.logger import get_logger
+from config.app_settings import (
+    MEDIAN_ESTIMATOR, MEDIAN_TRIM_PERCENT, MEDIAN_MAD_THRESHOLD, MEDIAN_MAD_MIN_SCALE_PERCENT
+)
 
 logger = get_logger('median_calculator')
 
 
+def _sorted_median(values: List[float]) -> float:
+    """Медиана уже отсортированного списка"""
+    n = len(values)
+    if n % 2 == 0:
+        return (values[n // 2 - 1] + values[n // 2]) / 2
+    return values[n // 2]
+
+
+def robust_median(
+    prices: List[float],
+    estimator: str = 'plain',
+    trim_percent: float = 10,
+    mad_threshold: float = 3.0,
+    mad_min_scale_percent: float = 5
+) -> Dict:
+    """
+    Устойчивая к выбросам оценка "типичной" цены за один проход по отсортированному окну
+    
+    Args:
+        prices: Цены из окна
+        estimator: 'plain' - обычная медиана;
+                   'trimmed' - среднее после отсечения trim_percent% с каждого края
+                   (от 3 цен - не меньше одной с каждого края);
+                   'mad' - медиана после отсечения цен дальше mad_threshold * MAD от медианы
+                   (чехлы, битые телефоны, "цена по запросу")
+        mad_min_scale_percent: Нижняя граница MAD в % от медианы - при MAD = 0
+                               (половина окна по одной цене) выбросы тоже отсекаются
+    
+    Returns:
+        {'median': float (до 2 знаков), 'sample_size': int, 'outliers_removed': int}
+    """
+    prices_sorted = sorted(prices)
+    n = len(prices_sorted)
+    kept = prices_sorted
+    
+    if estimator == 'trimmed':
+        cut = int(n * trim_percent / 100)
+        if n >= 3:
+            # На малых окнах процент дает 0 и оценка вырождается в обычное среднее
+            cut = max(cut, 1)
+        if n - 2 * cut > 0:
+            kept = prices_sorted[cut:n - cut]
+        median = sum(kept) / len(kept)
+    elif estimator == 'mad':
+        center = _sorted_median(prices_sorted)
+        mad = _sorted_median(sorted(abs(price - center) for price in prices_sorted))
+        mad = max(mad, abs(center) * mad_min_scale_percent / 100)
+        if mad > 0:
+            # 1.4826 * MAD - оценка стандартного отклонения для нормального распределения
+            limit = mad_threshold * 1.4826 * mad
+            kept = [price for price in prices_sorted if abs(price - center) <= limit]
+        median = _sorted_median(kept)
+    else:
+        median = _sorted_median(prices_sorted)
+    
+    # Округляем до копеек, как в DECIMAL(10,2): иначе среднее 'trimmed' всегда
+    # отличается от записанного значения и IS DISTINCT FROM переписывает строки
+    return {
+        'median': round(float(median), 2),
+        'sample_size': len(kept),
+        'outliers_removed': n - len(kept),
+    }
+
+
 class MedianPriceCalculator:
     """Калькулятор медианной цены с оптимизацией"""
     
@@ -25,15 +98,55 @@ class MedianPriceCalculator:
     # Период для расчета медианной цены (дни)
     MEDIAN_CALCULATION_PERIOD_DAYS = 30
     
+    # Окно цен для медианы. Обслуживается покрывающим индексом MEDIAN_WINDOW_INDEX
+    # (index-only scan без сортировки), см. check_index_usage. Пересчет выполняет его
+    # как подготовленный запрос 'median_window' (database.PREPARED_STATEMENTS)
+    MEDIAN_WINDOW_QUERY = """
+        SELECT price 
+        FROM advertisements
+        WHERE city = %s 
+        AND model = %s 
+        AND source = %s
+        AND created_at >= %s
+        ORDER BY created_at DESC
+        LIMIT %s
+    """
+    MEDIAN_WINDOW_INDEX = 'idx_ads_median_window'
+    
+    # Условие выгодности: цена ниже медианной на 15% ИЛИ на фиксированную сумму
+    DEAL_DISCOUNT_PERCENT = 15
+    MIN_DISCOUNT_BY_SOURCE = {
+        'avito': 6000,  # RUB
+        'kufar': 200,   # BYN
+    }
+    
     def __init__(self, db: Database):
         self.db = db
+        # Пороги выгодности: {(source, city, model): см. get_deal_threshold}
+        self.deal_thresholds = self.db.get_deal_thresholds()
+        # Пересчет выполняется в одном рабочем потоке на отдельном соединении,
+        # чтобы не блокировать event loop и не занимать соединения пула db
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='median')
+        self._worker_conn = None
+        # Чтение порогов для парсинга - свой поток на соединениях пула: полный
+        # пересчет может идти до MEDIAN_RECALCULATION_TIMEOUT_MINUTES, и парсинг
+        # не должен ждать его в очереди _executor
+        self._threshold_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thresholds')
+    
+    def _get_worker_connection(self):
+        """Получить выделенное соединение рабочего потока (переподключение при обрыве)"""
+        if self._worker_conn is None or self._worker_conn.closed:
+            self._worker_conn = psycopg2.connect(**self.db.db_config)
+            logger.info("Открыто отдельное соединение для пересчета медианных цен")
+        return self._worker_conn
     
     def calculate_median_price(
         self, 
         city: str, 
         model: str, 
         source: str = None,
-        use_recent_only: bool = True
+        use_recent_only: bool = True,
+        conn=None
     ) -> Optional[float]:
         """
         Рассчитать медианную цену для модели в городе
@@ -43,40 +156,49 @@ class MedianPriceCalculator:
             model: Модель iPhone
             source: Источник (avito/kufar) или None для всех
             use_recent_only: Использовать только недавние записи для производительности
+            conn: Соединение для запроса (по умолчанию соединение из пула db)
         
         Returns:
             Медианная цена или None
         """
+        stats = self.calculate_median_stats(city, model, source, use_recent_only, conn)
+        return stats['median'] if stats else None
+    
+    def calculate_median_stats(
+        self,
+        city: str,
+        model: str,
+        source: str = None,
+        use_recent_only: bool = True,
+        conn=None
+    ) -> Optional[Dict]:
+        """
+        Рассчитать медианную цену вместе с размером выборки
+        
+        Для окна недавних записей используется оценка MEDIAN_ESTIMATOR
+        (см. robust_median).
+        
+        Returns:
+            {'median', 'sample_size', 'outliers_removed'} или None
+        """
         try:
-            from psycopg2.extras import RealDictCursor
-            with self.db.conn.cursor() as cur:
+            # Без явного соединения запрос идет через пул основной БД
+            cursor_context = conn.cursor() if conn is not None else self.db.cursor()
+            with cursor_context as cur:
                 if use_recent_only:
                     # Используем только записи за последний период
                     date_threshold = datetime.now() - timedelta(days=self.MEDIAN_CALCULATION_PERIOD_DAYS)
                     
                     if source:
-                        query = """
-                            SELECT price 
-                            FROM advertisements
-                            WHERE city = %s 
-                            AND model = %s 
-                            AND source = %s
-                            AND created_at >= %s
-                            ORDER BY created_at DESC
-                            LIMIT %s
-                        """
-                        cur.execute(query, (city, model, source, date_threshold, self.MAX_RECORDS_FOR_MEDIAN))
+                        self.db.execute_prepared(
+                            cur, 'median_window',
+                            (city, model, source, date_threshold, self.MAX_RECORDS_FOR_MEDIAN)
+                        )
                     else:
-                        query = """
-                            SELECT price 
-                            FROM advertisements
-                            WHERE city = %s 
-                            AND model = %s
-                            AND created_at >= %s
-                            ORDER BY created_at DESC
-                            LIMIT %s
-                        """
-                        cur.execute(query, (city, model, date_threshold, self.MAX_RECORDS_FOR_MEDIAN))
+                        self.db.execute_prepared(
+                            cur, 'median_window_all_sources',
+                            (city, model, date_threshold, self.MAX_RECORDS_FOR_MEDIAN)
+                        )
                 else:
                     # Используем все записи (может быть медленно для больших объемов)
                     if source:
@@ -87,7 +209,9 @@ class MedianPriceCalculator:
                         """
                         cur.execute(query, (city, model, source))
                         result = cur.fetchone()
-                        return float(result[0]) if result and result[0] else None
+                        if not result or not result[0]:
+                            return None
+                        return {'median': float(result[0]), 'sample_size': None, 'outliers_removed': 0}
                     else:
                         query = """
                             SELECT PERCENTILE_CONT(0.5) WITHIN GROUP (ORDER BY price) as median
@@ -96,7 +220,9 @@ class MedianPriceCalculator:
                         """
                         cur.execute(query, (city, model))
                         result = cur.fetchone()
-                        return float(result[0]) if result and result[0] else None
+                        if not result or not result[0]:
+                            return None
+                        return {'median': float(result[0]), 'sample_size': None, 'outliers_removed': 0}
                 
                 # Получаем все цены и вычисляем медиану в Python
                 prices = [row[0] for row in cur.fetchall()]
@@ -105,87 +231,338 @@ class MedianPriceCalculator:
                     logger.debug(f"Нет данных для расчета медианной цены: {city}, {model}, {source}")
                     return None
                 
-                # Сортируем и находим медиану
-                prices_sorted = sorted(prices)
-                n = len(prices_sorted)
-                
-                if n % 2 == 0:
-                    median = (prices_sorted[n // 2 - 1] + prices_sorted[n // 2]) / 2
-                else:
-                    median = prices_sorted[n // 2]
+                stats = robust_median(
+                    prices, MEDIAN_ESTIMATOR,
+                    trim_percent=MEDIAN_TRIM_PERCENT, mad_threshold=MEDIAN_MAD_THRESHOLD,
+                    mad_min_scale_percent=MEDIAN_MAD_MIN_SCALE_PERCENT
+                )
                 
                 logger.info(
                     f"Медианная цена рассчитана: {city}, {model}, {source or 'all'}, "
-                    f"медиана={median:.2f}, записей={n}"
+                    f"медиана={stats['median']:.2f}, записей={stats['sample_size']}, "
+                    f"отброшено выбросов={stats['outliers_removed']} ({MEDIAN_ESTIMATOR})"
                 )
                 
-                return float(median)
+                return stats
                 
         except Exception as e:
+            if conn is not None and not conn.closed:
+                conn.rollback()
             logger.error(f"Ошибка расчета медианной цены для {city}, {model}, {source}: {e}")
             return None
     
-    def recalculate_all_medians(self, source: str = None):
+    @classmethod
+    def compute_price_ceiling(cls, median_price: float, source: str) -> int:
         """
-        Пересчитать медианные цены для всех комбинаций город-модель
+        Максимальная цена, которая еще считается выгодной для данной медианы
+        
+        Цена выгодна, если она ниже медианной на DEAL_DISCOUNT_PERCENT
+        или на MIN_DISCOUNT_BY_SOURCE, то есть не выше большего из двух порогов.
+        """
+        by_percent = median_price * (100 - cls.DEAL_DISCOUNT_PERCENT) / 100
+        by_amount = median_price - cls.MIN_DISCOUNT_BY_SOURCE.get(source, 0)
+        return math.floor(max(by_percent, by_amount))
+    
+    @classmethod
+    def _threshold_from_stats(cls, stats: Dict, source: str) -> Dict:
+        """Порог выгодности по результату calculate_median_stats"""
+        return {
+            'median_price': stats['median'],
+            'price_ceiling': cls.compute_price_ceiling(stats['median'], source),
+            'sample_size': stats['sample_size'],
+            'outliers_removed': stats['outliers_removed'],
+        }
+    
+    def get_deal_threshold(self, source: str, city: str, model: str) -> Optional[Dict]:
+        """
+        Получить предрассчитанный порог выгодности
+        
+        Returns:
+            {'median_price', 'price_ceiling', 'sample_size', 'outliers_removed'} или None
+        """
+        return self.deal_thresholds.get((source, city, model))
+    
+    def reload_deal_thresholds(self, key: Optional[tuple] = None) -> int:
+        """
+        Перечитать пороги выгодности из deal_thresholds в кэш
+        
+        Пороги пишет плановый пересчет на любом экземпляре приложения, поэтому
+        кэш перечитывается в начале цикла парсинга и при промахе.
+        
+        Args:
+            key: (source, city, model) - перечитать только эту комбинацию
+        
+        Returns:
+            Количество прочитанных порогов
+        """
+        thresholds = self.db.get_deal_thresholds(key)
+        self.deal_thresholds.update(thresholds)
+        return len(thresholds)
+    
+    def refresh_deal_threshold(self, source: str, city: str, model: str) -> Optional[Dict]:
+        """
+        Порог комбинации, которой нет в кэше
+        
+        Сначала порог ищется в deal_thresholds (его мог рассчитать другой
+        экземпляр), и только если его там нет - считается по окну медианы.
+        Медиана в объявления при этом не записывается: это делает плановый
+        пересчет (_recalculate).
+        
+        Returns:
+            Порог (см. get_deal_threshold) или None, если объявлений для медианы нет
+        """
+        key = (source, city, model)
+        if self.reload_deal_thresholds(key):
+            return self.deal_thresholds[key]
+        
+        stats = self.calculate_median_stats(city, model, source)
+        if not stats or not stats['median']:
+            return None
+        threshold = self._threshold_from_stats(stats, source)
+        try:
+            with self.db.cursor() as cur:
+                self.db.execute_prepared(cur, 'deal_threshold_upsert', (
+                    source, city, model, threshold['median_price'],
+                    threshold['price_ceiling'], threshold['sample_size'], threshold['outliers_removed']
+                ))
+        except Exception as e:
+            logger.error(f"Ошибка сохранения порога выгодности для {city}, {model}, {source}: {e}")
+        self.deal_thresholds[key] = threshold
+        return threshold
+    
+    async def reload_deal_thresholds_async(self) -> int:
+        """Перечитать пороги выгодности, не блокируя event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._threshold_executor, self.reload_deal_thresholds)
+    
+    async def refresh_deal_threshold_async(self, source: str, city: str, model: str) -> Optional[Dict]:
+        """Получить порог комбинации, которой нет в кэше, не блокируя event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._threshold_executor, self.refresh_deal_threshold, source, city, model)
+    
+    async def recalculate_all_medians_async(
+        self,
+        source: str = None,
+        city: str = None,
+        model: str = None,
+        progress_callback: Callable[[int, int], None] = None
+    ) -> int:
+        """
+        Пересчитать медианные цены в рабочем потоке, не блокируя event loop
         
         Args:
             source: Источник (avito/kufar) или None для всех
+            city, model: Ограничить пересчет одной комбинацией
+            progress_callback: Вызывается в event loop как callback(готово, всего)
+        
+        Returns:
+            Количество обновленных комбинаций город-модель
+        """
+        loop = asyncio.get_running_loop()
+        cancel_event = threading.Event()
+        
+        def report(done: int, total: int):
+            if progress_callback:
+                loop.call_soon_threadsafe(progress_callback, done, total)
+        
+        future = loop.run_in_executor(
+            self._executor, self._recalculate, source, city, model, report, cancel_event
+        )
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # Останавливаем пересчет между комбинациями (например, по таймауту планировщика)
+            cancel_event.set()
+            raise
+    
+    def _recalculate(
+        self,
+        source: str = None,
+        city: str = None,
+        model: str = None,
+        progress_callback: Callable[[int, int], None] = None,
+        cancel_event: threading.Event = None
+    ) -> int:
+        """
+        Пересчитать медианные цены для комбинаций город-модель
+        
+        Выполняется в рабочем потоке на выделенном соединении. Каждая
+        комбинация фиксируется отдельной короткой транзакцией.
         """
+        conn = self._get_worker_connection()
+        scope = source or 'all'
+        
         try:
-            logger.info(f"Начало пересчета медианных цен для источника: {source or 'all'}")
+            logger.info(f"Начало пересчета медианных цен для источника: {scope}")
             
-            with self.db.conn.cursor() as cur:
-                # Получаем все уникальные комбинации город-модель
+            with conn.cursor() as cur:
+                # Получаем уникальные комбинации город-модель
+                conditions = []
+                params = []
                 if source:
-                    query = """
-                        SELECT DISTINCT city, model 
-                        FROM advertisements 
-                        WHERE source = %s
-                    """
-                    cur.execute(query, (source,))
-                else:
-                    query = """
-                        SELECT DISTINCT city, model 
-                        FROM advertisements
-                    """
-                    cur.execute(query)
+                    conditions.append("source = %s")
+                    params.append(source)
+                if city:
+                    conditions.append("city = %s")
+                    params.append(city)
+                if model:
+                    conditions.append("model = %s")
+                    params.append(model)
+                where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
                 
+                cur.execute(f"SELECT DISTINCT city, model FROM advertisements {where}", params)
                 combinations = cur.fetchall()
-                logger.info(f"Найдено {len(combinations)} комбинаций город-модель для пересчета")
+                conn.commit()
+            
+            total = len(combinations)
+            logger.info(f"Найдено {total} комбинаций город-модель для пересчета")
+            
+            updated_count = 0
+            for done, (combo_city, combo_model) in enumerate(combinations, start=1):
+                if cancel_event is not None and cancel_event.is_set():
+                    logger.warning(f"Пересчет медианных цен прерван: {done - 1}/{total}")
+                    break
                 
-                updated_count = 0
-                for city, model in combinations:
-                    median_price = self.calculate_median_price(city, model, source)
-                    
-                    if median_price:
-                        # Обновляем медианные цены для всех объявлений этой комбинации
+                stats = self.calculate_median_stats(combo_city, combo_model, source, conn=conn)
+                median_price = stats['median'] if stats else None
+                
+                if median_price:
+                    # Обновляем медианные цены для всех объявлений этой комбинации
+                    with conn.cursor() as cur:
                         if source:
-                            update_query = """
-                                UPDATE advertisements
-                                SET median_price = %s,
-                                    price_difference = price - %s,
-                                    updated_at = CURRENT_TIMESTAMP
-                                WHERE city = %s AND model = %s AND source = %s
-                            """
-                            cur.execute(update_query, (median_price, median_price, city, model, source))
-                        else:
-                            update_query = """
-                                UPDATE advertisements
-                                SET median_price = %s,
-                                    price_difference = price - %s,
-                                    updated_at = CURRENT_TIMESTAMP
-                                WHERE city = %s AND model = %s
-                            """
-                            cur.execute(update_query, (median_price, median_price, city, model))
+                            # Порог выгодности и размер выборки пересчитываются вместе с медианой
+                            threshold = self._threshold_from_stats(stats, source)
+                            self.db.execute_prepared(cur, 'deal_threshold_upsert', (
+                                source, combo_city, combo_model, threshold['median_price'],
+                                threshold['price_ceiling'], threshold['sample_size'], threshold['outliers_removed']
+                            ))
+                            self.deal_thresholds[(source, combo_city, combo_model)] = threshold
                         
-                        updated_count += 1
+                        if source:
+                            self.db.execute_prepared(
+                                cur, 'ads_set_median', (median_price, combo_city, combo_model, source)
+                            )
+                        else:
+                            self.db.execute_prepared(
+                                cur, 'ads_set_median_all_sources', (median_price, combo_city, combo_model)
+                            )
+                    updated_count += 1
                 
-                self.db.conn.commit()
-                logger.info(f"Пересчет завершен. Обновлено {updated_count} комбинаций")
+                conn.commit()
+                if progress_callback:
+                    progress_callback(done, total)
+                if total >= 10 and done % max(1, total // 10) == 0:
+                    logger.info(f"Пересчет медианных цен ({scope}): {done}/{total}")
+            
+            logger.info(f"Пересчет завершен. Обновлено {updated_count} комбинаций")
+            return updated_count
                 
         except Exception as e:
-            self.db.conn.rollback()
+            conn.rollback()
             logger.error(f"Ошибка пересчета медианных цен: {e}")
             raise
-
+    
+    async def check_index_usage_async(self) -> Dict:
+        """Проверить план запроса окна медианы в рабочем потоке калькулятора"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.check_index_usage)
+    
+    def check_index_usage(self) -> Dict:
+        """
+        Проверить, что планировщик Postgres использует покрывающий индекс окна медианы
+        
+        Выполняет EXPLAIN запроса MEDIAN_WINDOW_QUERY для самой частой
+        комбинации источник-город-модель. Если индекс не используется или
+        используется не как Index Only Scan, пишет предупреждение в лог.
+        
+        Returns:
+            {'uses_index': bool, 'index_only': bool, 'node_type': str | None,
+             'partitions_scanned': int}
+        """
+        conn = self._get_worker_connection()
+        report = {'uses_index': False, 'index_only': False, 'node_type': None, 'partitions_scanned': 0}
+        
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT source, city, model FROM advertisements
+                    GROUP BY source, city, model
+                    ORDER BY COUNT(*) DESC
+                    LIMIT 1
+                """)
+                sample = cur.fetchone()
+                if not sample:
+                    conn.commit()
+                    return report
+                
+                # advertisements секционирована: в плане фигурируют индексы секций,
+                # унаследованные от MEDIAN_WINDOW_INDEX
+                cur.execute("""
+                    SELECT c.relname FROM pg_inherits i
+                    JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = to_regclass(%s)
+                """, (self.MEDIAN_WINDOW_INDEX,))
+                index_names = {self.MEDIAN_WINDOW_INDEX} | {row[0] for row in cur.fetchall()}
+                
+                source, city, model = sample
+                date_threshold = datetime.now() - timedelta(days=self.MEDIAN_CALCULATION_PERIOD_DAYS)
+                cur.execute(
+                    "EXPLAIN (FORMAT JSON) " + self.MEDIAN_WINDOW_QUERY,
+                    (city, model, source, date_threshold, self.MAX_RECORDS_FOR_MEDIAN)
+                )
+                plan = cur.fetchone()[0]
+                conn.commit()
+            
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            
+            # Обходим дерево плана: узлы с нашим индексом и просканированные секции
+            index_nodes = []
+            relations = set()
+            nodes = [plan[0]['Plan']]
+            while nodes:
+                node = nodes.pop()
+                if node.get('Relation Name'):
+                    relations.add(node['Relation Name'])
+                if node.get('Index Name') in index_names:
+                    index_nodes.append(node)
+                nodes.extend(node.get('Plans', []))
+            
+            report['partitions_scanned'] = len(relations)
+            if index_nodes:
+                report['uses_index'] = True
+                report['node_type'] = index_nodes[0].get('Node Type')
+                report['index_only'] = all(node.get('Node Type') == 'Index Only Scan' for node in index_nodes)
+            
+            if report['index_only']:
+                logger.info(
+                    f"Запрос окна медианы использует {self.MEDIAN_WINDOW_INDEX} (Index Only Scan), "
+                    f"секций: {report['partitions_scanned']}"
+                )
+            elif report['uses_index']:
+                logger.warning(
+                    f"Запрос окна медианы использует {self.MEDIAN_WINDOW_INDEX} как {report['node_type']}, "
+                    f"а не Index Only Scan (возможно, нужен VACUUM advertisements)"
+                )
+            else:
+                logger.warning(
+                    f"Планировщик перестал использовать {self.MEDIAN_WINDOW_INDEX} для окна медианы: "
+                    f"{plan[0]['Plan'].get('Node Type')} ({source}, {city}, {model})"
+                )
+            if report['partitions_scanned'] > 2:
+                # Окно в 30 дней должно попадать не более чем в две помесячные секции
+                logger.warning(
+                    f"Запрос окна медианы сканирует {report['partitions_scanned']} секций advertisements"
+                )
+            return report
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Ошибка проверки плана запроса окна медианы: {e}")
+            return report
+    
+    def close(self):
+        """Остановить рабочие потоки и закрыть выделенное соединение"""
+        self._threshold_executor.shutdown(wait=True)
+        self._executor.shutdown(wait=True)
+        if self._worker_conn and not self._worker_conn.closed:
+            self._worker_conn.close()
@@ -0,0 +1,160 @@
+"""
+Локальный журнал отложенных записей в базу данных
+
+Пока база недоступна, записи дописываются в файл: каждая запись - 4 байта
+длины (big-endian) и JSON с именем операции и данными. После восстановления
+соединения журнал читается и воспроизводится пачками (см. AsyncDatabase).
+
+Методы блокирующие (fsync, чтение и перезапись файла) - из асинхронного кода
+их вызывают через asyncio.to_thread.
+"""
+import fcntl
+import json
+import os
+import shutil
+import struct
+import threading
+from typing import List, Tuple
+from utils.logger import get_logger
+
+logger = get_logger('write_spool')
+
+# Заголовок записи: длина JSON в байтах
+RECORD_HEADER = struct.Struct('>I')
+
+
+class WriteSpool:
+    """Файл записей с префиксом длины: только дописывание в конец"""
+
+    def __init__(self, path: str, max_bytes: int = 0):
+        self.path, self._lock_file = self._claim(path)
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        # Дописывание и удаление прочитанного идут из разных потоков
+        self._lock = threading.Lock()
+        self._size = 0
+        self._repair()
+
+    @staticmethod
+    def _claim(path: str):
+        """
+        Занять файл журнала монопольно (flock на соседнем .lock)
+
+        Журнал не может быть общим для нескольких процессов: consume()
+        перезаписывает файл и потерял бы чужие записи. Если файл занят другим
+        процессом, используется путь с pid.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        base, ext = os.path.splitext(path)
+        for candidate in (path, f"{base}.{os.getpid()}{ext}"):
+            lock_file = open(candidate + '.lock', 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            if candidate != path:
+                logger.warning(f"Журнал {path} занят другим процессом, используется {candidate}")
+            return candidate, lock_file
+        raise RuntimeError(f"Не удалось занять журнал {path}")
+
+    def _repair(self):
+        """Отрезать оборванную последнюю запись (сбой процесса во время записи)"""
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        offset = 0
+        with open(self.path, 'rb') as spool:
+            # Идем только по заголовкам, содержимое записей не читаем
+            while True:
+                header = spool.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                (length,) = RECORD_HEADER.unpack(header)
+                if offset + RECORD_HEADER.size + length > size:
+                    break
+                offset += RECORD_HEADER.size + length
+                spool.seek(offset)
+        if offset < size:
+            with open(self.path, 'r+b') as spool:
+                spool.truncate(offset)
+            logger.warning(f"Журнал {self.path}: отброшена неполная запись ({size - offset} байт)")
+        self._size = offset
+        if offset:
+            logger.info(f"Журнал {self.path}: есть невоспроизведенные записи ({offset} байт)")
+
+    def size(self) -> int:
+        """Размер журнала в байтах (0 - записей нет); без обращения к диску"""
+        return self._size
+
+    def append(self, op: str, payload) -> bool:
+        """
+        Дописать запись и сбросить ее на диск
+
+        Returns:
+            False, если журнал достиг max_bytes и запись отброшена
+        """
+        data = json.dumps({'op': op, 'payload': payload}, ensure_ascii=False, default=str).encode('utf-8')
+        with self._lock:
+            if self.max_bytes and self._size + RECORD_HEADER.size + len(data) > self.max_bytes:
+                self.dropped += 1
+                if self.dropped % 100 == 1:
+                    logger.error(f"Журнал {self.path} переполнен, отброшено записей: {self.dropped}")
+                return False
+            with open(self.path, 'ab') as spool:
+                spool.write(RECORD_HEADER.pack(len(data)) + data)
+                spool.flush()
+                os.fsync(spool.fileno())
+            self._size += RECORD_HEADER.size + len(data)
+        return True
+
+    def read(self, offset: int, max_rows: int) -> List[Tuple[str, object, int]]:
+        """
+        Прочитать записи начиная с offset, пока не наберется max_rows строк
+
+        Returns:
+            [(операция, данные, смещение конца записи), ...] - смещение
+            последней обработанной записи затем передают в consume()
+        """
+        records = []
+        rows = 0
+        with self._lock:
+            end_of_data = self._size
+        try:
+            spool = open(self.path, 'rb')
+        except FileNotFoundError:
+            return records
+        with spool:
+            spool.seek(offset)
+            while rows < max_rows and offset + RECORD_HEADER.size <= end_of_data:
+                (length,) = RECORD_HEADER.unpack(spool.read(RECORD_HEADER.size))
+                record = json.loads(spool.read(length))
+                offset += RECORD_HEADER.size + length
+                records.append((record['op'], record['payload'], offset))
+                rows += len(record['payload']['rows'])
+        return records
+
+    def consume(self, offset: int):
+        """
+        Удалить из журнала первые offset байт (воспроизведенные записи)
+
+        Вызывается один раз после воспроизведения. Записи, дописанные за это
+        время, сохраняются: остаток копируется во временный файл, который
+        атомарно заменяет журнал.
+        """
+        with self._lock:
+            if offset >= self._size:
+                os.remove(self.path)
+                self._size = 0
+                return
+            temp_path = self.path + '.tmp'
+            with open(self.path, 'rb') as spool, open(temp_path, 'wb') as rest:
+                spool.seek(offset)
+                shutil.copyfileobj(spool, rest)
+                rest.flush()
+                os.fsync(rest.fileno())
+            os.replace(temp_path, self.path)
+            self._size -= offset